@@ -817,22 +817,20 @@ def evaluate_t5(model, val_loader, task: str = "qa"):
 # Evaluate T5 QA
 t5_qa_bleu, t5_qa_rouge, t5_qa_bert = evaluate_t5(t5_qa_model, qa_val_loader, task="qa")
 
-# Ensemble: T5 generates candidates, DPR re-ranks
-def ensemble_evaluate(t5_model, ctx_encoder, question_encoder, val_loader, candidates, top_k: int = 30):
+# Ensemble: T5 generates candidates, DPR re-ranks them against the question.
+# Per batch the question is DPR-encoded once, the generated sequences are deduplicated across the whole
+# batch and encoded in a single context-encoder pass, and one matmul scores every (question, sequence) pair.
+def ensemble_evaluate(t5_model, ctx_encoder, question_encoder, val_loader, top_k: int = 30):
     print("Evaluating ensemble (T5 + DPR)...")
     t5_model.eval()
     ctx_encoder.eval()
     question_encoder.eval()
     mrr, precision_at_1 = [], []
-    candidate_inputs = ctx_tokenizer(candidates, return_tensors="pt", padding=True, truncation=True, max_length=CONFIG.MAX_LENGTH)
-    candidate_inputs = {k: v.to(CONFIG.DEVICE) for k, v in candidate_inputs.items()}
-    with torch.no_grad():
-        candidate_embeddings = ctx_encoder(**candidate_inputs).pooler_output
     with torch.no_grad():
         for batch in tqdm(val_loader, desc="Ensemble Evaluating"):
             input_ids = batch["t5_input_ids"].to(CONFIG.DEVICE)
             attention_mask = batch["t5_attention_mask"].to(CONFIG.DEVICE)
-            references = batch["answer"]
+            references = [ref.lower().strip() for ref in batch["answer"]]
             generated_ids = t5_model.generate(
                 input_ids=input_ids,
                 attention_mask=attention_mask,
@@ -841,29 +839,37 @@ def ensemble_evaluate(t5_model, ctx_encoder, question_encoder, val_loader, candi
                 temperature=0.5,
                 num_return_sequences=top_k
             )
-            generated_texts = [t5_tokenizer.decode(g_ids, skip_special_tokens=True).lower().strip() for g_ids in generated_ids]
-            generated_texts = [generated_texts[i:i+top_k] for i in range(0, len(generated_texts), top_k)]
-            for i, (gen_texts, ref) in enumerate(zip(generated_texts, references)):
-                if not gen_texts:  # Skip if no candidates generated
-                    continue
-                gen_inputs = question_tokenizer(gen_texts, return_tensors="pt", padding=True, truncation=True, max_length=CONFIG.MAX_LENGTH)
-                gen_inputs = {k: v.to(CONFIG.DEVICE) for k, v in gen_inputs.items()}
-                gen_embeddings = question_encoder(**gen_inputs).pooler_output
-                gen_similarities = torch.matmul(gen_embeddings, candidate_embeddings.T)
-                rankings = torch.argsort(gen_similarities, dim=1, descending=True)
-                if rankings.size(0) == 0 or rankings.size(1) == 0:  # Skip if rankings are empty
-                    continue
-                top_idx = rankings[0, 0].item()  # Take the top-ranked candidate
-                if top_idx >= len(gen_texts):  # Ensure top_idx is within bounds
-                    continue
-                predicted = gen_texts[top_idx]
-                ref_idx = gen_texts.index(ref) if ref in gen_texts else -1
-                if ref_idx == -1:
+            generated_texts = [text.lower().strip() for text in t5_tokenizer.batch_decode(generated_ids, skip_special_tokens=True)]
+            # Map every distinct sequence in the batch to one column; each question keeps the columns it generated
+            unique_texts = {}
+            question_columns = []
+            for i in range(len(references)):
+                texts = dict.fromkeys(text for text in generated_texts[i * top_k:(i + 1) * top_k] if text)
+                question_columns.append([unique_texts.setdefault(text, len(unique_texts)) for text in texts])
+            if not unique_texts:  # Skip if no candidates generated
+                continue
+            question_embeddings = question_encoder(
+                input_ids=batch["dpr_input_ids"].to(CONFIG.DEVICE),
+                attention_mask=batch["dpr_attention_mask"].to(CONFIG.DEVICE)
+            ).pooler_output
+            gen_inputs = ctx_tokenizer(list(unique_texts), return_tensors="pt", padding=True, truncation=True, max_length=CONFIG.MAX_LENGTH)
+            gen_inputs = {k: v.to(CONFIG.DEVICE) for k, v in gen_inputs.items()}
+            gen_embeddings = ctx_encoder(**gen_inputs).pooler_output
+            similarities = torch.matmul(question_embeddings, gen_embeddings.T)  # Shape: (batch_size, num_unique)
+            # Hide sequences another question generated, so each row only ranks its own candidates
+            own_columns = torch.zeros_like(similarities, dtype=torch.bool)
+            for i, columns in enumerate(question_columns):
+                own_columns[i, columns] = True
+            similarities = similarities.masked_fill(~own_columns, float("-inf"))
+            rankings = torch.argsort(similarities, dim=1, descending=True).cpu()
+            for i, (columns, ref) in enumerate(zip(question_columns, references)):
+                ref_column = unique_texts.get(ref, -1)
+                if ref_column not in columns:  # Reference was not generated for this question
                     continue
-                rank = (rankings[:, 0] == ref_idx).nonzero(as_tuple=True)[0].item() + 1 if ref_idx in rankings[:, 0] else len(gen_texts)
+                rank = (rankings[i, :len(columns)] == ref_column).nonzero(as_tuple=True)[0].item() + 1
                 mrr.append(1.0 / rank)
                 precision_at_1.append(1.0 if rank == 1 else 0.0)
-            del input_ids, attention_mask, generated_ids, gen_inputs, gen_similarities, rankings
+            del input_ids, attention_mask, generated_ids, gen_inputs, gen_embeddings, similarities, rankings
             torch.cuda.empty_cache()
     avg_mrr = np.mean(mrr) if mrr else 0.0
     avg_precision_at_1 = np.mean(precision_at_1) if precision_at_1 else 0.0
@@ -873,7 +879,7 @@ def ensemble_evaluate(t5_model, ctx_encoder, question_encoder, val_loader, candi
     return avg_mrr, avg_precision_at_1
 
 # Evaluate ensemble
-ensemble_mrr, ensemble_precision = ensemble_evaluate(t5_qa_model, ctx_encoder, question_encoder, qa_val_loader, all_candidates)
+ensemble_mrr, ensemble_precision = ensemble_evaluate(t5_qa_model, ctx_encoder, question_encoder, qa_val_loader)
 
 # Save evaluation results
 results = {
@@ -45,6 +45,7 @@ import lime.lime_text
 import string
 import nltk
 import json
+import weakref
 
 nltk.download('wordnet')
 nltk.download('punkt')
@@ -222,26 +223,41 @@ print("Helper functions defined.")
 
 # Explainability with LIME and Custom Permutation SHAP
 
-# Function to compute DPR similarity scores for a given question embedding and candidates
-def compute_dpr_similarities_from_embedding(question_embedding, candidates, question_encoder, ctx_encoder, tokenizer):
-    with torch.no_grad():
-        # Convert NumPy array to PyTorch tensor and ensure correct device and shape
-        question_embedding = torch.tensor(question_embedding, dtype=torch.float32).to(CONFIG.DEVICE).unsqueeze(0)  # Shape: (1, 768)
-
-        # Encode candidates using DPR ctx_encoder
-        candidate_inputs = tokenizer(
-            candidates,
-            return_tensors="pt",
-            padding=True,
-            truncation=True,
-            max_length=CONFIG.MAX_LENGTH
-        )
-        candidate_inputs = {k: v.to(CONFIG.DEVICE) for k, v in candidate_inputs.items()}
-        candidate_embeddings = ctx_encoder(**candidate_inputs).pooler_output  # Shape: (num_candidates, 768)
-
-        # Compute similarities
-        similarities = torch.matmul(question_embedding, candidate_embeddings.T).squeeze(0)  # Shape: (num_candidates,)
-        return similarities.cpu().numpy()
+# Candidate embeddings for DPR explanations, encoded once per context encoder and reused by every perturbed sample
+class CandidateMatrix:
+    def __init__(self, candidates, ctx_encoder, tokenizer, batch_size=64):
+        self.candidates = list(dict.fromkeys(candidates))
+        self.index = {candidate: idx for idx, candidate in enumerate(self.candidates)}
+        embeddings = []
+        with torch.no_grad():
+            for start in range(0, len(self.candidates), batch_size):
+                candidate_inputs = tokenizer(
+                    self.candidates[start:start + batch_size],
+                    return_tensors="pt",
+                    padding=True,
+                    truncation=True,
+                    max_length=CONFIG.MAX_LENGTH
+                )
+                candidate_inputs = {k: v.to(CONFIG.DEVICE) for k, v in candidate_inputs.items()}
+                embeddings.append(ctx_encoder(**candidate_inputs).pooler_output)
+        self.embeddings = torch.cat(embeddings)  # Shape: (num_candidates, 768)
+
+    # Embeddings of the given candidates, in the given order
+    def rows(self, candidates):
+        return self.embeddings[[self.index[candidate] for candidate in candidates]]
+
+# Keyed on the encoder object itself and held weakly, so a freed encoder drops its matrix. The matrix is not
+# re-encoded if an encoder's weights change, so encoders must not be retrained while their matrix is in use.
+candidate_matrices = weakref.WeakKeyDictionary()
+
+# Cached candidate matrix for a context encoder, re-encoded only when new candidates are requested
+def get_candidate_matrix(ctx_encoder, candidates, tokenizer):
+    matrix = candidate_matrices.get(ctx_encoder)
+    if matrix is None or any(candidate not in matrix.index for candidate in candidates):
+        known = matrix.candidates if matrix is not None else []
+        matrix = CandidateMatrix(known + list(candidates), ctx_encoder, tokenizer)
+        candidate_matrices[ctx_encoder] = matrix
+    return matrix
 
 # Function to convert text to embeddings using SentenceTransformer and align with DPR
 def text_to_dpr_embedding(texts, sentence_transformer, question_encoder, tokenizer):
@@ -260,32 +276,29 @@ def text_to_dpr_embedding(texts, sentence_transformer, question_encoder, tokeniz
         dpr_embeddings = question_encoder(**dpr_inputs).pooler_output  # Shape: (n_texts, 768)
     return dpr_embeddings.cpu().numpy()
 
-# Wrapper function for general use
+# Wrapper function for general use: all texts are encoded in one batch and scored with one matmul against the
+# cached candidate matrix
 def dpr_predict(texts):
-    embeddings = text_to_dpr_embedding(texts, sentence_transformer, question_encoder, question_tokenizer)
-    similarities_list = []
-    for emb in embeddings:
-        similarities = compute_dpr_similarities_from_embedding(emb, all_candidates[:100], question_encoder, ctx_encoder, question_tokenizer)
-        similarities_list.append(similarities)
-    return np.array(similarities_list)
-
-# Wrapper function for LIME to handle perturbed samples
-def lime_dpr_predict(texts):
+    embeddings = torch.tensor(text_to_dpr_embedding(texts, sentence_transformer, question_encoder, question_tokenizer)).to(CONFIG.DEVICE)
+    candidate_embeddings = get_candidate_matrix(ctx_encoder, all_candidates[:100], question_tokenizer).rows(all_candidates[:100])
+    with torch.no_grad():
+        return torch.matmul(embeddings, candidate_embeddings.T).cpu().numpy()  # Shape: (n_texts, num_candidates)
+
+# Wrapper function for LIME to handle perturbed samples: explains the similarity of one target candidate, or its
+# reciprocal rank among the candidates when target="rank"
+def lime_dpr_predict(texts, target_candidate, target="score"):
     # Ensure texts is a list of strings
     if not isinstance(texts, list):
         texts = [texts]
-    # Get the number of perturbed samples from the input (LIME provides this)
-    num_samples = len(texts)
-    embeddings = text_to_dpr_embedding(texts, sentence_transformer, question_encoder, question_tokenizer)  # Shape: (num_samples, 768)
-    similarities_list = []
-    for emb in embeddings:
-        similarities = compute_dpr_similarities_from_embedding(emb, all_candidates[:100], question_encoder, ctx_encoder, question_tokenizer)
-        similarities_list.append(similarities)
-    # Ensure output shape matches LIME's expectation (num_samples, num_classes)
-    similarities_array = np.array(similarities_list)  # Shape: (num_samples, num_candidates)
-    # Convert to binary classification (similar vs. not similar) for LIME
-    probs = (similarities_array - similarities_array.min()) / (similarities_array.max() - similarities_array.min())
-    return np.vstack([1 - probs, probs]).T  # Shape: (num_samples, 2)
+    similarities_array = dpr_predict(texts)  # Shape: (num_samples, num_candidates)
+    target_scores = similarities_array[:, all_candidates[:100].index(target_candidate)]
+    if target == "rank":
+        target_scores = 1.0 / ((similarities_array > target_scores[:, None]).sum(axis=1) + 1)
+    return target_scores[:, None]  # Shape: (num_samples, 1), explained as LIME label 0
+
+# Top-1 candidate for the unperturbed question, the default explanation target
+def top_dpr_candidate(question):
+    return all_candidates[:100][int(dpr_predict([question])[0].argmax())]
 
 # Custom permutation-based SHAP approximation
 def custom_permutation_shap(question, candidates, num_permutations=50):
@@ -309,7 +322,7 @@ triple_examples = triple_val_df.sample(n=10, random_state=42)
 
 # LIME Explainability (Primary Method)
 print("Computing LIME explanations...")
-lime_explainer = lime.lime_text.LimeTextExplainer(class_names=["similarity_score"])
+lime_explainer = lime.lime_text.LimeTextExplainer(class_names=["target_similarity"])
 
 lime_explanations_qa = []
 lime_explanations_triple = []
@@ -317,15 +330,21 @@ lime_explanations_triple = []
 # LIME for QA examples
 for i, row in qa_examples.iterrows():
     question = row["question"]
-    explanation = lime_explainer.explain_instance(question, lime_dpr_predict, num_features=5, num_samples=100)  # Match num_samples to LIME default
-    lime_explanations_qa.append((question, explanation.as_list()))
+    target_candidate = top_dpr_candidate(question)
+    explanation = lime_explainer.explain_instance(
+        question, lambda texts: lime_dpr_predict(texts, target_candidate), num_features=5, num_samples=100, labels=(0,)
+    )  # Match num_samples to LIME default
+    lime_explanations_qa.append((question, target_candidate, explanation.as_list(label=0)))
     print(f"LIME computed for QA example {i+1}/10")
 
 # LIME for triple examples
 for i, row in triple_examples.iterrows():
     question = row["question"]
-    explanation = lime_explainer.explain_instance(question, lime_dpr_predict, num_features=5, num_samples=100)
-    lime_explanations_triple.append((question, explanation.as_list()))
+    target_candidate = top_dpr_candidate(question)
+    explanation = lime_explainer.explain_instance(
+        question, lambda texts: lime_dpr_predict(texts, target_candidate), num_features=5, num_samples=100, labels=(0,)
+    )
+    lime_explanations_triple.append((question, target_candidate, explanation.as_list(label=0)))
     print(f"LIME computed for triple example {i+1}/10")
 
 # Custom Permutation SHAP (Secondary Method)
@@ -362,13 +381,15 @@ print(f"Saved explainability results at {explainability_path}")
 
 # Print sample explanations
 print("Sample LIME Explanations (QA):")
-for question, explanation in lime_explanations_qa[:2]:
+for question, target_candidate, explanation in lime_explanations_qa[:2]:
     print(f"Question: {question}")
+    print(f"Explained candidate: {target_candidate}")
     print(f"LIME Explanation: {explanation}\n")
 
 print("Sample LIME Explanations (Triple):")
-for question, explanation in lime_explanations_triple[:2]:
+for question, target_candidate, explanation in lime_explanations_triple[:2]:
     print(f"Question: {question}")
+    print(f"Explained candidate: {target_candidate}")
     print(f"LIME Explanation: {explanation}\n")
 
 print("Sample Permutation SHAP Explanations (QA):")
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""Artifact manifest (JSON + pre-tokenized arrays) written by Step 2 and read by Steps 2, 3 and 4 (Version 3).
+
+Copy this file next to the notebooks' code folder (Config.CODE_PATH) so each step imports the same implementation.
+"""
+
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import torch
+import transformers
+from torch.utils.data import Dataset, DataLoader
+
+ARTIFACT_MANIFEST_VERSION = 1
+TOKENIZED_FIELDS = ["bart_input_ids", "bart_attention_mask", "bart_labels", "dpr_input_ids", "dpr_attention_mask"]
+
+# SHA-256 of a file, used to tie split row ids to the exact CSV they index
+def file_sha256(path: str) -> str:
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+# Read the manifest written at the end of Step 2's training
+def load_artifact_manifest(manifest_dir: str) -> dict:
+    with open(os.path.join(manifest_dir, "manifest.json")) as f:
+        manifest = json.load(f)
+    if manifest.get("version") != ARTIFACT_MANIFEST_VERSION:
+        raise ValueError(f"{manifest_dir} has manifest version {manifest.get('version')}, expected {ARTIFACT_MANIFEST_VERSION}")
+    manifest["dir"] = manifest_dir
+    return manifest
+
+# Candidate lists are stored as JSON next to the manifest ("all" or "triple")
+def load_manifest_candidates(manifest: dict, name: str = "all") -> list:
+    with open(os.path.join(manifest["dir"], manifest["candidates"][name])) as f:
+        return json.load(f)
+
+# Dataset over one pre-tokenized split. Text comes from the source CSV rows named by the manifest; the token
+# arrays are memory-mapped on first access, so DataLoader workers each map their own view and nothing is copied up front
+class PretokenizedDataset(Dataset):
+    def __init__(self, manifest: dict, split: str):
+        self.manifest_dir = manifest["dir"]
+        self.split = manifest["splits"][split]
+        self.task = self.split["task"]
+        if file_sha256(self.split["source"]) != self.split["source_sha256"]:
+            raise ValueError(f"{self.split['source']} changed since the manifest was written; re-run Step 2")
+        row_ids = np.load(os.path.join(self.manifest_dir, self.split["row_ids"]))
+        self.data = pd.read_csv(self.split["source"]).loc[row_ids]
+        self.arrays = None
+
+    def __len__(self):
+        return self.split["num_rows"]
+
+    def __getitem__(self, idx):
+        if self.arrays is None:
+            self.arrays = {field: np.load(os.path.join(self.manifest_dir, path), mmap_mode="r")
+                           for field, path in self.split["arrays"].items()}
+        row = self.data.iloc[idx]
+        item = {"task": self.task}
+        for field in TOKENIZED_FIELDS:
+            item[field] = torch.from_numpy(self.arrays[field][idx].astype(np.int64))
+        item["question"] = row["question"]
+        item["context"] = row["context"]
+        item["answer"] = row["answer"]
+        if "label_idx" in self.arrays:
+            item["label_idx"] = int(self.arrays["label_idx"][idx])
+        return item
+
+# Rebuild DataLoaders for the requested splits (all by default); train splits are shuffled
+def build_manifest_loaders(manifest: dict, batch_size: int, num_workers: int, splits: list = None) -> dict:
+    loaders = {}
+    for split in splits or list(manifest["splits"]):
+        loaders[split] = DataLoader(PretokenizedDataset(manifest, split), batch_size=batch_size,
+                                    shuffle=split.endswith("_train"), num_workers=num_workers)
+    return loaders
+
+# Tokenize a split exactly like Step 2's RetrievalDataset.__getitem__, but for all rows at once
+def pretokenize_split(df: pd.DataFrame, task: str, bart_tokenizer, dpr_question_tokenizer, max_length: int,
+                      chunk_size: int = 1024) -> dict:
+    questions, contexts, answers = df["question"].tolist(), df["context"].tolist(), df["answer"].tolist()
+    if task == "qa":
+        bart_texts = [f"question: {q} context: {c}" for q, c in zip(questions, contexts)]
+    else:
+        bart_texts = [f"complete the triple with the exact object: {q} context: {c}" for q, c in zip(questions, contexts)]
+    def encode(tokenizer, texts):
+        input_ids, attention_mask = [], []
+        for start in range(0, len(texts), chunk_size):
+            encoded = tokenizer(texts[start:start + chunk_size], return_tensors="np", max_length=max_length, truncation=True, padding="max_length")
+            input_ids.append(encoded["input_ids"].astype(np.int32))
+            attention_mask.append(encoded["attention_mask"].astype(np.int8))
+        return np.concatenate(input_ids), np.concatenate(attention_mask)
+    arrays = {}
+    arrays["bart_input_ids"], arrays["bart_attention_mask"] = encode(bart_tokenizer, bart_texts)
+    arrays["bart_labels"], _ = encode(bart_tokenizer, answers)
+    arrays["dpr_input_ids"], arrays["dpr_attention_mask"] = encode(dpr_question_tokenizer, questions)
+    return arrays
+
+# Write split row ids, pre-tokenized arrays, candidate lists and model/tokenizer ids, then the manifest itself last.
+# splits maps a split name to (DataFrame, task, source CSV path); models maps a role to its model identifier.
+def write_artifact_manifest(manifest_dir: str, splits: dict, all_candidates: list, triple_candidates: list,
+                            bart_tokenizer, dpr_question_tokenizer, max_length: int, models: dict) -> dict:
+    os.makedirs(manifest_dir, exist_ok=True)
+    manifest = {
+        "version": ARTIFACT_MANIFEST_VERSION,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "max_length": max_length,
+        "tokenizers": {"bart": bart_tokenizer.name_or_path, "dpr_question": dpr_question_tokenizer.name_or_path},
+        "models": dict(models),
+        "library_versions": {"torch": torch.__version__, "transformers": transformers.__version__},
+        "candidates": {"all": "all_candidates.json", "triple": "triple_candidates.json"},
+        "splits": {}
+    }
+    for name, candidates in (("all", all_candidates), ("triple", triple_candidates)):
+        with open(os.path.join(manifest_dir, manifest["candidates"][name]), "w") as f:
+            json.dump(candidates, f)
+    for split, (df, task, source) in splits.items():
+        arrays = pretokenize_split(df, task, bart_tokenizer, dpr_question_tokenizer, max_length)
+        if task == "triple":
+            candidate_index = {candidate: idx for idx, candidate in enumerate(triple_candidates)}
+            arrays["label_idx"] = np.array([candidate_index.get(answer, -1) for answer in df["answer"]], dtype=np.int32)
+        files = {}
+        for field, array in arrays.items():
+            files[field] = f"{split}_{field}.npy"
+            np.save(os.path.join(manifest_dir, files[field]), array)
+        np.save(os.path.join(manifest_dir, f"{split}_row_ids.npy"), df.index.to_numpy(dtype=np.int64))
+        manifest["splits"][split] = {
+            "task": task,
+            "source": source,
+            "source_sha256": file_sha256(source),
+            "num_rows": len(df),
+            "row_ids": f"{split}_row_ids.npy",
+            "arrays": files
+        }
+    tmp_path = os.path.join(manifest_dir, "manifest.json.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, os.path.join(manifest_dir, "manifest.json"))
+    manifest["dir"] = manifest_dir
+    return manifest
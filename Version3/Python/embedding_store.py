@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""Memory-mapped candidate embedding store shared by Steps 2, 3 and 4 (Version 3).
+
+Copy this file next to the notebooks' code folder (Config.CODE_PATH) so each step imports the same implementation.
+"""
+
+import json
+import os
+
+import numpy as np
+import torch
+from tqdm import tqdm
+
+from prediction_cache import model_fingerprint
+
+# File layout: magic | uint64 header length | JSON header | zero padding to 64 bytes | body rows | int8 row scales
+EMBEDDING_STORE_MAGIC = b"LJMUEMB1"
+
+def embedding_store_body_offset(header_len: int) -> int:
+    return -(-(len(EMBEDDING_STORE_MAGIC) + 8 + header_len) // 64) * 64
+
+# Write candidate embeddings as fp16, or int8 with one symmetric scale per row
+def save_embedding_store(path: str, embeddings: torch.Tensor, candidates: list, encoder_fingerprint: str,
+                         dtype: str = "float16"):
+    embeddings = embeddings.detach().float().cpu().numpy()
+    count, dim = embeddings.shape
+    if len(candidates) != count:
+        raise ValueError(f"Got {count} embeddings for {len(candidates)} candidates")
+    scales = None
+    if dtype == "float16":
+        body = embeddings.astype(np.float16)
+    elif dtype == "int8":
+        scales = (np.abs(embeddings).max(axis=1) / 127.0).astype(np.float32)
+        scales[scales == 0] = 1.0
+        body = np.clip(np.round(embeddings / scales[:, None]), -127, 127).astype(np.int8)
+    else:
+        raise ValueError(f"Unsupported embedding store dtype: {dtype}")
+    header = {
+        "version": 1,
+        "count": count,
+        "dim": dim,
+        "dtype": dtype,
+        "encoder_fingerprint": encoder_fingerprint,
+        "candidates": list(candidates)
+    }
+    header_bytes = json.dumps(header).encode("utf-8")
+    body_offset = embedding_store_body_offset(len(header_bytes))
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(EMBEDDING_STORE_MAGIC)
+        f.write(np.array([len(header_bytes)], dtype=np.uint64).tobytes())
+        f.write(header_bytes)
+        f.write(b"\0" * (body_offset - f.tell()))
+        f.write(body.tobytes())
+        if scales is not None:
+            f.write(scales.tobytes())
+    os.replace(tmp_path, path)  # Readers never see a half-written store
+    print(f"Saved {count} x {dim} {dtype} candidate embeddings ({os.path.getsize(path) / 1024 ** 2:.1f} MB) at {path}")
+
+# Read-only view over a store file; the body is memory-mapped, so opening it copies nothing and
+# every process that opens the same file shares the OS page cache
+class CandidateEmbeddingStore:
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            if f.read(len(EMBEDDING_STORE_MAGIC)) != EMBEDDING_STORE_MAGIC:
+                raise ValueError(f"Not a candidate embedding store: {path}")
+            header_len = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+            header = json.loads(f.read(header_len).decode("utf-8"))
+        self.path = path
+        self.count = header["count"]
+        self.dim = header["dim"]
+        self.dtype = header["dtype"]
+        self.encoder_fingerprint = header["encoder_fingerprint"]
+        self.candidates = header["candidates"]
+        body_offset = embedding_store_body_offset(header_len)
+        body_dtype = np.float16 if self.dtype == "float16" else np.int8
+        self.body = np.memmap(path, dtype=body_dtype, mode="r", offset=body_offset, shape=(self.count, self.dim))
+        self.scales = None
+        if self.dtype == "int8":
+            self.scales = np.memmap(path, dtype=np.float32, mode="r", offset=body_offset + self.body.nbytes, shape=(self.count,))
+        self.device_cache = {}
+
+    def __len__(self):
+        return self.count
+
+    # Dequantized float32 rows (CPU) for a slice or list of candidate ids
+    def rows(self, indices) -> torch.Tensor:
+        block = np.asarray(self.body[indices], dtype=np.float32)
+        if self.scales is not None:
+            block *= np.asarray(self.scales[indices], dtype=np.float32)[:, None]
+        return torch.from_numpy(block)
+
+    # Half-precision copy on an accelerator, made once per device
+    def to_device(self, device) -> torch.Tensor:
+        device = torch.device(device)
+        if device not in self.device_cache:
+            matrix = torch.from_numpy(np.array(self.body)).to(device)
+            if self.scales is not None:
+                matrix = matrix.half() * torch.from_numpy(np.array(self.scales)).to(device).half()[:, None]
+            self.device_cache[device] = matrix
+        return self.device_cache[device]
+
+    # Similarities of query embeddings against every candidate, returned as float32 on the query device.
+    # On CPU the memory-mapped body is dequantized chunk by chunk instead of being materialized in full.
+    def scores(self, query_embeddings: torch.Tensor, chunk_size: int = 8192) -> torch.Tensor:
+        if query_embeddings.device.type == "cuda":
+            matrix = self.to_device(query_embeddings.device)
+            return torch.matmul(query_embeddings.half(), matrix.T).float()
+        query_embeddings = query_embeddings.float()
+        scores = torch.empty(query_embeddings.size(0), self.count, dtype=torch.float32)
+        for start in range(0, self.count, chunk_size):
+            end = min(start + chunk_size, self.count)
+            scores[:, start:end] = torch.matmul(query_embeddings, self.rows(slice(start, end)).T)
+        return scores
+
+def open_embedding_store(path: str) -> CandidateEmbeddingStore:
+    store = CandidateEmbeddingStore(path)
+    print(f"Opened {store.count} x {store.dim} {store.dtype} candidate embeddings from {path}")
+    return store
+
+# Check a store was built from the expected candidate order (and encoder, when a fingerprint is given)
+def verify_embedding_store(store: CandidateEmbeddingStore, candidates: list, encoder_fingerprint: str = None):
+    if store.candidates != list(candidates):
+        raise ValueError(f"Candidate order in {store.path} does not match the current candidate list")
+    if encoder_fingerprint and store.encoder_fingerprint not in ("unknown", encoder_fingerprint):
+        raise ValueError(f"{store.path} was built with a different context encoder")
+
+# Open a store, converting a legacy torch.save'd embedding tensor once if only that exists
+def open_or_convert_embedding_store(store_path: str, legacy_pt_path: str, candidates: list, dtype: str = "float16") -> CandidateEmbeddingStore:
+    if not os.path.exists(store_path) and os.path.exists(legacy_pt_path):
+        print(f"Converting legacy embeddings {legacy_pt_path} to {store_path}")
+        legacy_embeddings = torch.load(legacy_pt_path, map_location="cpu")
+        save_embedding_store(store_path, legacy_embeddings, candidates[:legacy_embeddings.size(0)], encoder_fingerprint="unknown", dtype=dtype)
+    return open_embedding_store(store_path)
+
+# Encode candidates into a store once per context encoder (on the encoder's device); later calls reuse the file
+# while encoder and candidates match
+def build_candidate_store(ctx_encoder, ctx_tokenizer, candidates: list, path: str, max_length: int, dtype: str = "float16",
+                          batch_size: int = 256) -> CandidateEmbeddingStore:
+    encoder_hash = model_fingerprint(ctx_encoder)
+    if os.path.exists(path):
+        store = open_embedding_store(path)
+        if store.candidates == list(candidates) and store.encoder_fingerprint == encoder_hash:
+            return store
+        print(f"{path} is stale, re-encoding candidates")
+    ctx_encoder.eval()
+    embeddings = []
+    with torch.no_grad():
+        for start in tqdm(range(0, len(candidates), batch_size), desc="Encoding candidates"):
+            inputs = ctx_tokenizer(candidates[start:start + batch_size], return_tensors="pt", padding=True, truncation=True, max_length=max_length)
+            inputs = {k: v.to(ctx_encoder.device) for k, v in inputs.items()}
+            embeddings.append(ctx_encoder(**inputs).pooler_output.float().cpu())
+    save_embedding_store(path, torch.cat(embeddings), candidates, encoder_hash, dtype=dtype)
+    return open_embedding_store(path)
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+"""Fast model loading (meta-device init + memory-mapped safetensors) shared by Steps 2, 3 and 4 (Version 3).
+
+Copy this file next to the notebooks' code folder (Config.CODE_PATH) so each step imports the same implementation.
+"""
+
+import os
+import time
+
+import torch
+
+# Seconds spent loading each model directory in this process, keyed on the directory name
+model_load_seconds = {}
+
+# Load a saved model directory: transformers builds the modules on the meta device and reads each weight once from
+# the memory-mapped safetensors file straight onto the target device. A legacy state_dict .pt is converted once.
+def load_pretrained_fast(model_cls, model_dir: str, legacy_pt_path: str = None, base_model_name: str = None, device=None):
+    if device is None:
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    if not os.path.isdir(model_dir) and legacy_pt_path and os.path.exists(legacy_pt_path):
+        print(f"Converting legacy weights {legacy_pt_path} to {model_dir}")
+        model = model_cls.from_pretrained(base_model_name, low_cpu_mem_usage=True)
+        model.load_state_dict(torch.load(legacy_pt_path, map_location="cpu", mmap=True))
+        model.save_pretrained(model_dir, safe_serialization=True)
+        del model
+    start = time.perf_counter()
+    model = model_cls.from_pretrained(model_dir, low_cpu_mem_usage=True, use_safetensors=True, device_map={"": str(device)})
+    model_load_seconds[os.path.basename(model_dir)] = time.perf_counter() - start
+    print(f"Loaded {os.path.basename(model_dir)} in {model_load_seconds[os.path.basename(model_dir)]:.2f}s")
+    return model
+
+# Print per-model and total load time for this stage
+def report_model_load_times():
+    for name, seconds in model_load_seconds.items():
+        print(f"  {name}: {seconds:.2f}s")
+    print(f"Total model load time: {sum(model_load_seconds.values()):.2f}s")
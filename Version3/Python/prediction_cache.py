@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""Persistent prediction cache shared by Steps 2, 3 and 4 (Version 3).
+
+Copy this file next to the notebooks' code folder (Config.CODE_PATH) so each step imports the same implementation.
+"""
+
+import hashlib
+import json
+import os
+import weakref
+
+import numpy as np
+import torch
+
+# Feed one state_dict value into a hasher (int8 Linear layers store packed (weight, bias) tuples and dtypes)
+def update_fingerprint(hasher, value):
+    if isinstance(value, (tuple, list)):
+        for item in value:
+            update_fingerprint(hasher, item)
+    elif isinstance(value, torch.Tensor):
+        tensor = value.detach().cpu()
+        if tensor.is_quantized:
+            tensor = tensor.dequantize()
+        hasher.update(tensor.contiguous().numpy().tobytes())
+    elif value is not None:
+        hasher.update(str(value).encode("utf-8"))
+
+# Fingerprints per live model object, with the version counters of its tensors when it was hashed. In-place
+# updates (optimizer steps, load_state_dict) bump the counters, so a trained model is re-hashed and a frozen one
+# is hashed once however many caches are opened for it.
+model_fingerprints = weakref.WeakKeyDictionary()
+
+def state_versions(state: dict) -> tuple:
+    return tuple(value._version for value in state.values() if isinstance(value, torch.Tensor))
+
+# Hash model weights so cached predictions are tied to one exact checkpoint
+def model_fingerprint(model) -> str:
+    state = model.state_dict()
+    versions = state_versions(state)
+    cached = model_fingerprints.get(model)
+    if cached is not None and cached[0] == versions:
+        return cached[1]
+    hasher = hashlib.sha256()
+    for name, value in sorted(state.items()):
+        hasher.update(name.encode("utf-8"))
+        update_fingerprint(hasher, value)
+    model_fingerprints[model] = (versions, hasher.hexdigest())
+    return model_fingerprints[model][1]
+
+# Hash a JSON-serialisable config (decoding settings, candidate pool, tokenizer, ...)
+def config_fingerprint(config: dict) -> str:
+    return hashlib.sha256(json.dumps(config, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+# Key a single example by its unpadded input ids
+def input_fingerprint(input_ids: torch.Tensor, attention_mask: torch.Tensor) -> str:
+    ids = input_ids[attention_mask.bool()].cpu().numpy().astype(np.int64)
+    return hashlib.sha256(ids.tobytes()).hexdigest()
+
+# Prediction cache: one append-only JSONL file per (model fingerprint, config) namespace
+class PredictionCache:
+    def __init__(self, cache_dir: str, model_hash: str, config: dict):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.namespace = f"{model_hash[:16]}_{config_fingerprint(config)[:16]}"
+        self.path = os.path.join(cache_dir, f"{self.namespace}.jsonl")
+        self.records = {}
+        self.hits, self.misses = 0, 0
+        with open(os.path.join(cache_dir, f"{self.namespace}.json"), "w") as f:
+            json.dump({"model_hash": model_hash, "config": config}, f, default=str)
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # Skip a partially written line from an interrupted run
+                    self.records[entry["key"]] = entry["value"]
+        print(f"Prediction cache {self.namespace}: {len(self.records)} cached records")
+
+    def get(self, key: str):
+        value = self.records.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def put_many(self, records: dict):
+        self.records.update(records)
+        with open(self.path, "a") as f:
+            for key, value in records.items():
+                f.write(json.dumps({"key": key, "value": value}) + "\n")
+
+# Open the generation cache for a BART model and decoding config
+def open_generation_cache(model, generation_config: dict, cache_dir: str, tokenizer_name: str, max_length: int) -> PredictionCache:
+    config = {"kind": "bart_generate", "tokenizer": tokenizer_name, "max_length": max_length, **generation_config}
+    return PredictionCache(cache_dir, model_fingerprint(model), config)
+
+# Open the ranking cache for a DPR question encoder, context encoder and candidate pool
+def open_ranking_cache(ctx_encoder, question_encoder, candidates: list, cache_dir: str, max_length: int) -> PredictionCache:
+    config = {
+        "kind": "dpr_rank",
+        "ctx_encoder": model_fingerprint(ctx_encoder),
+        "candidates": config_fingerprint(list(candidates)),
+        "max_length": max_length
+    }
+    return PredictionCache(cache_dir, model_fingerprint(question_encoder), config)
+
+# Generate with BART, running generate() only on cache misses.
+# With rollout_fn, generate() also returns attentions and rollout_fn(outputs, input_ids, attention_mask, num_beams)
+# reduces them to one explanation per sequence; it is stored in the cache record with the prediction, cached
+# answers without one are regenerated once, and (texts, rollouts) is returned instead of texts.
+def cached_generate(model, tokenizer, input_ids, attention_mask, generation_config: dict, cache: PredictionCache = None,
+                    rollout_fn=None):
+    keys = [input_fingerprint(ids, mask) for ids, mask in zip(input_ids, attention_mask)] if cache else []
+    generated_texts = [None] * input_ids.size(0)
+    rollouts = [None] * input_ids.size(0)
+    miss_idx = []
+    for i in range(input_ids.size(0)):
+        record = cache.get(keys[i]) if cache else None
+        if record is None or (rollout_fn is not None and "attention_rollout" not in record):
+            miss_idx.append(i)
+        else:
+            generated_texts[i] = record["generated"]
+            rollouts[i] = record.get("attention_rollout")
+    if miss_idx:
+        miss = torch.tensor(miss_idx, device=input_ids.device)
+        outputs = model.generate(
+            input_ids=input_ids[miss],
+            attention_mask=attention_mask[miss],
+            return_dict_in_generate=True,
+            output_scores=True,
+            output_attentions=rollout_fn is not None,
+            **generation_config
+        )
+        sequence_scores = getattr(outputs, "sequences_scores", None)
+        if rollout_fn is not None:
+            new_rollouts = rollout_fn(outputs, input_ids[miss], attention_mask[miss], generation_config.get("num_beams", 1))
+        new_records = {}
+        for j, (i, g_ids) in enumerate(zip(miss_idx, outputs.sequences)):
+            generated_texts[i] = tokenizer.decode(g_ids, skip_special_tokens=True)
+            if rollout_fn is not None:
+                rollouts[i] = new_rollouts[j]
+            if cache:
+                score = sequence_scores[j].item() if sequence_scores is not None else None
+                new_records[keys[i]] = {"generated": generated_texts[i], "score": score}
+                if rollout_fn is not None:
+                    new_records[keys[i]]["attention_rollout"] = rollouts[i]
+        if cache:
+            cache.put_many(new_records)
+        del outputs
+    if rollout_fn is not None:
+        return generated_texts, rollouts
+    return generated_texts
+
+# Rank the candidate pool for a batch of DPR questions, encoding only cache misses.
+# candidate_embeddings_fn is called lazily so a fully cached run never encodes the pool.
+def cached_dpr_rankings(question_encoder, input_ids, attention_mask, candidate_embeddings_fn, cache: PredictionCache = None,
+                        top_scores: int = 100):
+    keys = [input_fingerprint(ids, mask) for ids, mask in zip(input_ids, attention_mask)] if cache else []
+    rankings = [None] * input_ids.size(0)
+    miss_idx = []
+    for i in range(input_ids.size(0)):
+        record = cache.get(keys[i]) if cache else None
+        if record is None:
+            miss_idx.append(i)
+        else:
+            rankings[i] = torch.tensor(record["ranking"], device=input_ids.device)
+    if miss_idx:
+        miss = torch.tensor(miss_idx, device=input_ids.device)
+        question_embeddings = question_encoder(input_ids=input_ids[miss], attention_mask=attention_mask[miss]).pooler_output
+        similarities = torch.matmul(question_embeddings, candidate_embeddings_fn().T)
+        sorted_scores, sorted_ids = torch.sort(similarities, dim=1, descending=True)
+        new_records = {}
+        for j, i in enumerate(miss_idx):
+            rankings[i] = sorted_ids[j]
+            if cache:
+                new_records[keys[i]] = {
+                    "ranking": sorted_ids[j].cpu().tolist(),
+                    "scores": sorted_scores[j, :top_scores].float().cpu().tolist()
+                }
+        if cache:
+            cache.put_many(new_records)
+        del question_embeddings, similarities, sorted_scores
+    return torch.stack(rankings)
@@ -742,7 +742,7 @@ def combine_qa_datasets(squad_train_df: pd.DataFrame, hotpotqa_train_df: pd.Data
 
     qa_val_df = squad_val_df[["question", "context", "answer"]]
 
-    triple_train_df = wikidata_df[["question", "context", "answer"]]
+    triple_train_df = wikidata_df[["question", "context", "answer", "predicate"]]  # predicate stratifies Step 4's budgeted evaluation
 
     qa_train_path = os.path.join(CONFIG.BASE_PATH, "qa_train_v4.csv")
     qa_val_path = os.path.join(CONFIG.BASE_PATH, "qa_val_v4.csv")
@@ -18,6 +18,7 @@ Original file is located at
 !pip install huggingface-hub==0.25.2
 !pip install nltk==3.8.1 rouge-score==0.1.2 bert-score==0.3.13 -q
 !pip install tqdm==4.66.5 -q
+!pip install accelerate==0.30.1 safetensors==0.4.3 -q
 
 # Setup and Imports
 
@@ -30,7 +31,8 @@ from transformers import (
     DPRContextEncoder, DPRQuestionEncoder,
     DPRContextEncoderTokenizer, DPRQuestionEncoderTokenizer
 )
-from sentence_transformers import SentenceTransformer
+from sentence_transformers import InputExample
+from sentence_transformers.cross_encoder import CrossEncoder
 from sklearn.model_selection import train_test_split
 import os
 from google.colab import drive
@@ -44,6 +46,8 @@ import torch.optim as optim
 import string
 import nltk
 import json
+import sys
+import time
 
 nltk.download('wordnet')
 nltk.download('punkt')
@@ -54,6 +58,7 @@ drive.mount('/content/drive')
 # Configuration (aligned with Steps 1 and 2)
 class Config:
     BASE_PATH = "/content/drive/MyDrive/LJMU-Datasets"
+    CODE_PATH = os.path.join(BASE_PATH, "code_v4")  # Folder holding the shared Version3/Python modules (prediction_cache.py, embedding_store.py, artifact_manifest.py, model_loading.py)
     DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     BART_MODEL_NAME = "facebook/bart-base"
     DPR_CTX_MODEL_NAME = "facebook/dpr-ctx_encoder-single-nq-base"
@@ -65,6 +70,21 @@ class Config:
     SUBSET_SIZE = 500
     HOTPOTQA_MAX_SAMPLES = 1000
     WIKIDATA_SUBSET_SIZE = 30000
+    USE_PREDICTION_CACHE = True
+    PREDICTION_CACHE_DIR = os.path.join(BASE_PATH, "prediction_cache_v4")
+    PREDICTION_CACHE_TOP_SCORES = 100  # Number of top DPR scores stored per question
+    SENTENCE_TRANSFORMER_NAME = "all-MiniLM-L6-v2"
+    EMBEDDING_STORE_DTYPE = "float16"  # "float16" or "int8" (per-row scale) for candidate embedding stores
+    CROSS_ENCODER_MODEL_NAME = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+    CROSS_ENCODER_MAX_LENGTH = 64
+    CROSS_ENCODER_BATCH_SIZE = 64
+    CROSS_ENCODER_TRAIN_QUESTIONS = 5000  # Questions sampled for re-ranker fine-tuning
+    CROSS_ENCODER_NEGATIVES = 3  # DPR hard negatives per training question
+    CROSS_ENCODER_EPOCHS = 1
+    RETRIEVE_TOP_K = 30  # Stage 1: candidates DPR pulls from the store per question
+    RERANK_TOP_K = 10  # Stage 2: head of the DPR list scored by the cross-encoder
+    RERANK_SKIP_MARGIN = None  # Skip stage 2 when DPR's top-1 leads top-2 by at least this score (None = always re-rank)
+    RERANK_SCORE_WINDOW = None  # Only re-rank candidates within this DPR score of the top-1 (None = whole budget)
 
 CONFIG = Config()
 print(f"Using device: {CONFIG.DEVICE}")
@@ -212,6 +232,13 @@ def bart_generation_loss(outputs, labels, references, tokenizer, ignore_index: i
 
 print("Helper functions defined.")
 
+# Shared prediction cache, model fingerprints, candidate embedding store, artifact manifest and model loading (Version3/Python, copied to CONFIG.CODE_PATH)
+sys.path.insert(0, CONFIG.CODE_PATH)
+from prediction_cache import model_fingerprint, open_generation_cache, open_ranking_cache, cached_generate, cached_dpr_rankings
+from embedding_store import save_embedding_store, build_candidate_store
+from artifact_manifest import load_artifact_manifest, load_manifest_candidates, build_manifest_loaders, write_artifact_manifest
+from model_loading import load_pretrained_fast, report_model_load_times
+
 # Fine-Tune BART for QA Retrieval with A100 Optimizations
 
 def fine_tune_bart_qa(train_loader, val_loader, epochs: int = CONFIG.MAX_EPOCHS, checkpoint_path: str = None):
@@ -487,8 +514,6 @@ except Exception as e:
 
 # Save Artifacts to Google Drive
 
-import pickle
-
 # Mount Google Drive
 drive.mount('/content/drive')
 
@@ -496,45 +521,29 @@ drive.mount('/content/drive')
 save_path = '/content/drive/MyDrive/bert_retrieval_artifacts_v4'
 os.makedirs(save_path, exist_ok=True)
 
-# Load sentence transformer
-sentence_transformer = SentenceTransformer('all-MiniLM-L6-v2')
-
-# Save DataLoaders (Version 4)
-with open(os.path.join(save_path, 'qa_train_loader_v4.pkl'), 'wb') as f:
-    pickle.dump(qa_train_loader_v4, f)
-with open(os.path.join(save_path, 'qa_val_loader_v4.pkl'), 'wb') as f:
-    pickle.dump(qa_val_loader_v4, f)
-with open(os.path.join(save_path, 'triple_train_loader_v4.pkl'), 'wb') as f:
-    pickle.dump(triple_train_loader_v4, f)
-with open(os.path.join(save_path, 'triple_val_loader_v4.pkl'), 'wb') as f:
-    pickle.dump(triple_val_loader_v4, f)
-
-# Save triple_candidates
-with open(os.path.join(save_path, 'triple_candidates_v4.pkl'), 'wb') as f:
-    pickle.dump(triple_candidates_v4, f)
-
-# Save BART models
-torch.save(bart_qa_model.state_dict(), os.path.join(save_path, 'bart_qa_v4.pt'))
-torch.save(bart_triple_model.state_dict(), os.path.join(save_path, 'bart_triple_v4.pt'))
-
-# Save sentence_transformer
-with open(os.path.join(save_path, 'sentence_transformer_v4.pkl'), 'wb') as f:
-    pickle.dump(sentence_transformer, f)
-
-# Compute all_candidates directly from DataLoaders
-all_candidates = []
-for batch in qa_train_loader_v4:
-    all_candidates.extend(batch["answer"])
-for batch in qa_val_loader_v4:
-    all_candidates.extend(batch["answer"])
-all_candidates.extend(triple_candidates_v4)
-all_candidates = list(set(all_candidates))[:5000]
+# Save BART models (safetensors directories, loaded with load_pretrained_fast in Steps 3 and 4)
+bart_qa_model.save_pretrained(os.path.join(save_path, 'bart_qa_v4'), safe_serialization=True)
+bart_triple_model.save_pretrained(os.path.join(save_path, 'bart_triple_v4'), safe_serialization=True)
 
-# Save all_candidates
-with open(os.path.join(save_path, 'all_candidates_v4.pkl'), 'wb') as f:
-    pickle.dump(all_candidates, f)
+# Compute all_candidates directly from the split DataFrames
+all_candidates = qa_train_df_v4["answer"].tolist() + qa_val_df_v4["answer"].tolist() + triple_candidates_v4
+all_candidates = list(set(all_candidates))[:5000]
 
-print("Artifacts saved to Google Drive for Version 4!")
+# Save split row ids, pre-tokenized arrays and candidates (Version 4)
+manifest_dir = os.path.join(save_path, "manifest_v4")
+artifact_manifest = write_artifact_manifest(manifest_dir, {
+    "qa_train": (qa_train_df_v4, "qa", qa_train_path_v4),
+    "qa_val": (qa_val_df_v4, "qa", qa_val_path_v4),
+    "triple_train": (triple_train_df_v4, "triple", triple_train_path_v4),
+    "triple_val": (triple_val_df_v4, "triple", triple_train_path_v4)
+}, all_candidates, triple_candidates_v4, bart_tokenizer, dpr_question_tokenizer, CONFIG.MAX_LENGTH, {
+    "bart": CONFIG.BART_MODEL_NAME,
+    "dpr_ctx": CONFIG.DPR_CTX_MODEL_NAME,
+    "dpr_question": CONFIG.DPR_QUESTION_MODEL_NAME,
+    "sentence_transformer": CONFIG.SENTENCE_TRANSFORMER_NAME
+})
+
+print(f"Artifacts saved to Google Drive for Version 4! Manifest: {manifest_dir}")
 
 # Fine-Tune DPR for Discriminative Retrieval on QA Task
 
@@ -547,15 +556,11 @@ gc.collect()
 # Load artifacts
 save_path = '/content/drive/MyDrive/bert_retrieval_artifacts_v4'
 
-# Load DataLoaders
-with open(os.path.join(save_path, 'qa_train_loader_v4.pkl'), 'rb') as f:
-    qa_train_loader_v4 = pickle.load(f)
-with open(os.path.join(save_path, 'qa_val_loader_v4.pkl'), 'rb') as f:
-    qa_val_loader_v4 = pickle.load(f)
-
-# Load all_candidates
-with open(os.path.join(save_path, 'all_candidates_v4.pkl'), 'rb') as f:
-    all_candidates = pickle.load(f)
+# Rebuild DataLoaders and load all_candidates from the artifact manifest
+artifact_manifest = load_artifact_manifest(os.path.join(save_path, "manifest_v4"))
+loaders = build_manifest_loaders(artifact_manifest, CONFIG.BATCH_SIZE, CONFIG.NUM_WORKERS, ["qa_train", "qa_val"])
+qa_train_loader_v4, qa_val_loader_v4 = loaders["qa_train"], loaders["qa_val"]
+all_candidates = load_manifest_candidates(artifact_manifest)
 
 # Load DPR models and tokenizers
 ctx_encoder = DPRContextEncoder.from_pretrained(CONFIG.DPR_CTX_MODEL_NAME).to(CONFIG.DEVICE)
@@ -569,7 +574,8 @@ candidate_inputs = ctx_tokenizer(all_candidates, return_tensors="pt", padding=Tr
 candidate_inputs = {k: v.to(CONFIG.DEVICE) for k, v in candidate_inputs.items()}
 with torch.no_grad():
     candidate_embeddings = ctx_encoder(**candidate_inputs).pooler_output
-torch.save(candidate_embeddings, os.path.join(save_path, 'dpr_candidate_embeddings_v4.pt'))
+save_embedding_store(os.path.join(save_path, 'dpr_candidate_embeddings_v4.emb'), candidate_embeddings, all_candidates, model_fingerprint(ctx_encoder),
+                     dtype=CONFIG.EMBEDDING_STORE_DTYPE)
 
 # Fine-tune DPR
 optimizer = torch.optim.AdamW(list(ctx_encoder.parameters()) + list(question_encoder.parameters()), lr=2e-5)
@@ -616,16 +622,25 @@ for epoch in range(epochs):
     print(f"Epoch {epoch+1}/{epochs} - Train Loss: {avg_loss:.4f}")
 
 # Evaluate DPR
-def evaluate_dpr(ctx_encoder, question_encoder, val_loader, candidates, small_candidate_pool: bool = False):
+def evaluate_dpr(ctx_encoder, question_encoder, val_loader, candidates, small_candidate_pool: bool = False,
+                 use_cache: bool = CONFIG.USE_PREDICTION_CACHE):
     ctx_encoder.eval()
     question_encoder.eval()
     mrr, precision_at_1 = [], []
     eval_candidates = candidates[:100] if small_candidate_pool else candidates
     print(f"Using candidate pool size: {len(eval_candidates)}")
-    candidate_inputs = ctx_tokenizer(eval_candidates, return_tensors="pt", padding=True, truncation=True, max_length=CONFIG.MAX_LENGTH)
-    candidate_inputs = {k: v.to(CONFIG.DEVICE) for k, v in candidate_inputs.items()}
-    with torch.no_grad():
-        candidate_embeddings = ctx_encoder(**candidate_inputs).pooler_output
+    cache = open_ranking_cache(ctx_encoder, question_encoder, eval_candidates, CONFIG.PREDICTION_CACHE_DIR, CONFIG.MAX_LENGTH) if use_cache else None
+    candidate_embeddings = None
+
+    # Encode the candidate pool only if at least one question misses the cache
+    def get_candidate_embeddings():
+        nonlocal candidate_embeddings
+        if candidate_embeddings is None:
+            candidate_inputs = ctx_tokenizer(eval_candidates, return_tensors="pt", padding=True, truncation=True, max_length=CONFIG.MAX_LENGTH)
+            candidate_inputs = {k: v.to(CONFIG.DEVICE) for k, v in candidate_inputs.items()}
+            candidate_embeddings = ctx_encoder(**candidate_inputs).pooler_output
+        return candidate_embeddings
+
     with torch.no_grad():
         for batch in tqdm(val_loader, desc="Evaluating"):
             question_inputs = {
@@ -633,9 +648,8 @@ def evaluate_dpr(ctx_encoder, question_encoder, val_loader, candidates, small_ca
                 "attention_mask": batch["dpr_attention_mask"].to(CONFIG.DEVICE)
             }
             references = batch["answer"]
-            question_embeddings = question_encoder(**question_inputs).pooler_output
-            similarities = torch.matmul(question_embeddings, candidate_embeddings.T)
-            rankings = torch.argsort(similarities, dim=1, descending=True)
+            rankings = cached_dpr_rankings(question_encoder, question_inputs["input_ids"], question_inputs["attention_mask"],
+                                           get_candidate_embeddings, cache, top_scores=CONFIG.PREDICTION_CACHE_TOP_SCORES)
             for i, (ranking, ref) in enumerate(zip(rankings, references)):
                 ref_idx = eval_candidates.index(ref) if ref in eval_candidates else -1
                 if ref_idx == -1:
@@ -643,8 +657,10 @@ def evaluate_dpr(ctx_encoder, question_encoder, val_loader, candidates, small_ca
                 rank = (ranking == ref_idx).nonzero(as_tuple=True)[0].item() + 1 if ref_idx in ranking else len(eval_candidates)
                 mrr.append(1.0 / rank)
                 precision_at_1.append(1.0 if rank == 1 else 0.0)
-            del question_inputs, similarities, rankings
+            del question_inputs, rankings
             torch.cuda.empty_cache()
+    if cache:
+        print(f"Prediction cache: {cache.hits} hits, {cache.misses} misses")
     avg_mrr = np.mean(mrr)
     avg_precision_at_1 = np.mean(precision_at_1)
     print("DPR Evaluation:")
@@ -667,15 +683,10 @@ print("Saved DPR models for QA task.")
 torch.cuda.empty_cache()
 gc.collect()
 
-# Load DataLoaders (Version 4)
-with open(os.path.join(save_path, 'triple_train_loader_v4.pkl'), 'rb') as f:
-    triple_train_loader_v4 = pickle.load(f)
-with open(os.path.join(save_path, 'triple_val_loader_v4.pkl'), 'rb') as f:
-    triple_val_loader_v4 = pickle.load(f)
-
-# Load all_candidates
-with open(os.path.join(save_path, 'all_candidates_v4.pkl'), 'rb') as f:
-    all_candidates = pickle.load(f)
+# Rebuild DataLoaders and load all_candidates from the artifact manifest (Version 4)
+loaders = build_manifest_loaders(artifact_manifest, CONFIG.BATCH_SIZE, CONFIG.NUM_WORKERS, ["triple_train", "triple_val"])
+triple_train_loader_v4, triple_val_loader_v4 = loaders["triple_train"], loaders["triple_val"]
+all_candidates = load_manifest_candidates(artifact_manifest)
 
 # Load DPR models and tokenizers (start fresh to avoid overfitting from QA fine-tuning)
 ctx_encoder = DPRContextEncoder.from_pretrained(CONFIG.DPR_CTX_MODEL_NAME).to(CONFIG.DEVICE)
@@ -689,7 +700,8 @@ candidate_inputs = ctx_tokenizer(all_candidates, return_tensors="pt", padding=Tr
 candidate_inputs = {k: v.to(CONFIG.DEVICE) for k, v in candidate_inputs.items()}
 with torch.no_grad():
     candidate_embeddings = ctx_encoder(**candidate_inputs).pooler_output
-torch.save(candidate_embeddings, os.path.join(save_path, 'dpr_candidate_embeddings_triple_v4.pt'))
+save_embedding_store(os.path.join(save_path, 'dpr_candidate_embeddings_triple_v4.emb'), candidate_embeddings, all_candidates, model_fingerprint(ctx_encoder),
+                     dtype=CONFIG.EMBEDDING_STORE_DTYPE)
 
 # Fine-tune DPR on triple task
 optimizer = torch.optim.AdamW(list(ctx_encoder.parameters()) + list(question_encoder.parameters()), lr=2e-5)
@@ -753,35 +765,36 @@ gc.collect()
 # Load artifacts
 save_path = '/content/drive/MyDrive/bert_retrieval_artifacts_v4'
 
-# Load DataLoaders
-with open(os.path.join(save_path, 'qa_val_loader_v4.pkl'), 'rb') as f:
-    qa_val_loader_v4 = pickle.load(f)
-with open(os.path.join(save_path, 'triple_val_loader_v4.pkl'), 'rb') as f:
-    triple_val_loader_v4 = pickle.load(f)
-
-# Load all_candidates
-with open(os.path.join(save_path, 'all_candidates_v4.pkl'), 'rb') as f:
-    all_candidates = pickle.load(f)
+# Rebuild DataLoaders and load all_candidates from the artifact manifest
+artifact_manifest = load_artifact_manifest(os.path.join(save_path, "manifest_v4"))
+loaders = build_manifest_loaders(artifact_manifest, CONFIG.BATCH_SIZE, CONFIG.NUM_WORKERS, ["qa_val", "triple_val"])
+qa_val_loader_v4, triple_val_loader_v4 = loaders["qa_val"], loaders["triple_val"]
+all_candidates = load_manifest_candidates(artifact_manifest)
 
 # Load DPR models and tokenizers for QA task
-ctx_encoder_qa = DPRContextEncoder.from_pretrained(os.path.join(CONFIG.BASE_PATH, "dpr_ctx_encoder_qa_v4")).to(CONFIG.DEVICE)
-question_encoder_qa = DPRQuestionEncoder.from_pretrained(os.path.join(CONFIG.BASE_PATH, "dpr_question_encoder_qa_v4")).to(CONFIG.DEVICE)
+ctx_encoder_qa = load_pretrained_fast(DPRContextEncoder, os.path.join(CONFIG.BASE_PATH, "dpr_ctx_encoder_qa_v4"), device=CONFIG.DEVICE)
+question_encoder_qa = load_pretrained_fast(DPRQuestionEncoder, os.path.join(CONFIG.BASE_PATH, "dpr_question_encoder_qa_v4"), device=CONFIG.DEVICE)
 ctx_tokenizer = DPRContextEncoderTokenizer.from_pretrained(CONFIG.DPR_CTX_MODEL_NAME)
 question_tokenizer = DPRQuestionEncoderTokenizer.from_pretrained(CONFIG.DPR_QUESTION_MODEL_NAME)
-candidate_embeddings_qa = torch.load(os.path.join(save_path, 'dpr_candidate_embeddings_v4.pt')).to(CONFIG.DEVICE)
+candidate_store_qa = build_candidate_store(ctx_encoder_qa, ctx_tokenizer, all_candidates, os.path.join(save_path, 'dpr_candidate_embeddings_ft_qa_v4.emb'),
+                                           CONFIG.MAX_LENGTH, dtype=CONFIG.EMBEDDING_STORE_DTYPE)
 
 # Load DPR models and tokenizers for triple task
-ctx_encoder_triple = DPRContextEncoder.from_pretrained(os.path.join(CONFIG.BASE_PATH, "dpr_ctx_encoder_triple_v4")).to(CONFIG.DEVICE)
-question_encoder_triple = DPRQuestionEncoder.from_pretrained(os.path.join(CONFIG.BASE_PATH, "dpr_question_encoder_triple_v4")).to(CONFIG.DEVICE)
-candidate_embeddings_triple = torch.load(os.path.join(save_path, 'dpr_candidate_embeddings_triple_v4.pt')).to(CONFIG.DEVICE)
+ctx_encoder_triple = load_pretrained_fast(DPRContextEncoder, os.path.join(CONFIG.BASE_PATH, "dpr_ctx_encoder_triple_v4"), device=CONFIG.DEVICE)
+question_encoder_triple = load_pretrained_fast(DPRQuestionEncoder, os.path.join(CONFIG.BASE_PATH, "dpr_question_encoder_triple_v4"), device=CONFIG.DEVICE)
+report_model_load_times()
+candidate_store_triple = build_candidate_store(ctx_encoder_triple, ctx_tokenizer, all_candidates, os.path.join(save_path, 'dpr_candidate_embeddings_ft_triple_v4.emb'),
+                                               CONFIG.MAX_LENGTH, dtype=CONFIG.EMBEDDING_STORE_DTYPE)
 
 # Evaluate BART on QA and triple tasks
-def evaluate_bart(model, val_loader, task: str = "qa"):
+def evaluate_bart(model, val_loader, task: str = "qa", use_cache: bool = CONFIG.USE_PREDICTION_CACHE):
     print(f"Evaluating BART for {task}...")
     model.eval()
     bleu_scores, rouge_scores, bert_scores = [], [], []
     sample_outputs = []
     scorer = rouge_scorer.RougeScorer(['rougeL'], use_stemmer=True)
+    generation_config = {"max_new_tokens": 100, "num_beams": 20, "temperature": 0.5, "no_repeat_ngram_size": 2}
+    cache = open_generation_cache(model, generation_config, CONFIG.PREDICTION_CACHE_DIR, CONFIG.BART_MODEL_NAME, CONFIG.MAX_LENGTH) if use_cache else None
 
     with torch.no_grad():
         # Limit the number of steps for evaluation
@@ -792,15 +805,7 @@ def evaluate_bart(model, val_loader, task: str = "qa"):
             input_ids = batch["bart_input_ids"].to(CONFIG.DEVICE)
             attention_mask = batch["bart_attention_mask"].to(CONFIG.DEVICE)
             references = batch["answer"]
-            generated_ids = model.generate(
-                input_ids=input_ids,
-                attention_mask=attention_mask,
-                max_new_tokens=100,
-                num_beams=20,
-                temperature=0.5,
-                no_repeat_ngram_size=2
-            )
-            generated_texts = [bart_tokenizer.decode(g_ids, skip_special_tokens=True) for g_ids in generated_ids]
+            generated_texts = cached_generate(model, bart_tokenizer, input_ids, attention_mask, generation_config, cache)
             for gen, ref in zip(generated_texts, references):
                 gen = normalize_text(gen)
                 ref = normalize_text(ref)
@@ -811,8 +816,10 @@ def evaluate_bart(model, val_loader, task: str = "qa"):
                 rouge_scores.append(rouge)
                 bert_scores.append(bert_f1)
                 sample_outputs.append((gen, ref))
-            del input_ids, attention_mask, generated_ids
+            del input_ids, attention_mask
             torch.cuda.empty_cache()
+    if cache:
+        print(f"Prediction cache: {cache.hits} hits, {cache.misses} misses")
     avg_bleu = np.mean(bleu_scores)
     avg_rouge = np.mean(rouge_scores)
     avg_bert = np.mean(bert_scores)
@@ -830,56 +837,145 @@ def evaluate_bart(model, val_loader, task: str = "qa"):
 bart_qa_bleu, bart_qa_rouge, bart_qa_bert = evaluate_bart(bart_qa_model, qa_val_loader_v4, task="qa")
 bart_triple_bleu, bart_triple_rouge, bart_triple_bert = evaluate_bart(bart_triple_model, triple_val_loader_v4, task="triple")
 
-# Redesign Ensemble: Use DPR to generate candidates, then re-rank
-def ensemble_evaluate_dpr(ctx_encoder, question_encoder, val_loader, candidates, top_k: int = 30):
-    print("Evaluating DPR-based ensemble (DPR for candidate selection)...")
-    ctx_encoder.eval()
+# Retrieve-then-Rerank Cascade (shared with Step 4)
+
+# Load the fine-tuned re-ranker for a task, falling back to the pretrained MS MARCO cross-encoder
+def load_cross_encoder(task: str = "qa") -> CrossEncoder:
+    path = os.path.join(CONFIG.BASE_PATH, f"cross_encoder_{task}_v4")
+    model_name = path if os.path.isdir(path) else CONFIG.CROSS_ENCODER_MODEL_NAME
+    return CrossEncoder(model_name, num_labels=1, max_length=CONFIG.CROSS_ENCODER_MAX_LENGTH, device=str(CONFIG.DEVICE))
+
+# Two-stage cascade for one batch: DPR pulls retrieve_top_k candidates from the store, then the cross-encoder
+# scores only the first rerank_top_k (question, candidate) pairs, fewer when an early cutoff applies.
+# Returns the DPR and cascade orders as (batch, retrieve_top_k) candidate ids, seconds per stage and pairs scored.
+def cascade_retrieve_rerank(question_encoder, cross_encoder, candidate_store, questions, input_ids, attention_mask,
+                            retrieve_top_k: int = CONFIG.RETRIEVE_TOP_K, rerank_top_k: int = CONFIG.RERANK_TOP_K,
+                            skip_margin: float = CONFIG.RERANK_SKIP_MARGIN, score_window: float = CONFIG.RERANK_SCORE_WINDOW):
+    stage_seconds = {}
+    start = time.perf_counter()
+    question_embeddings = question_encoder(input_ids=input_ids, attention_mask=attention_mask).pooler_output
+    top_scores, dpr_ids = torch.topk(candidate_store.scores(question_embeddings), k=min(retrieve_top_k, len(candidate_store)), dim=1)
+    top_scores, dpr_ids = top_scores.cpu(), dpr_ids.cpu()  # Copy to host also waits for the GPU
+    stage_seconds["retrieve"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    cascade_ids = dpr_ids.clone()
+    pairs, slots = [], []
+    for i, question in enumerate(questions):
+        if skip_margin is not None and top_scores.size(1) > 1 and top_scores[i, 0] - top_scores[i, 1] >= skip_margin:
+            continue
+        budget = min(rerank_top_k, dpr_ids.size(1))
+        if score_window is not None:
+            budget = int((top_scores[i, :budget] >= top_scores[i, 0] - score_window).sum())
+        if budget < 2:
+            continue
+        slots.append((i, budget, len(pairs)))
+        pairs.extend((question, candidate_store.candidates[idx]) for idx in dpr_ids[i, :budget].tolist())
+    if pairs:
+        pair_scores = torch.as_tensor(cross_encoder.predict(pairs, batch_size=CONFIG.CROSS_ENCODER_BATCH_SIZE, show_progress_bar=False))
+        for i, budget, offset in slots:
+            order = torch.argsort(pair_scores[offset:offset + budget], descending=True)
+            cascade_ids[i, :budget] = dpr_ids[i, :budget][order]
+    stage_seconds["rerank"] = time.perf_counter() - start
+    return dpr_ids, cascade_ids, stage_seconds, len(pairs)
+
+# 1-based rank of each reference in a row of candidate ids (0 when it was not retrieved)
+def reference_ranks(ranked_ids: torch.Tensor, references, candidates: list) -> list:
+    ranks = []
+    for row, ref in zip(ranked_ids.tolist(), references):
+        ranked = [candidates[idx] for idx in row]
+        ranks.append(ranked.index(ref) + 1 if ref in ranked else 0)
+    return ranks
+
+# Compare DPR and cascade orders over questions whose reference DPR retrieved, with per-stage latency
+def summarize_cascade(dpr_ranks: list, cascade_ranks: list, stage_seconds: dict, num_pairs: int, k_values=(1,), task: str = "qa") -> dict:
+    retrieved = [i for i, rank in enumerate(dpr_ranks) if rank > 0]
+    num_questions = max(len(dpr_ranks), 1)
+    report = {"recall_at_retrieve": len(retrieved) / num_questions, "pairs_per_question": num_pairs / num_questions}
+    for stage, seconds in stage_seconds.items():
+        report[f"{stage}_ms_per_question"] = 1000 * seconds / num_questions
+    for name, ranks in (("dpr", dpr_ranks), ("cascade", cascade_ranks)):
+        kept = np.array([ranks[i] for i in retrieved]) if retrieved else np.zeros(0)
+        for k in k_values:
+            report[f"{name}_mrr_at_{k}"] = float(np.mean(np.where(kept <= k, 1.0 / np.maximum(kept, 1), 0.0))) if kept.size else 0.0
+            report[f"{name}_hit_at_{k}"] = float(np.mean(kept <= k)) if kept.size else 0.0
+        report[f"{name}_precision_at_1"] = float(np.mean(kept == 1)) if kept.size else 0.0
+    print(f"Cascade Evaluation ({task}): DPR P@1 {report['dpr_precision_at_1']:.4f} -> cascade P@1 {report['cascade_precision_at_1']:.4f}")
+    for k in k_values:
+        print(f"MRR@{k}: DPR {report[f'dpr_mrr_at_{k}']:.4f}, cascade {report[f'cascade_mrr_at_{k}']:.4f}")
+    print(f"Recall@{CONFIG.RETRIEVE_TOP_K}: {report['recall_at_retrieve']:.4f}, pairs re-ranked per question: {report['pairs_per_question']:.1f}")
+    print(f"Latency per question: retrieve {report['retrieve_ms_per_question']:.2f} ms, rerank {report['rerank_ms_per_question']:.2f} ms")
+    return report
+
+print("Cascade helpers defined.")
+
+# Fine-Tune Cross-Encoder Re-Ranker on DPR Hard Negatives
+
+# Pair each training question with its answer (label 1) and the top DPR candidates that are not the answer (label 0)
+def mine_cross_encoder_examples(question_encoder, candidate_store, df: pd.DataFrame,
+                                num_questions: int = CONFIG.CROSS_ENCODER_TRAIN_QUESTIONS,
+                                num_negatives: int = CONFIG.CROSS_ENCODER_NEGATIVES, batch_size: int = 64) -> list:
+    sample_df = df.sample(n=min(num_questions, len(df)), random_state=42)
+    questions, answers = sample_df["question"].tolist(), sample_df["answer"].tolist()
     question_encoder.eval()
-    mrr, precision_at_1 = [], []
-    # Reduce candidate pool size
-    eval_candidates = candidates[:1000]  # Limit to 1000 candidates
-    candidate_inputs = ctx_tokenizer(eval_candidates, return_tensors="pt", padding=True, truncation=True, max_length=CONFIG.MAX_LENGTH)
-    candidate_inputs = {k: v.to(CONFIG.DEVICE) for k, v in candidate_inputs.items()}
+    examples = []
     with torch.no_grad():
-        candidate_embeddings = ctx_encoder(**candidate_inputs).pooler_output
+        for start in tqdm(range(0, len(questions), batch_size), desc="Mining hard negatives"):
+            batch_questions = questions[start:start + batch_size]
+            inputs = question_tokenizer(batch_questions, return_tensors="pt", padding=True, truncation=True, max_length=CONFIG.MAX_LENGTH)
+            inputs = {k: v.to(CONFIG.DEVICE) for k, v in inputs.items()}
+            question_embeddings = question_encoder(**inputs).pooler_output
+            top_ids = torch.topk(candidate_store.scores(question_embeddings), k=num_negatives + 1, dim=1).indices.cpu()
+            for question, answer, ids in zip(batch_questions, answers[start:start + batch_size], top_ids.tolist()):
+                examples.append(InputExample(texts=[question, answer], label=1.0))
+                negatives = [candidate_store.candidates[idx] for idx in ids if candidate_store.candidates[idx] != answer]
+                examples.extend(InputExample(texts=[question, negative], label=0.0) for negative in negatives[:num_negatives])
+    return examples
+
+# Fine-tune the pretrained cross-encoder on one task and save it where load_cross_encoder looks
+def fine_tune_cross_encoder(question_encoder, candidate_store, train_df: pd.DataFrame, task: str = "qa") -> CrossEncoder:
+    print(f"Fine-tuning cross-encoder for {task}...")
+    cross_encoder = CrossEncoder(CONFIG.CROSS_ENCODER_MODEL_NAME, num_labels=1, max_length=CONFIG.CROSS_ENCODER_MAX_LENGTH, device=str(CONFIG.DEVICE))
+    examples = mine_cross_encoder_examples(question_encoder, candidate_store, train_df)
+    train_loader = DataLoader(examples, shuffle=True, batch_size=CONFIG.CROSS_ENCODER_BATCH_SIZE)
+    cross_encoder.fit(train_dataloader=train_loader, epochs=CONFIG.CROSS_ENCODER_EPOCHS,
+                      warmup_steps=int(0.1 * len(train_loader)), show_progress_bar=True)
+    save_dir = os.path.join(CONFIG.BASE_PATH, f"cross_encoder_{task}_v4")
+    cross_encoder.save(save_dir)
+    print(f"Saved cross-encoder for {task} at {save_dir}")
+    return cross_encoder
+
+cross_encoder_qa = fine_tune_cross_encoder(question_encoder_qa, candidate_store_qa, qa_train_df_v4, task="qa")
+cross_encoder_triple = fine_tune_cross_encoder(question_encoder_triple, candidate_store_triple, triple_train_df_v4, task="triple")
+
+# Redesign Ensemble: DPR retrieves candidates from the store, then the cross-encoder re-ranks the head of the list
+def ensemble_evaluate_dpr(question_encoder, cross_encoder, candidate_store, val_loader, task: str = "qa"):
+    print(f"Evaluating DPR -> cross-encoder cascade for {task}...")
+    question_encoder.eval()
+    dpr_ranks, cascade_ranks = [], []
+    stage_seconds = {"retrieve": 0.0, "rerank": 0.0}
+    num_pairs = 0
     with torch.no_grad():
         # Limit the number of steps for evaluation
         max_steps = min(1000, len(val_loader))  # Cap at 1000 steps
         for step, batch in enumerate(tqdm(val_loader, desc="Ensemble Evaluating", total=max_steps)):
             if step >= max_steps:
                 break
-            question_inputs = {
-                "input_ids": batch["dpr_input_ids"].to(CONFIG.DEVICE),
-                "attention_mask": batch["dpr_attention_mask"].to(CONFIG.DEVICE)
-            }
-            references = batch["answer"]
-            question_embeddings = question_encoder(**question_inputs).pooler_output
-            similarities = torch.matmul(question_embeddings, candidate_embeddings.T)
-            rankings = torch.argsort(similarities, dim=1, descending=True)
-            top_k_indices = rankings[:, :top_k]  # Shape: (batch_size, top_k)
-            batch_size = top_k_indices.size(0)
-            for i in range(batch_size):
-                top_k_candidate_indices = top_k_indices[i].cpu().numpy()
-                top_k_candidates = [eval_candidates[idx] for idx in top_k_candidate_indices]
-                ref = references[i]
-                ref_idx = top_k_candidates.index(ref) if ref in top_k_candidates else -1
-                if ref_idx == -1:
-                    continue
-                rank = (top_k_indices[i] == top_k_candidate_indices[ref_idx]).nonzero(as_tuple=True)[0].item() + 1 if ref_idx >= 0 else len(top_k_candidates)
-                mrr.append(1.0 / rank)
-                precision_at_1.append(1.0 if rank == 1 else 0.0)
-            del question_inputs, similarities, rankings, top_k_indices
-            torch.cuda.empty_cache()
-    avg_mrr = np.mean(mrr) if mrr else 0.0
-    avg_precision_at_1 = np.mean(precision_at_1) if precision_at_1 else 0.0
-    print("DPR-based Ensemble Evaluation:")
-    print(f"MRR: {avg_mrr:.4f}")
-    print(f"Precision@1: {avg_precision_at_1:.4f}")
-    return avg_mrr, avg_precision_at_1
+            dpr_ids, cascade_ids, batch_seconds, batch_pairs = cascade_retrieve_rerank(
+                question_encoder, cross_encoder, candidate_store, batch["question"],
+                batch["dpr_input_ids"].to(CONFIG.DEVICE), batch["dpr_attention_mask"].to(CONFIG.DEVICE)
+            )
+            dpr_ranks.extend(reference_ranks(dpr_ids, batch["answer"], candidate_store.candidates))
+            cascade_ranks.extend(reference_ranks(cascade_ids, batch["answer"], candidate_store.candidates))
+            for stage, seconds in batch_seconds.items():
+                stage_seconds[stage] += seconds
+            num_pairs += batch_pairs
+    report = summarize_cascade(dpr_ranks, cascade_ranks, stage_seconds, num_pairs, k_values=[1, 5, 10, CONFIG.RETRIEVE_TOP_K], task=task)
+    return report[f"cascade_mrr_at_{CONFIG.RETRIEVE_TOP_K}"], report["cascade_precision_at_1"], report
 
 # Evaluate ensemble for QA and triple tasks
-ensemble_mrr_qa, ensemble_precision_qa = ensemble_evaluate_dpr(ctx_encoder_qa, question_encoder_qa, qa_val_loader_v4, all_candidates)
-ensemble_mrr_triple, ensemble_precision_triple = ensemble_evaluate_dpr(ctx_encoder_triple, question_encoder_triple, triple_val_loader_v4, all_candidates)
+ensemble_mrr_qa, ensemble_precision_qa, ensemble_report_qa = ensemble_evaluate_dpr(question_encoder_qa, cross_encoder_qa, candidate_store_qa, qa_val_loader_v4, task="qa")
+ensemble_mrr_triple, ensemble_precision_triple, ensemble_report_triple = ensemble_evaluate_dpr(question_encoder_triple, cross_encoder_triple, candidate_store_triple, triple_val_loader_v4, task="triple")
 
 # Save evaluation results
 results = {
@@ -889,8 +985,8 @@ results = {
     "dpr_small_pool_qa": {"mrr": dpr_mrr_small_qa, "precision_at_1": dpr_precision_small_qa},
     "dpr_full_triple": {"mrr": dpr_mrr_full_triple, "precision_at_1": dpr_precision_full_triple},
     "dpr_small_pool_triple": {"mrr": dpr_mrr_small_triple, "precision_at_1": dpr_precision_small_triple},
-    "ensemble_qa": {"mrr": ensemble_mrr_qa, "precision_at_1": ensemble_precision_qa},
-    "ensemble_triple": {"mrr": ensemble_mrr_triple, "precision_at_1": ensemble_precision_triple}
+    "ensemble_qa": {"mrr": ensemble_mrr_qa, "precision_at_1": ensemble_precision_qa, "cascade": ensemble_report_qa},
+    "ensemble_triple": {"mrr": ensemble_mrr_triple, "precision_at_1": ensemble_precision_triple, "cascade": ensemble_report_triple}
 }
 
 results_path = os.path.join(CONFIG.BASE_PATH, "step2_metrics_v4.json")
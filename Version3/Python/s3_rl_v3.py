@@ -18,13 +18,13 @@ Original file is located at
 !pip install huggingface-hub==0.25.2
 !pip install nltk==3.8.1 rouge-score==0.1.2 bert-score==0.3.13 -q
 !pip install tqdm==4.66.5 -q
+!pip install accelerate==0.30.1 safetensors==0.4.3 -q
 
 # Setup and Imports
 
 import pandas as pd
 import numpy as np
 import torch
-from torch.utils.data import Dataset, DataLoader
 from transformers import (
     BartForConditionalGeneration, BartTokenizer,
     DPRContextEncoder, DPRQuestionEncoder,
@@ -41,7 +41,12 @@ from bert_score import score as bert_score
 import string
 import nltk
 import json
+import sys
 import pickle
+from collections import OrderedDict
+import random
+import torch.multiprocessing as mp
+from safetensors.torch import save_file
 
 nltk.download('wordnet')
 nltk.download('punkt')
@@ -52,6 +57,7 @@ drive.mount('/content/drive')
 # Configuration
 class Config:
     BASE_PATH = "/content/drive/MyDrive/LJMU-Datasets"
+    CODE_PATH = os.path.join(BASE_PATH, "code_v4")  # Folder holding the shared Version3/Python modules (prediction_cache.py, embedding_store.py, artifact_manifest.py, model_loading.py)
     DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     BART_MODEL_NAME = "facebook/bart-base"
     DPR_CTX_MODEL_NAME = "facebook/dpr-ctx_encoder-single-nq-base"
@@ -63,6 +69,27 @@ class Config:
     SUBSET_SIZE = 500
     HOTPOTQA_MAX_SAMPLES = 1000
     WIKIDATA_SUBSET_SIZE = 30000
+    EMBEDDING_STORE_DTYPE = "float16"  # "float16" or "int8" (per-row scale) for candidate embedding stores
+    RL_NUM_ENVS = 64  # Questions stepped in parallel by VectorizedRankingEnvironment
+    REWARD_POOL_SIZE = 100  # compute_reward only credits references among the first REWARD_POOL_SIZE candidates
+    REWARD_CACHE_SIZE = 4096  # Reference embeddings kept by RewardService (least recently used evicted first)
+    PPO_CLIP_EPSILON = 0.1
+    PPO_EPOCHS = 5
+    PPO_MINIBATCH_SIZE = 256  # Transitions per PPO minibatch (an episode holds RL_NUM_ENVS x steps transitions)
+    PPO_GAMMA = 0.99
+    PPO_LAMBDA = 0.95
+    PPO_ACTION_STD = 0.1  # Std of the Gaussian over embedding adjustments
+    RL_PARALLEL_ROLLOUTS = True  # Collect episodes in forked CPU worker processes and train QA and triple together
+    RL_NUM_WORKERS = max(1, (os.cpu_count() or 2) // 4)  # Rollout worker processes per task
+    RL_TRAINING_MODE = "online"  # "online" (rollouts rank the full store) or "offline" (PPO over a logged top-k dataset)
+    OFFLINE_LOG_TOP_K = 200  # Candidates logged per question; offline rewards rank the reference among these
+    OFFLINE_EPOCHS = 50  # Passes over the logged questions in offline mode
+    RUN_PPO_SWEEP = False  # Tune PPO / reward parameters with run_ppo_sweep before the full RL run
+    SWEEP_NUM_TRIALS = 16
+    SWEEP_NUM_WORKERS = max(1, (os.cpu_count() or 2) // 2)  # Trial processes in the sweep pool
+    SWEEP_RUNG_EPISODES = 20  # Episodes each surviving trial trains between early-stopping decisions
+    SWEEP_NUM_RUNGS = 3
+    QUERY_ADAPTER_TRACE = True  # Also export question encoder + adapter as one TorchScript module
 
 CONFIG = Config()
 print(f"Using device: {CONFIG.DEVICE}")
@@ -70,128 +97,51 @@ print(f"Using device: {CONFIG.DEVICE}")
 # Clear GPU memory
 torch.cuda.empty_cache()
 
+# Shared model fingerprints, candidate embedding store, artifact manifest and model loading (Version3/Python, copied to CONFIG.CODE_PATH)
+sys.path.insert(0, CONFIG.CODE_PATH)
+from prediction_cache import model_fingerprint
+from embedding_store import open_embedding_store, verify_embedding_store, build_candidate_store
+from artifact_manifest import load_artifact_manifest, load_manifest_candidates, build_manifest_loaders
+from model_loading import load_pretrained_fast, report_model_load_times
+
 # Load Artifacts from Step 2 and Create DataLoaders
 
 import pickle
 
 save_path = '/content/drive/MyDrive/bert_retrieval_artifacts_v4'
 
-# Load raw datasets
-qa_train_path_v4 = os.path.join(CONFIG.BASE_PATH, "qa_train_v4.csv")
-qa_val_path_v4 = os.path.join(CONFIG.BASE_PATH, "qa_val_v4.csv")
-triple_train_path_v4 = os.path.join(CONFIG.BASE_PATH, "triple_train_v4.csv")
-
-qa_train_df_v4 = pd.read_csv(qa_train_path_v4)
-qa_val_df_v4 = pd.read_csv(qa_val_path_v4)
-triple_train_df_v4 = pd.read_csv(triple_train_path_v4)
-
-# Split triple_train_df into train and validation sets (80/20)
-triple_train_df_v4, triple_val_df_v4 = train_test_split(triple_train_df_v4, train_size=0.8, random_state=42)
-print(f"Triple Train Size (Version 4): {len(triple_train_df_v4)}, Triple Val Size (Version 4): {len(triple_val_df_v4)}")
-
-# Load all_candidates
-with open(os.path.join(save_path, 'all_candidates_v4.pkl'), 'rb') as f:
-    all_candidates = pickle.load(f)
-
-# Define RetrievalDataset class
-class RetrievalDataset(Dataset):
-    def __init__(self, df: pd.DataFrame, bart_tokenizer: BartTokenizer, dpr_question_tokenizer: DPRQuestionEncoderTokenizer,
-                 max_length: int = 256, task: str = "qa", candidate_objects: list = None):
-        self.bart_tokenizer = bart_tokenizer
-        self.dpr_question_tokenizer = dpr_question_tokenizer
-        self.max_length = max_length
-        self.task = task
-        self.data = df
-        self.candidate_objects = candidate_objects
-
-    def __len__(self):
-        return len(self.data)
-
-    def __getitem__(self, idx):
-        row = self.data.iloc[idx]
-        question = row["question"]
-        context = row["context"]
-        answer = row["answer"]
-
-        if self.task == "qa":
-            bart_input_text = f"question: {question} context: {context}"
-        else:
-            bart_input_text = f"complete the triple with the exact object: {question} context: {context}"
-        bart_inputs = self.bart_tokenizer(
-            bart_input_text,
-            return_tensors="pt",
-            max_length=self.max_length,
-            truncation=True,
-            padding="max_length"
-        )
-        bart_labels = self.bart_tokenizer(
-            answer,
-            return_tensors="pt",
-            max_length=self.max_length,
-            truncation=True,
-            padding="max_length"
-        )
-
-        dpr_inputs = self.dpr_question_tokenizer(
-            question,
-            return_tensors="pt",
-            max_length=self.max_length,
-            truncation=True,
-            padding="max_length"
-        )
-
-        item = {
-            "task": self.task,
-            "bart_input_ids": bart_inputs["input_ids"].squeeze().long(),  # Ensure LongTensor
-            "bart_attention_mask": bart_inputs["attention_mask"].squeeze().long(),
-            "bart_labels": bart_labels["input_ids"].squeeze().long(),
-            "dpr_input_ids": dpr_inputs["input_ids"].squeeze().long(),  # Ensure LongTensor
-            "dpr_attention_mask": dpr_inputs["attention_mask"].squeeze().long(),
-            "question": question,
-            "answer": answer
-        }
-
-        if self.task == "triple" and self.candidate_objects:
-            label_idx = self.candidate_objects.index(answer) if answer in self.candidate_objects else -1
-            item["label_idx"] = label_idx
+# Rebuild DataLoaders and load all_candidates from the manifest (same split rows and tokenization as Step 2)
+artifact_manifest = load_artifact_manifest(os.path.join(save_path, "manifest_v4"))
+loaders = build_manifest_loaders(artifact_manifest, CONFIG.BATCH_SIZE, CONFIG.NUM_WORKERS)
+qa_train_loader_v4, qa_val_loader_v4 = loaders["qa_train"], loaders["qa_val"]
+triple_train_loader_v4, triple_val_loader_v4 = loaders["triple_train"], loaders["triple_val"]
+all_candidates = load_manifest_candidates(artifact_manifest)
 
-        return item
-
-# Create DataLoaders from raw data
-bart_tokenizer = BartTokenizer.from_pretrained(CONFIG.BART_MODEL_NAME)
-dpr_question_tokenizer = DPRQuestionEncoderTokenizer.from_pretrained(CONFIG.DPR_QUESTION_MODEL_NAME)
-
-qa_train_dataset_v4 = RetrievalDataset(qa_train_df_v4, bart_tokenizer, dpr_question_tokenizer, task="qa", candidate_objects=all_candidates)
-qa_val_dataset_v4 = RetrievalDataset(qa_val_df_v4, bart_tokenizer, dpr_question_tokenizer, task="qa", candidate_objects=all_candidates)
-triple_train_dataset_v4 = RetrievalDataset(triple_train_df_v4, bart_tokenizer, dpr_question_tokenizer, task="triple", candidate_objects=all_candidates)
-triple_val_dataset_v4 = RetrievalDataset(triple_val_df_v4, bart_tokenizer, dpr_question_tokenizer, task="triple", candidate_objects=all_candidates)
-
-qa_train_loader_v4 = DataLoader(qa_train_dataset_v4, batch_size=CONFIG.BATCH_SIZE, shuffle=True, num_workers=CONFIG.NUM_WORKERS)
-qa_val_loader_v4 = DataLoader(qa_val_dataset_v4, batch_size=CONFIG.BATCH_SIZE, shuffle=False, num_workers=CONFIG.NUM_WORKERS)
-triple_train_loader_v4 = DataLoader(triple_train_dataset_v4, batch_size=CONFIG.BATCH_SIZE, shuffle=True, num_workers=CONFIG.NUM_WORKERS)
-triple_val_loader_v4 = DataLoader(triple_val_dataset_v4, batch_size=CONFIG.BATCH_SIZE, shuffle=False, num_workers=CONFIG.NUM_WORKERS)
-
-print(f"Created QA DataLoaders (Version 4): QA Train={len(qa_train_dataset_v4)}, QA Val={len(qa_val_dataset_v4)}")
-print(f"Created Triple DataLoaders (Version 4): Triple Train={len(triple_train_dataset_v4)}, Triple Val={len(triple_val_dataset_v4)}")
+print(f"Created QA DataLoaders (Version 4): QA Train={len(qa_train_loader_v4.dataset)}, QA Val={len(qa_val_loader_v4.dataset)}")
+print(f"Created Triple DataLoaders (Version 4): Triple Train={len(triple_train_loader_v4.dataset)}, Triple Val={len(triple_val_loader_v4.dataset)}")
 
 # Load BART models and tokenizer
-bart_qa_model = BartForConditionalGeneration.from_pretrained(CONFIG.BART_MODEL_NAME).to(CONFIG.DEVICE)
-bart_qa_model.load_state_dict(torch.load(os.path.join(save_path, 'bart_qa_v4.pt')))
+bart_qa_model = load_pretrained_fast(BartForConditionalGeneration, os.path.join(save_path, 'bart_qa_v4'), os.path.join(save_path, 'bart_qa_v4.pt'), CONFIG.BART_MODEL_NAME, device=CONFIG.DEVICE)
 bart_tokenizer = BartTokenizer.from_pretrained(CONFIG.BART_MODEL_NAME)
 bart_qa_model.eval()
 
 # Load DPR models and tokenizers (post-fine-tuning from Step 2)
-ctx_encoder_qa = DPRContextEncoder.from_pretrained(os.path.join(CONFIG.BASE_PATH, "dpr_ctx_encoder_qa_v4")).to(CONFIG.DEVICE)
-question_encoder_qa = DPRQuestionEncoder.from_pretrained(os.path.join(CONFIG.BASE_PATH, "dpr_question_encoder_qa_v4")).to(CONFIG.DEVICE)
-ctx_encoder_triple = DPRContextEncoder.from_pretrained(os.path.join(CONFIG.BASE_PATH, "dpr_ctx_encoder_triple_v4")).to(CONFIG.DEVICE)
-question_encoder_triple = DPRQuestionEncoder.from_pretrained(os.path.join(CONFIG.BASE_PATH, "dpr_question_encoder_triple_v4")).to(CONFIG.DEVICE)
+ctx_encoder_qa = load_pretrained_fast(DPRContextEncoder, os.path.join(CONFIG.BASE_PATH, "dpr_ctx_encoder_qa_v4"), device=CONFIG.DEVICE)
+question_encoder_qa = load_pretrained_fast(DPRQuestionEncoder, os.path.join(CONFIG.BASE_PATH, "dpr_question_encoder_qa_v4"), device=CONFIG.DEVICE)
+ctx_encoder_triple = load_pretrained_fast(DPRContextEncoder, os.path.join(CONFIG.BASE_PATH, "dpr_ctx_encoder_triple_v4"), device=CONFIG.DEVICE)
+question_encoder_triple = load_pretrained_fast(DPRQuestionEncoder, os.path.join(CONFIG.BASE_PATH, "dpr_question_encoder_triple_v4"), device=CONFIG.DEVICE)
+report_model_load_times()
 ctx_tokenizer = DPRContextEncoderTokenizer.from_pretrained(CONFIG.DPR_CTX_MODEL_NAME)
 question_tokenizer = DPRQuestionEncoderTokenizer.from_pretrained(CONFIG.DPR_QUESTION_MODEL_NAME)
-candidate_embeddings_qa = torch.load(os.path.join(save_path, 'dpr_candidate_embeddings_v4.pt')).to(CONFIG.DEVICE)
-candidate_embeddings_triple = torch.load(os.path.join(save_path, 'dpr_candidate_embeddings_triple_v4.pt')).to(CONFIG.DEVICE)
+# Candidate stores encoded by Step 2 with the fine-tuned context encoders loaded above, so PPO ranks against the same
+# embeddings the exported adapters are later applied to
+candidate_store_qa = open_embedding_store(os.path.join(save_path, 'dpr_candidate_embeddings_ft_qa_v4.emb'))
+candidate_store_triple = open_embedding_store(os.path.join(save_path, 'dpr_candidate_embeddings_ft_triple_v4.emb'))
+verify_embedding_store(candidate_store_qa, all_candidates, model_fingerprint(ctx_encoder_qa))
+verify_embedding_store(candidate_store_triple, all_candidates, model_fingerprint(ctx_encoder_triple))
 
 # Load sentence transformer
-sentence_transformer = SentenceTransformer('all-MiniLM-L6-v2')
+sentence_transformer = SentenceTransformer(artifact_manifest["models"]["sentence_transformer"])
 
 print("Artifacts loaded from Step 2 and DataLoaders rebuilt for Version 4.")
 
@@ -255,316 +205,8 @@ def compute_mrr(generated_ranking: torch.Tensor, ref_idx: int) -> float:
     rank = (generated_ranking == ref_idx).nonzero(as_tuple=True)[0].item() + 1 if ref_idx in generated_ranking else len(generated_ranking)
     return 1.0 / rank
 
-# Compute reward for RL
-def compute_reward(generated_ranking: torch.Tensor, reference: str) -> float:
-    candidates = all_candidates[:100]  # Use small candidate pool for efficiency
-    ref_idx = candidates.index(reference) if reference in candidates else -1
-    if ref_idx == -1:
-        return 0.0
-    mrr = compute_mrr(generated_ranking, ref_idx)
-    exact_match_bonus = 0.5 if generated_ranking[0] == ref_idx else 0.0
-    return mrr + exact_match_bonus
-
-# Policy Network for DPR (simple MLP to adjust embeddings)
-class PolicyNetwork(torch.nn.Module):
-    def __init__(self, input_dim=768, hidden_dim=256):
-        super(PolicyNetwork, self).__init__()
-        self.network = torch.nn.Sequential(
-            torch.nn.Linear(input_dim, hidden_dim),
-            torch.nn.ReLU(),
-            torch.nn.Linear(hidden_dim, input_dim),
-            torch.nn.Tanh()  # Output adjustment to [-1, 1]
-        )
-
-    def forward(self, x):
-        return self.network(x)
-
-# RL Environment for DPR ranking
-class RankingEnvironment:
-    def __init__(self, ctx_encoder, question_encoder, candidates, candidate_embeddings, val_loader, task: str = "qa"):
-        self.ctx_encoder = ctx_encoder
-        self.question_encoder = question_encoder
-        self.candidates = candidates
-        self.candidate_embeddings = candidate_embeddings
-        self.val_loader = val_loader
-        self.task = task
-        self.current_batch = None
-        self.current_idx = 0
-        self.batch_iterator = iter(val_loader)
-
-    def reset(self):
-        try:
-            self.current_batch = next(self.batch_iterator)
-            self.current_idx = 0
-        except StopIteration:
-            self.batch_iterator = iter(self.val_loader)
-            self.current_batch = next(self.batch_iterator)
-            self.current_idx = 0
-        question_inputs = {
-            "input_ids": self.current_batch["dpr_input_ids"][self.current_idx].to(CONFIG.DEVICE).unsqueeze(0),
-            "attention_mask": self.current_batch["dpr_attention_mask"][self.current_idx].to(CONFIG.DEVICE).unsqueeze(0)
-        }
-        with torch.no_grad():
-            state = self.question_encoder(**question_inputs).pooler_output  # Shape: (1, 768)
-        return state
-
-    def step(self, action):
-        question_inputs = {
-            "input_ids": self.current_batch["dpr_input_ids"][self.current_idx].to(CONFIG.DEVICE).unsqueeze(0),
-            "attention_mask": self.current_batch["dpr_attention_mask"][self.current_idx].to(CONFIG.DEVICE).unsqueeze(0)
-        }
-        with torch.no_grad():
-            question_embedding = self.question_encoder(**question_inputs).pooler_output  # Shape: (1, 768)
-        adjusted_embedding = question_embedding + action  # Adjust embedding
-        similarities = torch.matmul(adjusted_embedding, self.candidate_embeddings.T)  # Shape: (1, num_candidates)
-        rankings = torch.argsort(similarities, dim=1, descending=True)
-        ref = self.current_batch["answer"][self.current_idx]
-        done = False
-        if ref not in self.candidates:
-            reward = 0.0
-            done = True
-        else:
-            reward = compute_reward(rankings[0].cpu(), ref)
-            print(f"Task: {self.task}, Reward: {reward:.4f}")
-
-        # Move to next sample
-        self.current_idx += 1
-        if self.current_idx >= len(self.current_batch["answer"]):
-            try:
-                self.current_batch = next(self.batch_iterator)
-                self.current_idx = 0
-            except StopIteration:
-                done = True
-
-        # Get next state
-        if not done:
-            next_question_inputs = {
-                "input_ids": self.current_batch["dpr_input_ids"][self.current_idx].to(CONFIG.DEVICE).unsqueeze(0),
-                "attention_mask": self.current_batch["dpr_attention_mask"][self.current_idx].to(CONFIG.DEVICE).unsqueeze(0)
-            }
-            with torch.no_grad():
-                next_state = self.question_encoder(**next_question_inputs).pooler_output
-        else:
-            next_state = None
-
-        return next_state, reward, done
-
-# PPO Implementation
-def compute_gae(rewards, values, next_value, gamma=0.99, lam=0.95):
-    advantages = []
-    gae = 0
-    rewards = rewards + [next_value]
-    values = values + [next_value]
-    for t in reversed(range(len(rewards) - 1)):
-        delta = rewards[t] + gamma * values[t + 1] - values[t]
-        gae = delta + gamma * lam * gae
-        advantages.insert(0, gae)
-    return advantages
-
-def ppo_update(policy, optimizer, states, actions, old_log_probs, advantages, returns, clip_epsilon=0.1, epochs=5):
-    for _ in range(epochs):
-        policy.train()
-        new_log_probs = []
-        for state, action in zip(states, actions):
-            state = state.to(CONFIG.DEVICE)
-            action = action.to(CONFIG.DEVICE)
-            adjustment = policy(state)
-            dist = torch.distributions.Normal(adjustment, 0.1)
-            log_prob = dist.log_prob(action).sum(dim=-1)
-            new_log_probs.append(log_prob)
-        new_log_probs = torch.stack(new_log_probs)
-
-        # Compute ratio
-        ratios = torch.exp(new_log_probs - torch.stack(old_log_probs))
-
-        # Compute surrogate loss
-        surr1 = ratios * torch.tensor(advantages, device=CONFIG.DEVICE)
-        surr2 = torch.clamp(ratios, 1 - clip_epsilon, 1 + clip_epsilon) * torch.tensor(advantages, device=CONFIG.DEVICE)
-        policy_loss = -torch.min(surr1, surr2).mean()
-
-        # Update policy
-        optimizer.zero_grad()
-        policy_loss.backward()
-        optimizer.step()
-        print(f"Policy Loss: {policy_loss.item():.4f}")
-
-    return policy_loss.item()
-
 print("RL helper functions defined.")
 
-# RL Fine-Tuning for DPR on QA Task
-
-# Fine-tune DPR with PPO on QA data
-policy_qa = PolicyNetwork(input_dim=768, hidden_dim=256).to(CONFIG.DEVICE)
-value_network_qa = PolicyNetwork(input_dim=768, hidden_dim=256).to(CONFIG.DEVICE)
-policy_optimizer_qa = torch.optim.Adam(policy_qa.parameters(), lr=5e-5)
-value_optimizer_qa = torch.optim.Adam(value_network_qa.parameters(), lr=5e-5)
-
-# Create environment for QA task
-qa_env = RankingEnvironment(ctx_encoder_qa, question_encoder_qa, all_candidates, candidate_embeddings_qa, qa_val_loader_v4, task="qa")
-
-num_episodes = 500  # Reduced number of episodes
-max_steps_per_episode = 50  # Maximum steps per episode
-
-print("Fine-tuning DPR with PPO on QA data...")
-for episode in range(num_episodes):
-    print(f"QA Episode {episode + 1}/{num_episodes}")
-    state = qa_env.reset()
-    if state.dim() == 1:
-        state = state.unsqueeze(0)
-    states, actions, rewards, old_log_probs, values = [], [], [], [], []
-    done = False
-    episode_steps = 0
-
-    while not done and episode_steps < max_steps_per_episode:
-        state = state.to(CONFIG.DEVICE)
-        with torch.no_grad():
-            adjustment = policy_qa(state)
-            dist = torch.distributions.Normal(adjustment, 0.1)
-            action = dist.sample()
-            log_prob = dist.log_prob(action).sum(dim=-1)
-            value = value_network_qa(state).mean()
-
-        next_state, reward, done = qa_env.step(action)
-
-        if next_state is not None and next_state.dim() == 1:
-            next_state = next_state.unsqueeze(0)
-
-        states.append(state)
-        actions.append(action)
-        rewards.append(reward)
-        old_log_probs.append(log_prob)
-        values.append(value.item())
-
-        state = next_state
-        episode_steps += 1
-
-    # Compute returns and advantages
-    with torch.no_grad():
-        next_value = value_network_qa(state).mean().item() if state is not None else 0.0
-    advantages = compute_gae(rewards, values, next_value)
-    returns = [r + next_value for r in rewards]
-
-    # Update policy and value network
-    policy_loss = ppo_update(policy_qa, policy_optimizer_qa, states, actions, old_log_probs, advantages, returns)
-
-    # Update value network
-    value_loss = 0
-    for state, ret in zip(states, returns):
-        state = state.to(CONFIG.DEVICE)
-        value = value_network_qa(state).mean()
-        value_loss += (value - ret) ** 2
-    value_loss = value_loss / len(states)
-    value_optimizer_qa.zero_grad()
-    value_loss.backward()
-    value_optimizer_qa.step()
-    print(f"QA Value Loss: {value_loss.item():.4f}")
-
-# Save fine-tuned DPR models for QA task (Version 4)
-ctx_encoder_qa.save_pretrained(os.path.join(CONFIG.BASE_PATH, "dpr_ctx_encoder_rl_qa_v4"))
-question_encoder_qa.save_pretrained(os.path.join(CONFIG.BASE_PATH, "dpr_question_encoder_rl_qa_v4"))
-print("Saved RL fine-tuned DPR models for QA task.")
-
-# RL Fine-Tuning for DPR on Triple Task
-
-# Fine-tune DPR with PPO on triple data
-policy_triple = PolicyNetwork(input_dim=768, hidden_dim=256).to(CONFIG.DEVICE)
-value_network_triple = PolicyNetwork(input_dim=768, hidden_dim=256).to(CONFIG.DEVICE)
-policy_optimizer_triple = torch.optim.Adam(policy_triple.parameters(), lr=5e-5)
-value_optimizer_triple = torch.optim.Adam(value_network_triple.parameters(), lr=5e-5)
-
-# Create environment for triple task
-triple_env = RankingEnvironment(ctx_encoder_triple, question_encoder_triple, all_candidates, candidate_embeddings_triple, triple_val_loader_v4, task="triple")
-
-num_episodes = 500  # Reduced number of episodes
-max_steps_per_episode = 50  # Maximum steps per episode
-
-print("Fine-tuning DPR with PPO on triple data...")
-for episode in range(num_episodes):
-    print(f"Triple Episode {episode + 1}/{num_episodes}")
-    state = triple_env.reset()
-    if state.dim() == 1:
-        state = state.unsqueeze(0)
-    states, actions, rewards, old_log_probs, values = [], [], [], [], []
-    done = False
-    episode_steps = 0
-
-    while not done and episode_steps < max_steps_per_episode:
-        state = state.to(CONFIG.DEVICE)
-        with torch.no_grad():
-            adjustment = policy_triple(state)
-            dist = torch.distributions.Normal(adjustment, 0.1)
-            action = dist.sample()
-            log_prob = dist.log_prob(action).sum(dim=-1)
-            value = value_network_triple(state).mean()
-
-        next_state, reward, done = triple_env.step(action)
-
-        if next_state is not None and next_state.dim() == 1:
-            next_state = next_state.unsqueeze(0)
-
-        states.append(state)
-        actions.append(action)
-        rewards.append(reward)
-        old_log_probs.append(log_prob)
-        values.append(value.item())
-
-        state = next_state
-        episode_steps += 1
-
-    # Compute returns and advantages
-    with torch.no_grad():
-        next_value = value_network_triple(state).mean().item() if state is not None else 0.0
-    advantages = compute_gae(rewards, values, next_value)
-    returns = [r + next_value for r in rewards]
-
-    # Update policy and value network
-    policy_loss = ppo_update(policy_triple, policy_optimizer_triple, states, actions, old_log_probs, advantages, returns)
-
-    # Update value network
-    value_loss = 0
-    for state, ret in zip(states, returns):
-        state = state.to(CONFIG.DEVICE)
-        value = value_network_triple(state).mean()
-        value_loss += (value - ret) ** 2
-    value_loss = value_loss / len(states)
-    value_optimizer_triple.zero_grad()
-    value_loss.backward()
-    value_optimizer_triple.step()
-    print(f"Triple Value Loss: {value_loss.item():.4f}")
-
-# Save fine-tuned DPR models for triple task
-ctx_encoder_triple.save_pretrained(os.path.join(CONFIG.BASE_PATH, "dpr_ctx_encoder_rl_triple_v4"))
-question_encoder_triple.save_pretrained(os.path.join(CONFIG.BASE_PATH, "dpr_question_encoder_rl_triple_v4"))
-print("Saved RL fine-tuned DPR models for triple task.")
-
-# Save RL Metrics and Artifacts
-
-rl_metrics = {
-    "qa_policy_losses": [],  # Placeholder, as losses are not computed in the current setup
-    "qa_value_losses": [],   # Placeholder
-    "triple_policy_losses": [],  # Placeholder
-    "triple_value_losses": []    # Placeholder
-}
-
-rl_metrics_path = os.path.join(CONFIG.BASE_PATH, "rl_metrics_v4.json")
-with open(rl_metrics_path, "w") as f:
-    json.dump(rl_metrics, f)
-print(f"Saved RL metrics at {rl_metrics_path}")
-
-# Save updated candidate embeddings
-with torch.no_grad():
-    # Limit candidate pool size for faster encoding
-    eval_candidates = all_candidates[:1000]  # Limit to 1000 candidates
-    candidate_inputs = ctx_tokenizer(eval_candidates, return_tensors="pt", padding=True, truncation=True, max_length=CONFIG.MAX_LENGTH)
-    candidate_inputs = {k: v.to(CONFIG.DEVICE) for k, v in candidate_inputs.items()}
-    candidate_embeddings_qa = ctx_encoder_qa(**candidate_inputs).pooler_output
-    candidate_embeddings_triple = ctx_encoder_triple(**candidate_inputs).pooler_output
-torch.save(candidate_embeddings_qa, os.path.join(save_path, 'dpr_candidate_embeddings_rl_qa_v4.pt'))
-torch.save(candidate_embeddings_triple, os.path.join(save_path, 'dpr_candidate_embeddings_rl_triple_v4.pt'))
-
-print("Updated candidate embeddings saved for Version 4.")
-
 """Improve RL reward"""
 
 # Define RL Helper Functions
@@ -596,25 +238,90 @@ def compute_mrr(generated_ranking: torch.Tensor, ref_idx: int) -> float:
     rank = (generated_ranking == ref_idx).nonzero(as_tuple=True)[0].item() + 1 if ref_idx in generated_ranking else len(generated_ranking)
     return 1.0 / rank
 
+# Updated reward from each reference's position in its ranking: scaled MRR + exact-match bonus + exploration
+# bonus for references in the reward pool, `penalties` (default 0) for the rest
+def pool_rewards(rankings: torch.Tensor, ref_ids: torch.Tensor, pool_size: int = CONFIG.REWARD_POOL_SIZE,
+                 penalties: torch.Tensor = None, **reward_params) -> torch.Tensor:
+    positions = (rankings == ref_ids.clamp(min=0).unsqueeze(1)).float().argmax(dim=1)
+    return position_rewards(positions, ref_ids, pool_size, penalties, **reward_params)
+
+# 0-based position of each reference from (batch, num_candidates) similarities by counting the candidates that
+# score above it: O(N) on the similarities' device instead of a full sort
+def reference_positions(similarities: torch.Tensor, ref_ids: torch.Tensor) -> torch.Tensor:
+    ref_scores = similarities.gather(1, ref_ids.clamp(min=0).unsqueeze(1).to(similarities.device))
+    return (similarities > ref_scores).sum(dim=1)
+
+# Same reward from 0-based reference positions, for callers that count rather than sort
+def position_rewards(positions: torch.Tensor, ref_ids: torch.Tensor, pool_size: int = CONFIG.REWARD_POOL_SIZE,
+                     penalties: torch.Tensor = None, mrr_scale: float = 2.0, exact_match_bonus: float = 0.5,
+                     exploration_bonus: float = 0.01) -> torch.Tensor:
+    in_pool = (ref_ids >= 0) & (ref_ids < pool_size)
+    mrr_scaled = mrr_scale / (positions + 1).float()  # Scale MRR to provide stronger signal
+    exact_match = (positions == 0).float() * exact_match_bonus
+    penalties = torch.zeros_like(mrr_scaled) if penalties is None else penalties.to(mrr_scaled.device)
+    return torch.where(in_pool, mrr_scaled + exact_match + exploration_bonus, penalties)
+
+# Reward service for the updated reward: the sentence transformer is loaded once, the reward pool is
+# encoded once, and reference embeddings are kept in an LRU cache, so a batch of references costs at most
+# one encode call for the references not seen recently
+class RewardService:
+    def __init__(self, model: SentenceTransformer, candidates: list, cache_size: int = CONFIG.REWARD_CACHE_SIZE):
+        self.model = model
+        self.candidates = candidates
+        self.candidate_index = {candidate: idx for idx, candidate in enumerate(candidates)}
+        self.candidate_embeddings = model.encode(candidates, convert_to_tensor=True, normalize_embeddings=True).to(CONFIG.DEVICE)
+        self.cache_size = cache_size
+        self.reference_cache = OrderedDict()
+        self.hits, self.misses = 0, 0
+
+    # Unit-norm embeddings for a list of references, encoding only cache misses in one batch
+    def reference_embeddings(self, references: list) -> torch.Tensor:
+        missing = [ref for ref in dict.fromkeys(references) if ref not in self.reference_cache]
+        self.misses += len(missing)
+        self.hits += len(references) - len(missing)
+        if missing:
+            encoded = self.model.encode(missing, convert_to_tensor=True, normalize_embeddings=True).to(CONFIG.DEVICE)
+            self.reference_cache.update(zip(missing, encoded))
+        for ref in references:
+            self.reference_cache.move_to_end(ref)
+        embeddings = torch.stack([self.reference_cache[ref] for ref in references])
+        while len(self.reference_cache) > self.cache_size:
+            self.reference_cache.popitem(last=False)
+        return embeddings
+
+    # Penalty for references outside the pool: closer to 0 if a pool candidate is similar, closer to -0.5 if not
+    def penalties(self, references: list) -> torch.Tensor:
+        similarities = torch.matmul(self.reference_embeddings(references), self.candidate_embeddings.T)
+        return -0.5 * (1.0 - similarities.max(dim=1).values)
+
+    # Penalties for a whole table of references in one encode call (bypasses the LRU cache); they are fixed per
+    # reference, so environments and rollout workers can look them up instead of calling the service
+    def penalty_table(self, references: list) -> torch.Tensor:
+        embeddings = self.model.encode(references, convert_to_tensor=True, normalize_embeddings=True, batch_size=256).to(CONFIG.DEVICE)
+        return -0.5 * (1.0 - torch.matmul(embeddings, self.candidate_embeddings.T).max(dim=1).values)
+
+    # Rewards for a batch of (ranking, reference) pairs; rankings is (batch, num_candidates) on any device.
+    # ref_ids (candidate ids of the references, -1 if absent) can be passed to skip the string lookup.
+    def score(self, rankings: torch.Tensor, references: list, ref_ids: torch.Tensor = None) -> torch.Tensor:
+        if ref_ids is None:
+            ref_ids = torch.tensor([self.candidate_index.get(ref, -1) for ref in references], device=rankings.device)
+        positions = (rankings == ref_ids.clamp(min=0).unsqueeze(1)).float().argmax(dim=1)
+        return self.score_positions(positions, references, ref_ids)
+
+    # Rewards from 0-based reference positions (see reference_positions); ref_ids as in score
+    def score_positions(self, positions: torch.Tensor, references: list, ref_ids: torch.Tensor) -> torch.Tensor:
+        in_pool = (ref_ids >= 0) & (ref_ids < len(self.candidates))
+        rewards = position_rewards(positions, ref_ids, len(self.candidates))
+        if not bool(in_pool.all()):
+            missing = torch.nonzero(~in_pool).flatten()
+            rewards[missing] = self.penalties([references[i] for i in missing.tolist()]).to(rewards.device)
+        return rewards
+
+reward_service = RewardService(sentence_transformer, all_candidates[:CONFIG.REWARD_POOL_SIZE])
+
 # Compute reward for RL (Updated with semantic similarity for missing references)
 def compute_reward(generated_ranking: torch.Tensor, reference: str) -> float:
-    candidates = all_candidates[:100]  # Use small candidate pool for efficiency
-    ref_idx = candidates.index(reference) if reference in candidates else -1
-    if ref_idx == -1:
-        # Compute semantic similarity to the reference using SentenceTransformer
-        sentence_transformer = SentenceTransformer('all-MiniLM-L6-v2')
-        ref_embedding = sentence_transformer.encode(reference, convert_to_tensor=True).to(CONFIG.DEVICE)
-        candidate_embeddings = sentence_transformer.encode(candidates, convert_to_tensor=True).to(CONFIG.DEVICE)
-        similarities = torch.cosine_similarity(ref_embedding.unsqueeze(0), candidate_embeddings, dim=1)
-        max_similarity = similarities.max().item()
-        # Scale the penalty based on the maximum similarity (closer to 0 if similar, closer to -0.5 if dissimilar)
-        penalty = -0.5 * (1.0 - max_similarity)
-        return penalty
-    mrr = compute_mrr(generated_ranking, ref_idx)
-    mrr_scaled = mrr * 2.0  # Scale MRR to provide stronger signal
-    exact_match_bonus = 0.5 if generated_ranking[0] == ref_idx else 0.0
-    exploration_bonus = 0.01  # Small bonus to encourage exploration
-    return mrr_scaled + exact_match_bonus + exploration_bonus
+    return reward_service.score(generated_ranking.unsqueeze(0), [reference])[0].item()
 
 # Policy Network for DPR (simple MLP to adjust embeddings)
 class PolicyNetwork(torch.nn.Module):
@@ -630,116 +337,584 @@ class PolicyNetwork(torch.nn.Module):
     def forward(self, x):
         return self.network(x)
 
-# RL Environment for DPR ranking
-class RankingEnvironment:
-    def __init__(self, ctx_encoder, question_encoder, candidates, candidate_embeddings, val_loader, task: str = "qa"):
-        self.ctx_encoder = ctx_encoder
-        self.question_encoder = question_encoder
-        self.candidates = candidates
-        self.candidate_embeddings = candidate_embeddings
-        self.val_loader = val_loader
+# Vectorized RL Environment (precomputed question-embedding table)
+
+# The question encoder is frozen during PPO, so every validation question is encoded exactly once.
+# Returns the (num_questions, 768) table, the reference strings and each reference's candidate id (-1 if absent).
+def build_question_embedding_table(question_encoder, val_loader, candidates: list):
+    question_encoder.eval()
+    embeddings, references = [], []
+    with torch.no_grad():
+        for batch in tqdm(val_loader, desc="Encoding questions"):
+            embeddings.append(question_encoder(
+                input_ids=batch["dpr_input_ids"].to(CONFIG.DEVICE),
+                attention_mask=batch["dpr_attention_mask"].to(CONFIG.DEVICE)
+            ).pooler_output)
+            references.extend(batch["answer"])
+    candidate_index = {candidate: idx for idx, candidate in enumerate(candidates)}
+    ref_ids = torch.tensor([candidate_index.get(ref, -1) for ref in references], device=CONFIG.DEVICE)
+    return torch.cat(embeddings), references, ref_ids
+
+# RL environment that steps num_envs questions at once: states are rows of the embedding table, and one
+# batched matmul against the candidate store ranks every adjusted question of the step.
+# shard restricts the environment to a subset of table rows; with reward_penalties (one per table row) the
+# reward is pure tensor math and never calls the reward service.
+class VectorizedRankingEnvironment:
+    def __init__(self, question_table: torch.Tensor, references: list, ref_ids: torch.Tensor, candidate_store,
+                 num_envs: int = CONFIG.RL_NUM_ENVS, task: str = "qa", seed: int = 42,
+                 shard: torch.Tensor = None, reward_penalties: torch.Tensor = None, reward_params: dict = None):
+        self.question_table = question_table
+        self.references = references
+        self.ref_ids = ref_ids
+        self.candidate_store = candidate_store
+        self.shard = torch.arange(len(question_table)) if shard is None else shard
+        self.reward_penalties = reward_penalties
+        self.reward_params = reward_params or {}  # Overrides for position_rewards' shaping terms (penalty-table rewards only)
+        self.num_envs = min(num_envs, len(self.shard))
         self.task = task
-        self.current_batch = None
-        self.current_idx = 0
-        self.batch_iterator = iter(val_loader)
+        self.generator = torch.Generator().manual_seed(seed)
+        self.order = self.shard[torch.randperm(len(self.shard), generator=self.generator)]
+        self.cursor = 0
+        self.question_ids = None
+
+    # Draw the next num_envs questions, reshuffling after each pass over the shard
+    def next_questions(self) -> torch.Tensor:
+        if self.cursor + self.num_envs > len(self.order):
+            self.order = self.shard[torch.randperm(len(self.shard), generator=self.generator)]
+            self.cursor = 0
+        question_ids = self.order[self.cursor:self.cursor + self.num_envs].to(self.question_table.device)
+        self.cursor += self.num_envs
+        return question_ids
 
     def reset(self):
-        try:
-            self.current_batch = next(self.batch_iterator)
-            self.current_idx = 0
-        except StopIteration:
-            self.batch_iterator = iter(self.val_loader)
-            self.current_batch = next(self.batch_iterator)
-            self.current_idx = 0
-        question_inputs = {
-            "input_ids": self.current_batch["dpr_input_ids"][self.current_idx].to(CONFIG.DEVICE).unsqueeze(0),
-            "attention_mask": self.current_batch["dpr_attention_mask"][self.current_idx].to(CONFIG.DEVICE).unsqueeze(0)
+        self.question_ids = self.next_questions()
+        return self.question_table[self.question_ids]  # Shape: (num_envs, 768)
+
+    # Rewards for adjusting the given questions by actions
+    def rewards_for(self, question_ids: torch.Tensor, actions: torch.Tensor) -> torch.Tensor:
+        adjusted_embeddings = self.question_table[question_ids] + actions  # Adjust embeddings
+        similarities = self.candidate_store.scores(adjusted_embeddings)  # Shape: (num_envs, num_candidates)
+        positions = reference_positions(similarities, self.ref_ids[question_ids])
+        if self.reward_penalties is not None:
+            return position_rewards(positions, self.ref_ids[question_ids].to(positions.device),
+                                    penalties=self.reward_penalties[question_ids], **self.reward_params)
+        return reward_service.score_positions(positions, [self.references[i] for i in question_ids.tolist()],
+                                              self.ref_ids[question_ids].to(positions.device))
+
+    # Top-k candidate ids for the given adjusted questions, for logging only
+    def top_k_ids(self, question_ids: torch.Tensor, actions: torch.Tensor, k: int = 10) -> torch.Tensor:
+        similarities = self.candidate_store.scores(self.question_table[question_ids] + actions)
+        return torch.topk(similarities, k=min(k, similarities.size(1)), dim=1).indices
+
+    # Each question is a one-step episode: every env ends its episode and moves on to a fresh question, so the
+    # returned dones are all ones and GAE never bootstraps a question's value into the next one
+    def step(self, actions):
+        rewards = self.rewards_for(self.question_ids, actions)
+        self.question_ids = self.next_questions()
+        return self.question_table[self.question_ids], rewards, torch.ones_like(rewards)
+
+# PPO Implementation (tensorized rollout buffer, minibatched updates)
+
+# Preallocated storage for one episode of num_steps x num_envs transitions
+class RolloutBuffer:
+    def __init__(self, num_steps: int, num_envs: int, state_dim: int = 768, device=CONFIG.DEVICE):
+        self.states = torch.zeros(num_steps, num_envs, state_dim, device=device)
+        self.actions = torch.zeros(num_steps, num_envs, state_dim, device=device)
+        self.log_probs = torch.zeros(num_steps, num_envs, device=device)
+        self.values = torch.zeros(num_steps, num_envs, device=device)
+        self.rewards = torch.zeros(num_steps, num_envs, device=device)
+        self.dones = torch.zeros(num_steps, num_envs, device=device)
+        self.advantages = torch.zeros(num_steps, num_envs, device=device)
+        self.returns = torch.zeros(num_steps, num_envs, device=device)
+        self.step = 0
+
+    def reset(self):
+        self.step = 0
+
+    def add(self, state, action, log_prob, value, reward, done):
+        self.states[self.step] = state
+        self.actions[self.step] = action
+        self.log_probs[self.step] = log_prob
+        self.values[self.step] = value
+        self.rewards[self.step] = reward
+        self.dones[self.step] = done
+        self.step += 1
+
+    # GAE as a reverse scan over time, vectorized across environments
+    def compute_returns_and_advantages(self, next_value: torch.Tensor, gamma: float = CONFIG.PPO_GAMMA, lam: float = CONFIG.PPO_LAMBDA):
+        gae = torch.zeros_like(next_value)
+        for t in reversed(range(self.step)):
+            next_values = next_value if t == self.step - 1 else self.values[t + 1]
+            not_done = 1.0 - self.dones[t]
+            delta = self.rewards[t] + gamma * next_values * not_done - self.values[t]
+            gae = delta + gamma * lam * not_done * gae
+            self.advantages[t] = gae
+        self.returns[:self.step] = self.advantages[:self.step] + self.values[:self.step]
+
+    # Shuffled minibatches over the flattened (step, env) transitions
+    def minibatches(self, minibatch_size: int):
+        num_transitions = self.step * self.states.size(1)
+        flat = {
+            "states": self.states[:self.step].reshape(num_transitions, -1),
+            "actions": self.actions[:self.step].reshape(num_transitions, -1),
+            "log_probs": self.log_probs[:self.step].reshape(-1),
+            "advantages": self.advantages[:self.step].reshape(-1),
+            "returns": self.returns[:self.step].reshape(-1)
         }
+        order = torch.randperm(num_transitions, device=self.states.device)
+        for start in range(0, num_transitions, minibatch_size):
+            indices = order[start:start + minibatch_size]
+            yield {key: value[indices] for key, value in flat.items()}
+
+# PPO learner: clipped policy loss and value regression over shuffled minibatches of a rollout buffer
+class PPOLearner:
+    def __init__(self, policy, value_network, policy_optimizer, value_optimizer, clip_epsilon: float = CONFIG.PPO_CLIP_EPSILON,
+                 epochs: int = CONFIG.PPO_EPOCHS, minibatch_size: int = CONFIG.PPO_MINIBATCH_SIZE, action_std: float = CONFIG.PPO_ACTION_STD,
+                 gamma: float = CONFIG.PPO_GAMMA, lam: float = CONFIG.PPO_LAMBDA):
+        self.policy = policy
+        self.value_network = value_network
+        self.policy_optimizer = policy_optimizer
+        self.value_optimizer = value_optimizer
+        self.clip_epsilon = clip_epsilon
+        self.epochs = epochs
+        self.minibatch_size = minibatch_size
+        self.action_std = action_std
+        self.gamma = gamma
+        self.lam = lam
+
+    # Sample adjustments for a batch of states; returns (action, log_prob, value)
+    def act(self, states: torch.Tensor):
         with torch.no_grad():
-            state = self.question_encoder(**question_inputs).pooler_output  # Shape: (1, 768)
-        return state
+            dist = torch.distributions.Normal(self.policy(states), self.action_std)
+            actions = dist.sample()
+            return actions, dist.log_prob(actions).sum(dim=-1), self.value_network(states).mean(dim=-1)
 
-    def step(self, action):
-        question_inputs = {
-            "input_ids": self.current_batch["dpr_input_ids"][self.current_idx].to(CONFIG.DEVICE).unsqueeze(0),
-            "attention_mask": self.current_batch["dpr_attention_mask"][self.current_idx].to(CONFIG.DEVICE).unsqueeze(0)
+    def value(self, states: torch.Tensor) -> torch.Tensor:
+        with torch.no_grad():
+            return self.value_network(states).mean(dim=-1)
+
+    # Returns the mean policy and value loss over all minibatch updates
+    def update(self, buffer: RolloutBuffer):
+        self.policy.train()
+        self.value_network.train()
+        policy_losses, value_losses = [], []
+        for _ in range(self.epochs):
+            for batch in buffer.minibatches(self.minibatch_size):
+                dist = torch.distributions.Normal(self.policy(batch["states"]), self.action_std)
+                ratios = torch.exp(dist.log_prob(batch["actions"]).sum(dim=-1) - batch["log_probs"])
+                surr1 = ratios * batch["advantages"]
+                surr2 = torch.clamp(ratios, 1 - self.clip_epsilon, 1 + self.clip_epsilon) * batch["advantages"]
+                policy_loss = -torch.min(surr1, surr2).mean()
+                self.policy_optimizer.zero_grad()
+                policy_loss.backward()
+                self.policy_optimizer.step()
+
+                value_loss = ((self.value_network(batch["states"]).mean(dim=-1) - batch["returns"]) ** 2).mean()
+                self.value_optimizer.zero_grad()
+                value_loss.backward()
+                self.value_optimizer.step()
+                policy_losses.append(policy_loss.item())
+                value_losses.append(value_loss.item())
+        return float(np.mean(policy_losses)), float(np.mean(value_losses))
+
+# PPO on the vectorized environment: every step advances num_envs questions and is written into the
+# preallocated buffer, so rollout collection and the update never leave the device
+def train_ppo_vectorized(env, learner: PPOLearner, num_episodes: int = 500, steps_per_episode: int = 50, verbose: bool = True):
+    buffer = RolloutBuffer(steps_per_episode, env.num_envs, device=env.question_table.device)
+    policy_losses, value_losses = [], []
+    for episode in range(num_episodes):
+        buffer.reset()
+        state = env.reset()
+        for _ in range(steps_per_episode):
+            action, log_prob, value = learner.act(state)
+            next_state, reward, done = env.step(action)
+            buffer.add(state, action, log_prob, value, reward, done)
+            state = next_state
+        buffer.compute_returns_and_advantages(learner.value(state), learner.gamma, learner.lam)
+        policy_loss, value_loss = learner.update(buffer)
+        policy_losses.append(policy_loss)
+        value_losses.append(value_loss)
+        if not verbose:
+            continue
+        # The LRU counters only move when rewards go through the reward service, not the precomputed penalty table
+        reward_cache = "" if env.reward_penalties is not None else f", Reward Cache {reward_service.hits} hits / {reward_service.misses} misses"
+        print(f"{env.task} Episode {episode + 1}/{num_episodes}: Mean Reward {buffer.rewards.mean().item():.4f}, "
+              f"Policy Loss {policy_loss:.4f}, Value Loss {value_loss:.4f}{reward_cache}")
+    return policy_losses, value_losses
+
+# Parallel Rollout Workers (forked CPU processes, shared-memory embedding table)
+
+# Worker process: runs its own environment over one shard of the shared question table on CPU and sends
+# one batched trajectory per episode. It reloads the policy whenever the learner publishes a new version, and
+# samples with the learner's action_std so the stored log-probs come from the same Gaussian the PPO ratio uses.
+def rollout_worker(worker_id: int, task: str, question_table, ref_ids, reward_penalties, shard, store_path: str,
+                   shared_policy, weight_version, trajectory_queue, stop_event, num_envs: int, steps_per_episode: int,
+                   reward_params: dict = None, action_std: float = CONFIG.PPO_ACTION_STD):
+    torch.set_num_threads(1)
+    torch.manual_seed(1000 + worker_id)
+    env = VectorizedRankingEnvironment(question_table, None, ref_ids, open_embedding_store(store_path), num_envs=num_envs,
+                                       task=task, seed=1000 + worker_id, shard=shard, reward_penalties=reward_penalties,
+                                       reward_params=reward_params)
+    policy = PolicyNetwork(input_dim=question_table.size(1), hidden_dim=256)
+    policy_version = -1
+    while not stop_event.is_set():
+        if weight_version.value != policy_version:
+            with weight_version.get_lock():
+                policy.load_state_dict(shared_policy.state_dict())
+                policy_version = weight_version.value
+        state = env.reset()
+        states, actions, log_probs, rewards, dones = [], [], [], [], []
+        with torch.no_grad():
+            for _ in range(steps_per_episode):
+                dist = torch.distributions.Normal(policy(state), action_std)
+                action = dist.sample()
+                next_state, reward, done = env.step(action)
+                states.append(state)
+                actions.append(action)
+                log_probs.append(dist.log_prob(action).sum(dim=-1))
+                rewards.append(reward)
+                dones.append(done)
+                state = next_state
+        trajectory_queue.put({
+            "worker_id": worker_id,
+            "policy_version": policy_version,
+            "states": torch.stack(states),
+            "actions": torch.stack(actions),
+            "log_probs": torch.stack(log_probs),
+            "rewards": torch.stack(rewards),
+            "dones": torch.stack(dones),
+            "next_state": state
+        })
+
+# Train one learner per task from a pool of rollout workers. Every task's workers run at the same time, and the
+# learner process pulls trajectories round-robin across tasks, updates on the device and broadcasts the new
+# policy weights through a shared-memory copy, so QA and triple train concurrently.
+# tasks maps a task name to {"learner", "question_table", "ref_ids", "reward_penalties", "store_path"} and optionally "reward_params".
+def train_ppo_parallel(tasks: dict, num_episodes: int = 500, steps_per_episode: int = 50,
+                       num_workers: int = CONFIG.RL_NUM_WORKERS, envs_per_worker: int = CONFIG.RL_NUM_ENVS):
+    ctx = mp.get_context("fork")  # Workers inherit the notebook's functions; they only touch CPU tensors
+    runs = {}
+    for task, setup in tasks.items():
+        question_table = setup["question_table"].cpu().share_memory_()
+        ref_ids = setup["ref_ids"].cpu().share_memory_()
+        reward_penalties = setup["reward_penalties"].cpu().share_memory_()
+        shared_policy = PolicyNetwork(input_dim=question_table.size(1), hidden_dim=256)
+        shared_policy.load_state_dict({k: v.cpu() for k, v in setup["learner"].policy.state_dict().items()})
+        shared_policy.share_memory()
+        shards = torch.randperm(len(question_table)).chunk(num_workers)
+        num_envs = min(envs_per_worker, min(len(shard) for shard in shards))
+        run = {
+            "learner": setup["learner"],
+            "shared_policy": shared_policy,
+            "weight_version": ctx.Value("i", 0),
+            "trajectory_queue": ctx.Queue(maxsize=2 * num_workers),
+            "stop_event": ctx.Event(),
+            "buffer": RolloutBuffer(steps_per_episode, num_envs),
+            "episodes": 0,
+            "policy_losses": [],
+            "value_losses": []
         }
+        run["workers"] = [
+            ctx.Process(target=rollout_worker, daemon=True, args=(
+                worker_id, task, question_table, ref_ids, reward_penalties, shard, setup["store_path"], shared_policy,
+                run["weight_version"], run["trajectory_queue"], run["stop_event"], num_envs, steps_per_episode,
+                setup.get("reward_params"), setup["learner"].action_std
+            ))
+            for worker_id, shard in enumerate(shards)
+        ]
+        for worker in run["workers"]:
+            worker.start()
+        runs[task] = run
+
+    try:
+        while any(run["episodes"] < num_episodes for run in runs.values()):
+            for task, run in runs.items():
+                if run["episodes"] >= num_episodes:
+                    continue
+                trajectory = run["trajectory_queue"].get()
+                learner, buffer = run["learner"], run["buffer"]
+                buffer.reset()
+                steps, envs = trajectory["rewards"].shape
+                buffer.states[:steps] = trajectory["states"].to(CONFIG.DEVICE)
+                buffer.actions[:steps] = trajectory["actions"].to(CONFIG.DEVICE)
+                buffer.log_probs[:steps] = trajectory["log_probs"].to(CONFIG.DEVICE)
+                buffer.rewards[:steps] = trajectory["rewards"].to(CONFIG.DEVICE)
+                buffer.dones[:steps] = trajectory["dones"].to(CONFIG.DEVICE)
+                buffer.values[:steps] = learner.value(buffer.states[:steps].reshape(steps * envs, -1)).view(steps, envs)
+                buffer.step = steps
+                buffer.compute_returns_and_advantages(learner.value(trajectory["next_state"].to(CONFIG.DEVICE)), learner.gamma, learner.lam)
+                policy_loss, value_loss = learner.update(buffer)
+                with run["weight_version"].get_lock():
+                    run["shared_policy"].load_state_dict({k: v.cpu() for k, v in learner.policy.state_dict().items()})
+                    run["weight_version"].value += 1
+                run["episodes"] += 1
+                run["policy_losses"].append(policy_loss)
+                run["value_losses"].append(value_loss)
+                print(f"{task} Episode {run['episodes']}/{num_episodes} (worker {trajectory['worker_id']}, "
+                      f"policy v{trajectory['policy_version']}): Mean Reward {buffer.rewards[:steps].mean().item():.4f}, "
+                      f"Policy Loss {policy_loss:.4f}, Value Loss {value_loss:.4f}")
+    finally:
+        for run in runs.values():
+            run["stop_event"].set()
+            while any(worker.is_alive() for worker in run["workers"]):
+                try:
+                    run["trajectory_queue"].get(timeout=1)  # Unblock workers waiting on a full queue
+                except Exception:
+                    pass
+            for worker in run["workers"]:
+                worker.join()
+    return {task: (run["policy_losses"], run["value_losses"]) for task, run in runs.items()}
+
+# Offline RL from Logged Rankings
+
+# One pass over the precomputed question table: log each question's top-k candidate ids and scores, its reference
+# id and reward penalty, plus the embeddings of every logged candidate, as .npy files under log_dir. The log is
+# reused while the question encoder, store and top_k are unchanged.
+def log_offline_rankings(log_dir: str, question_table: torch.Tensor, ref_ids: torch.Tensor, reward_penalties: torch.Tensor,
+                         candidate_store, question_encoder_hash: str, top_k: int = CONFIG.OFFLINE_LOG_TOP_K, batch_size: int = 256) -> str:
+    log_meta = {
+        "question_encoder_fingerprint": question_encoder_hash,
+        "store_path": candidate_store.path,
+        "store_encoder_fingerprint": candidate_store.encoder_fingerprint,
+        "num_questions": len(question_table),
+        "top_k": min(top_k, len(candidate_store)),
+        "reward_pool_size": CONFIG.REWARD_POOL_SIZE
+    }
+    meta_path = os.path.join(log_dir, "log_meta.json")
+    if os.path.exists(meta_path):
+        with open(meta_path, "r") as f:
+            if json.load(f) == log_meta:
+                print(f"Reusing offline log at {log_dir}")
+                return log_dir
+    os.makedirs(log_dir, exist_ok=True)
+    topk_scores, topk_ids = [], []
+    with torch.no_grad():
+        for start in range(0, len(question_table), batch_size):
+            scores = candidate_store.scores(question_table[start:start + batch_size])
+            values, ids = torch.topk(scores, k=log_meta["top_k"], dim=1)
+            topk_scores.append(values.cpu())
+            topk_ids.append(ids.cpu())
+    topk_ids = torch.cat(topk_ids)
+    ref_ids = ref_ids.cpu()
+    row_ids = torch.unique(torch.cat([topk_ids.flatten(), ref_ids[ref_ids >= 0]]))  # Sorted, so rows are found by searchsorted
+    arrays = {
+        "question_embeddings": question_table.cpu().half().numpy(),
+        "topk_ids": topk_ids.int().numpy(),
+        "topk_scores": torch.cat(topk_scores).half().numpy(),
+        "ref_ids": ref_ids.int().numpy(),
+        "reward_penalties": reward_penalties.cpu().float().numpy(),
+        "row_ids": row_ids.int().numpy(),
+        "candidate_rows": candidate_store.rows(row_ids.numpy()).half().numpy()
+    }
+    for name, array in arrays.items():
+        np.save(os.path.join(log_dir, f"{name}.npy"), array)
+    with open(meta_path, "w") as f:
+        json.dump(log_meta, f)
+    print(f"Logged {len(question_table)} questions x top-{log_meta['top_k']} ({len(row_ids)} candidate rows) to {log_dir}")
+    return log_dir
+
+# Environment over an offline log: an adjusted question is scored only against its logged top-k and its reference,
+# and the reference's position is the number of logged candidates that now outscore it. References outside the
+# logged top-k can move into it, but candidates outside it are assumed to stay below the reference.
+class OfflineRankingEnvironment(VectorizedRankingEnvironment):
+    def __init__(self, log_dir: str, num_envs: int = CONFIG.RL_NUM_ENVS, task: str = "qa", seed: int = 42, device=CONFIG.DEVICE,
+                 reward_params: dict = None):
+        arrays = {name: torch.from_numpy(np.load(os.path.join(log_dir, f"{name}.npy")))
+                  for name in ["question_embeddings", "topk_ids", "ref_ids", "reward_penalties", "row_ids", "candidate_rows"]}
+        ref_ids = arrays["ref_ids"].long().to(device)
+        super(OfflineRankingEnvironment, self).__init__(arrays["question_embeddings"].float().to(device), None, ref_ids, None,
+                                                        num_envs=num_envs, task=task, seed=seed,
+                                                        reward_penalties=arrays["reward_penalties"].to(device), reward_params=reward_params)
+        row_ids = arrays["row_ids"].long().to(device)
+        self.candidate_rows = arrays["candidate_rows"].float().to(device)
+        self.topk_ids = arrays["topk_ids"].long().to(device)
+        self.topk_rows = torch.searchsorted(row_ids, self.topk_ids)
+        self.ref_rows = torch.searchsorted(row_ids, ref_ids.clamp(min=0))
+
+    def rewards_for(self, ids: torch.Tensor, actions: torch.Tensor) -> torch.Tensor:
+        adjusted_embeddings = self.question_table[ids] + actions
+        topk_scores = torch.bmm(self.candidate_rows[self.topk_rows[ids]], adjusted_embeddings.unsqueeze(2)).squeeze(2)
+        ref_scores = (self.candidate_rows[self.ref_rows[ids]] * adjusted_embeddings).sum(dim=1, keepdim=True)
+        is_reference = self.topk_ids[ids] == self.ref_ids[ids].unsqueeze(1)
+        positions = ((topk_scores > ref_scores) & ~is_reference).sum(dim=1)
+        return position_rewards(positions, self.ref_ids[ids], penalties=self.reward_penalties[ids], **self.reward_params)
+
+# Train a learner for num_epochs passes over an offline log; neither the question encoder, the full store nor
+# the sentence transformer is touched, so a run costs small batched matmuls only
+def train_ppo_offline(log_dir: str, learner: PPOLearner, task: str = "qa", num_epochs: int = CONFIG.OFFLINE_EPOCHS,
+                      steps_per_episode: int = 50, reward_params: dict = None):
+    env = OfflineRankingEnvironment(log_dir, task=task, reward_params=reward_params)
+    episodes_per_epoch = max(1, len(env.question_table) // (env.num_envs * steps_per_episode))
+    return train_ppo_vectorized(env, learner, num_episodes=num_epochs * episodes_per_epoch, steps_per_episode=steps_per_episode)
+
+# PPO Hyperparameter Sweep (process pool, early stopping)
+
+# Search space: each key maps to the values a trial may take. Learner keys feed PPOLearner and the optimizers,
+# reward keys feed position_rewards through the environment.
+SWEEP_LEARNER_KEYS = ["lr", "clip_epsilon", "epochs", "minibatch_size", "action_std", "gamma", "lam"]
+SWEEP_REWARD_KEYS = ["pool_size", "mrr_scale", "exact_match_bonus", "exploration_bonus"]
+ppo_search_space = {
+    "lr": [1e-5, 5e-5, 1e-4, 3e-4],
+    "clip_epsilon": [0.1, 0.2, 0.3],
+    "epochs": [3, 5, 10],
+    "gamma": [0.9, 0.99],
+    "lam": [0.9, 0.95],
+    "action_std": [0.05, 0.1, 0.2],
+    "mrr_scale": [1.0, 2.0],
+    "exact_match_bonus": [0.0, 0.5, 1.0]
+}
+
+# Frozen inputs shared by every trial process; set before the pool forks so children inherit the same
+# shared-memory table instead of receiving a copy per trial
+sweep_shared = {}
+
+def init_sweep_worker():
+    torch.set_num_threads(1)
+    sweep_shared["candidate_store"] = open_embedding_store(sweep_shared["store_path"])
+
+# Train one trial for a rung of episodes on CPU, resuming from its previous state, and score the deterministic
+# policy (mean adjustment) over every question under the default reward. Returns (trial_id, score, state).
+def run_sweep_trial(trial_id: int, params: dict, rung: int, num_episodes: int, steps_per_episode: int, state: dict = None):
+    torch.manual_seed(1000 * trial_id + rung)
+    question_table = sweep_shared["question_table"]
+    reward_params = {k: v for k, v in params.items() if k in SWEEP_REWARD_KEYS}
+    env = VectorizedRankingEnvironment(question_table, None, sweep_shared["ref_ids"], sweep_shared["candidate_store"],
+                                       task=sweep_shared["task"], seed=1000 * trial_id + rung,
+                                       reward_penalties=sweep_shared["reward_penalties"], reward_params=reward_params)
+    policy = PolicyNetwork(input_dim=question_table.size(1), hidden_dim=256)
+    value_network = PolicyNetwork(input_dim=question_table.size(1), hidden_dim=256)
+    lr = params.get("lr", 5e-5)
+    learner = PPOLearner(policy, value_network, torch.optim.Adam(policy.parameters(), lr=lr), torch.optim.Adam(value_network.parameters(), lr=lr),
+                         **{k: v for k, v in params.items() if k in SWEEP_LEARNER_KEYS and k != "lr"})
+    if state is not None:
+        for name in ["policy", "value_network", "policy_optimizer", "value_optimizer"]:
+            getattr(learner, name).load_state_dict(state[name])
+    train_ppo_vectorized(env, learner, num_episodes=num_episodes, steps_per_episode=steps_per_episode, verbose=False)
+    env.reward_params = {}
+    rewards = []
+    with torch.no_grad():
+        for question_ids in torch.arange(len(question_table)).split(env.num_envs):
+            rewards.append(env.rewards_for(question_ids, learner.policy(question_table[question_ids])))
+    state = {name: getattr(learner, name).state_dict() for name in ["policy", "value_network", "policy_optimizer", "value_optimizer"]}
+    return trial_id, torch.cat(rewards).mean().item(), state
+
+# Sample num_trials configurations, train them rung by rung in a process pool and stop poor trials early.
+# rule="halving" keeps the best 1/eta of the survivors after each rung (successive halving); rule="median"
+# stops trials scoring below the median of the survivors at that rung. Every trial's per-rung scores go to one
+# CSV table, sorted by final score.
+def run_ppo_sweep(search_space: dict, task: str, question_table: torch.Tensor, ref_ids: torch.Tensor, reward_penalties: torch.Tensor,
+                  store_path: str, num_trials: int = CONFIG.SWEEP_NUM_TRIALS, rule: str = "halving", eta: int = 2,
+                  num_rungs: int = CONFIG.SWEEP_NUM_RUNGS, rung_episodes: int = CONFIG.SWEEP_RUNG_EPISODES, steps_per_episode: int = 50,
+                  num_workers: int = CONFIG.SWEEP_NUM_WORKERS, seed: int = 42, results_path: str = None) -> pd.DataFrame:
+    if rule not in ("halving", "median"):
+        raise ValueError(f"Unknown early-stopping rule: {rule}")
+    rng = random.Random(seed)
+    trials = [{key: rng.choice(values) for key, values in search_space.items()} for _ in range(num_trials)]
+    sweep_shared.update({
+        "task": task,
+        "question_table": question_table.cpu().share_memory_(),
+        "ref_ids": ref_ids.cpu().share_memory_(),
+        "reward_penalties": reward_penalties.cpu().share_memory_(),
+        "store_path": store_path
+    })
+    scores = {trial_id: [] for trial_id in range(num_trials)}
+    states = {trial_id: None for trial_id in range(num_trials)}
+    survivors = list(range(num_trials))
+    ctx = mp.get_context("fork")
+    with ctx.Pool(processes=num_workers, initializer=init_sweep_worker) as pool:
+        for rung in range(num_rungs):
+            jobs = [(trial_id, trials[trial_id], rung, rung_episodes, steps_per_episode, states[trial_id]) for trial_id in survivors]
+            for trial_id, score, state in pool.starmap(run_sweep_trial, jobs):
+                scores[trial_id].append(score)
+                states[trial_id] = state
+            rung_scores = {trial_id: scores[trial_id][-1] for trial_id in survivors}
+            print(f"{task} sweep rung {rung + 1}/{num_rungs}: {len(survivors)} trials, best {max(rung_scores.values()):.4f}, "
+                  f"median {float(np.median(list(rung_scores.values()))):.4f}")
+            if rung == num_rungs - 1:
+                break
+            if rule == "halving":
+                ranked = sorted(survivors, key=lambda trial_id: rung_scores[trial_id], reverse=True)
+                survivors = ranked[:max(1, len(ranked) // eta)]
+            else:
+                median = float(np.median(list(rung_scores.values())))
+                survivors = [trial_id for trial_id in survivors if rung_scores[trial_id] >= median]
+    rows = []
+    for trial_id, params in enumerate(trials):
+        row = {"trial": trial_id, **params, "rungs_completed": len(scores[trial_id]), "final_score": scores[trial_id][-1],
+               "status": "completed" if len(scores[trial_id]) == num_rungs else "stopped"}
+        row.update({f"score_rung_{rung + 1}": score for rung, score in enumerate(scores[trial_id])})
+        rows.append(row)
+    results = pd.DataFrame(rows).sort_values(["rungs_completed", "final_score"], ascending=False)
+    results_path = results_path or os.path.join(CONFIG.BASE_PATH, f"ppo_sweep_{task}_v4.csv")
+    results.to_csv(results_path, index=False)
+    print(f"Saved {task} sweep results at {results_path}")
+    return results
+
+# Query Adapter Export
+
+# Serving form of a trained policy: the question embedding plus the policy's mean adjustment, i.e. what the
+# environment ranks with once the exploration noise is dropped. Parameter names match PolicyNetwork.
+class QueryAdapter(torch.nn.Module):
+    def __init__(self, input_dim=768, hidden_dim=256):
+        super(QueryAdapter, self).__init__()
+        self.network = torch.nn.Sequential(
+            torch.nn.Linear(input_dim, hidden_dim),
+            torch.nn.ReLU(),
+            torch.nn.Linear(hidden_dim, input_dim),
+            torch.nn.Tanh()
+        )
+
+    def forward(self, question_embeddings):
+        return question_embeddings + self.network(question_embeddings)
+
+# Question encoder and adapter as one module returning the adjusted embedding, for torch.jit.trace
+class FusedQueryEncoder(torch.nn.Module):
+    def __init__(self, question_encoder, adapter):
+        super(FusedQueryEncoder, self).__init__()
+        self.question_encoder = question_encoder
+        self.adapter = adapter
+
+    def forward(self, input_ids, attention_mask):
+        return self.adapter(self.question_encoder(input_ids=input_ids, attention_mask=attention_mask, return_dict=False)[0])
+
+# Save a trained policy as query_adapter_rl_{task}_v4: safetensors weights plus a config tying the adapter to the
+# question encoder and candidate store it was trained on. With trace=True the fused encoder is traced, checked against eager and saved too.
+def export_query_adapter(policy, question_encoder, candidate_store, task: str, trace: bool = CONFIG.QUERY_ADAPTER_TRACE) -> str:
+    adapter_dir = os.path.join(CONFIG.BASE_PATH, f"query_adapter_rl_{task}_v4")
+    os.makedirs(adapter_dir, exist_ok=True)
+    input_dim, hidden_dim = policy.network[0].in_features, policy.network[0].out_features
+    adapter = QueryAdapter(input_dim=input_dim, hidden_dim=hidden_dim).to(CONFIG.DEVICE)
+    adapter.load_state_dict(policy.state_dict())
+    adapter.eval()
+    save_file({k: v.detach().cpu().contiguous() for k, v in adapter.state_dict().items()}, os.path.join(adapter_dir, "adapter.safetensors"))
+    adapter_config = {
+        "task": task,
+        "input_dim": input_dim,
+        "hidden_dim": hidden_dim,
+        "question_encoder_fingerprint": model_fingerprint(question_encoder),
+        "candidate_store_fingerprint": candidate_store.encoder_fingerprint,
+        "traced": None
+    }
+    if trace:
+        question_encoder.eval()
+        fused = FusedQueryEncoder(question_encoder, adapter).eval()
+        example = question_tokenizer(["who wrote the origin of species?"], return_tensors="pt").to(CONFIG.DEVICE)
+        check = question_tokenizer(["what is the capital city of the country with the largest population?"], return_tensors="pt").to(CONFIG.DEVICE)
         with torch.no_grad():
-            question_embedding = self.question_encoder(**question_inputs).pooler_output  # Shape: (1, 768)
-        adjusted_embedding = question_embedding + action  # Adjust embedding
-        similarities = torch.matmul(adjusted_embedding, self.candidate_embeddings.T)  # Shape: (1, num_candidates)
-        rankings = torch.argsort(similarities, dim=1, descending=True)
-        ref = self.current_batch["answer"][self.current_idx]
-        done = False
-        reward = compute_reward(rankings[0].cpu(), ref)
-        print(f"Task: {self.task}, Reward: {reward:.4f}")
-
-        # Move to next sample
-        self.current_idx += 1
-        if self.current_idx >= len(self.current_batch["answer"]):
-            try:
-                self.current_batch = next(self.batch_iterator)
-                self.current_idx = 0
-            except StopIteration:
-                done = True
-
-        # Get next state
-        if not done:
-            next_question_inputs = {
-                "input_ids": self.current_batch["dpr_input_ids"][self.current_idx].to(CONFIG.DEVICE).unsqueeze(0),
-                "attention_mask": self.current_batch["dpr_attention_mask"][self.current_idx].to(CONFIG.DEVICE).unsqueeze(0)
-            }
-            with torch.no_grad():
-                next_state = self.question_encoder(**next_question_inputs).pooler_output
-        else:
-            next_state = None
-
-        return next_state, reward, done
-
-# PPO Implementation
-def compute_gae(rewards, values, next_value, gamma=0.99, lam=0.95):
-    advantages = []
-    gae = 0
-    rewards = rewards + [next_value]
-    values = values + [next_value]
-    for t in reversed(range(len(rewards) - 1)):
-        delta = rewards[t] + gamma * values[t + 1] - values[t]
-        gae = delta + gamma * lam * gae
-        advantages.insert(0, gae)
-    return advantages
-
-def ppo_update(policy, optimizer, states, actions, old_log_probs, advantages, returns, clip_epsilon=0.1, epochs=5):
-    for _ in range(epochs):
-        policy.train()
-        new_log_probs = []
-        for state, action in zip(states, actions):
-            state = state.to(CONFIG.DEVICE)
-            action = action.to(CONFIG.DEVICE)
-            adjustment = policy(state)
-            dist = torch.distributions.Normal(adjustment, 0.1)
-            log_prob = dist.log_prob(action).sum(dim=-1)
-            new_log_probs.append(log_prob)
-        new_log_probs = torch.stack(new_log_probs)
-
-        # Compute ratio
-        ratios = torch.exp(new_log_probs - torch.stack(old_log_probs))
-
-        # Compute surrogate loss
-        surr1 = ratios * torch.tensor(advantages, device=CONFIG.DEVICE)
-        surr2 = torch.clamp(ratios, 1 - clip_epsilon, 1 + clip_epsilon) * torch.tensor(advantages, device=CONFIG.DEVICE)
-        policy_loss = -torch.min(surr1, surr2).mean()
-
-        # Update policy
-        optimizer.zero_grad()
-        policy_loss.backward()
-        optimizer.step()
-        print(f"Policy Loss: {policy_loss.item():.4f}")
-
-    return policy_loss.item()
+            traced = torch.jit.trace(fused, (example["input_ids"], example["attention_mask"]))
+            eager_out = fused(check["input_ids"], check["attention_mask"])
+            traced_out = traced(check["input_ids"], check["attention_mask"])
+        if not torch.allclose(eager_out, traced_out, atol=1e-4):
+            raise ValueError(f"Traced query encoder for {task} diverges from eager (max diff {(eager_out - traced_out).abs().max().item():.2e})")
+        traced.save(os.path.join(adapter_dir, "query_encoder_traced.pt"))
+        adapter_config["traced"] = "query_encoder_traced.pt"
+    with open(os.path.join(adapter_dir, "adapter_config.json"), "w") as f:
+        json.dump(adapter_config, f)
+    return adapter_dir
 
 print("RL helper functions defined.")
 
-# Test Updated Reward Function and Re-Run RL Fine-Tuning for Triple Task
+# Test Updated Reward Function and Re-Run RL Fine-Tuning for QA and Triple Tasks
 
 # Test the updated reward function on a few examples from triple data with a larger candidate pool
 print("Testing updated reward function on triple data...")
@@ -751,7 +926,7 @@ question_inputs = {
 }
 with torch.no_grad():
     question_embeddings = question_encoder_triple(**question_inputs).pooler_output
-    similarities = torch.matmul(question_embeddings, candidate_embeddings_triple.T)
+    similarities = candidate_store_triple.scores(question_embeddings)
     rankings = torch.argsort(similarities, dim=1, descending=True).cpu()
 
 # Temporarily increase candidate pool for testing
@@ -760,87 +935,91 @@ for rank, ref in zip(rankings, test_references):
     reward = compute_reward(rank, ref)
     print(f"Reference: {ref}, Reward: {reward:.4f}")
 
-# Re-run RL fine-tuning for the triple task with the updated reward function
+# Re-run RL fine-tuning for the QA and triple tasks with the updated reward function
+policy_qa = PolicyNetwork(input_dim=768, hidden_dim=256).to(CONFIG.DEVICE)
+value_network_qa = PolicyNetwork(input_dim=768, hidden_dim=256).to(CONFIG.DEVICE)
+policy_optimizer_qa = torch.optim.Adam(policy_qa.parameters(), lr=5e-5)
+value_optimizer_qa = torch.optim.Adam(value_network_qa.parameters(), lr=5e-5)
 policy_triple = PolicyNetwork(input_dim=768, hidden_dim=256).to(CONFIG.DEVICE)
 value_network_triple = PolicyNetwork(input_dim=768, hidden_dim=256).to(CONFIG.DEVICE)
 policy_optimizer_triple = torch.optim.Adam(policy_triple.parameters(), lr=5e-5)
 value_optimizer_triple = torch.optim.Adam(value_network_triple.parameters(), lr=5e-5)
 
-# Create environment for triple task
-triple_env = RankingEnvironment(ctx_encoder_triple, question_encoder_triple, all_candidates, candidate_embeddings_triple, triple_val_loader_v4, task="triple")
+# Encode the validation questions once; reference penalties are fixed per question, so compute them once too
+qa_question_table, qa_references, qa_ref_ids = build_question_embedding_table(question_encoder_qa, qa_val_loader_v4, all_candidates)
+triple_question_table, triple_references, triple_ref_ids = build_question_embedding_table(question_encoder_triple, triple_val_loader_v4, all_candidates)
+rl_tasks = {
+    "qa": {
+        "learner": PPOLearner(policy_qa, value_network_qa, policy_optimizer_qa, value_optimizer_qa),
+        "question_table": qa_question_table, "references": qa_references, "ref_ids": qa_ref_ids,
+        "reward_penalties": reward_service.penalty_table(qa_references), "candidate_store": candidate_store_qa,
+        "store_path": candidate_store_qa.path
+    },
+    "triple": {
+        "learner": PPOLearner(policy_triple, value_network_triple, policy_optimizer_triple, value_optimizer_triple),
+        "question_table": triple_question_table, "references": triple_references, "ref_ids": triple_ref_ids,
+        "reward_penalties": reward_service.penalty_table(triple_references), "candidate_store": candidate_store_triple,
+        "store_path": candidate_store_triple.path
+    }
+}
 
 num_episodes = 500
 max_steps_per_episode = 50
 
-print("Re-running fine-tuning DPR with PPO on triple data...")
-triple_policy_losses = []
-triple_value_losses = []
-for episode in range(num_episodes):
-    print(f"Triple Episode {episode + 1}/{num_episodes}")
-    state = triple_env.reset()
-    if state.dim() == 1:
-        state = state.unsqueeze(0)
-    states, actions, rewards, old_log_probs, values = [], [], [], [], []
-    done = False
-    episode_steps = 0
-
-    while not done and episode_steps < max_steps_per_episode:
-        state = state.to(CONFIG.DEVICE)
-        with torch.no_grad():
-            adjustment = policy_triple(state)
-            dist = torch.distributions.Normal(adjustment, 0.1)
-            action = dist.sample()
-            log_prob = dist.log_prob(action).sum(dim=-1)
-            value = value_network_triple(state).mean()
-
-        next_state, reward, done = triple_env.step(action)
-
-        if next_state is not None and next_state.dim() == 1:
-            next_state = next_state.unsqueeze(0)
-
-        states.append(state)
-        actions.append(action)
-        rewards.append(reward)
-        old_log_probs.append(log_prob)
-        values.append(value.item())
-
-        state = next_state
-        episode_steps += 1
-
-    # Compute returns and advantages
-    with torch.no_grad():
-        next_value = value_network_triple(state).mean().item() if state is not None else 0.0
-    advantages = compute_gae(rewards, values, next_value)
-    returns = [r + next_value for r in rewards]
-
-    # Update policy and value network
-    policy_loss = ppo_update(policy_triple, policy_optimizer_triple, states, actions, old_log_probs, advantages, returns)
-    triple_policy_losses.append(policy_loss)
-
-    # Update value network
-    value_loss = 0
-    for state, ret in zip(states, returns):
-        state = state.to(CONFIG.DEVICE)
-        value = value_network_triple(state).mean()
-        value_loss += (value - ret) ** 2
-    value_loss = value_loss / len(states)
-    value_optimizer_triple.zero_grad()
-    value_loss.backward()
-    value_optimizer_triple.step()
-    triple_value_losses.append(value_loss.item())
-    print(f"Triple Value Loss: {value_loss.item():.4f}")
-
-# Save fine-tuned DPR models for triple task
+# Optionally tune PPO and reward parameters per task first; the best trial that survived every rung replaces
+# the default learner and reward settings for the full run
+if CONFIG.RUN_PPO_SWEEP:
+    for task, setup in rl_tasks.items():
+        sweep_results = run_ppo_sweep(ppo_search_space, task, setup["question_table"], setup["ref_ids"], setup["reward_penalties"],
+                                      setup["store_path"], steps_per_episode=max_steps_per_episode)
+        best = {key: type(values[0])(sweep_results.iloc[0][key]) for key, values in ppo_search_space.items()}
+        print(f"Best {task} sweep parameters: {best}")
+        policy, value_network = setup["learner"].policy, setup["learner"].value_network
+        lr = best.get("lr", 5e-5)
+        setup["learner"] = PPOLearner(policy, value_network, torch.optim.Adam(policy.parameters(), lr=lr),
+                                      torch.optim.Adam(value_network.parameters(), lr=lr),
+                                      **{k: v for k, v in best.items() if k in SWEEP_LEARNER_KEYS and k != "lr"})
+        setup["reward_params"] = {k: v for k, v in best.items() if k in SWEEP_REWARD_KEYS}
+
+print("Re-running fine-tuning DPR with PPO on QA and triple data...")
+if CONFIG.RL_TRAINING_MODE == "offline":
+    rl_losses = {}
+    for task, setup in rl_tasks.items():
+        question_encoder = question_encoder_qa if task == "qa" else question_encoder_triple
+        log_dir = log_offline_rankings(os.path.join(CONFIG.BASE_PATH, f"offline_rl_log_{task}_v4"), setup["question_table"],
+                                       setup["ref_ids"], setup["reward_penalties"], setup["candidate_store"],
+                                       model_fingerprint(question_encoder))
+        rl_losses[task] = train_ppo_offline(log_dir, setup["learner"], task=task, steps_per_episode=max_steps_per_episode,
+                                            reward_params=setup.get("reward_params"))
+elif CONFIG.RL_PARALLEL_ROLLOUTS:
+    rl_losses = train_ppo_parallel(rl_tasks, num_episodes=num_episodes, steps_per_episode=max_steps_per_episode)
+else:
+    rl_losses = {}
+    for task, setup in rl_tasks.items():
+        env = VectorizedRankingEnvironment(setup["question_table"], setup["references"], setup["ref_ids"], setup["candidate_store"],
+                                           task=task, reward_penalties=setup["reward_penalties"], reward_params=setup.get("reward_params"))
+        rl_losses[task] = train_ppo_vectorized(env, setup["learner"], num_episodes=num_episodes, steps_per_episode=max_steps_per_episode)
+qa_policy_losses, qa_value_losses = rl_losses["qa"]
+triple_policy_losses, triple_value_losses = rl_losses["triple"]
+
+# Export the trained policies as query adapters applied on top of the saved question encoders
+for task, question_encoder in [("qa", question_encoder_qa), ("triple", question_encoder_triple)]:
+    adapter_dir = export_query_adapter(rl_tasks[task]["learner"].policy, question_encoder, rl_tasks[task]["candidate_store"], task)
+    print(f"Saved {task} query adapter at {adapter_dir}")
+
+# Save DPR models for the QA and triple tasks under the RL names Step 4 loads
+ctx_encoder_qa.save_pretrained(os.path.join(CONFIG.BASE_PATH, "dpr_ctx_encoder_rl_qa_v4"))
+question_encoder_qa.save_pretrained(os.path.join(CONFIG.BASE_PATH, "dpr_question_encoder_rl_qa_v4"))
 ctx_encoder_triple.save_pretrained(os.path.join(CONFIG.BASE_PATH, "dpr_ctx_encoder_rl_triple_v4"))
 question_encoder_triple.save_pretrained(os.path.join(CONFIG.BASE_PATH, "dpr_question_encoder_rl_triple_v4"))
-print("Saved RL fine-tuned DPR models for triple task.")
+print("Saved RL fine-tuned DPR models for QA and triple tasks.")
 
 # Save RL Metrics and Artifacts
 
 # Save RL metrics
 rl_metrics = {
-    "qa_policy_losses": [],  # Placeholder for QA, as only triple task was re-run
-    "qa_value_losses": [],   # Placeholder
+    "qa_policy_losses": qa_policy_losses,
+    "qa_value_losses": qa_value_losses,
     "triple_policy_losses": triple_policy_losses,
     "triple_value_losses": triple_value_losses
 }
@@ -850,16 +1029,11 @@ with open(rl_metrics_path, "w") as f:
     json.dump(rl_metrics, f)
 print(f"Saved RL metrics at {rl_metrics_path}")
 
-# Save updated candidate embeddings
-with torch.no_grad():
-    # Limit candidate pool size for faster encoding
-    eval_candidates = all_candidates[:1000]  # Limit to 1000 candidates
-    candidate_inputs = ctx_tokenizer(eval_candidates, return_tensors="pt", padding=True, truncation=True, max_length=CONFIG.MAX_LENGTH)
-    candidate_inputs = {k: v.to(CONFIG.DEVICE) for k, v in candidate_inputs.items()}
-    candidate_embeddings_qa = ctx_encoder_qa(**candidate_inputs).pooler_output
-    candidate_embeddings_triple = ctx_encoder_triple(**candidate_inputs).pooler_output
-torch.save(candidate_embeddings_qa, os.path.join(save_path, 'dpr_candidate_embeddings_rl_qa_v4.pt'))
-torch.save(candidate_embeddings_triple, os.path.join(save_path, 'dpr_candidate_embeddings_rl_triple_v4.pt'))
+# Save updated candidate embeddings over the full candidate list (Step 4 evaluates against every candidate)
+build_candidate_store(ctx_encoder_qa, ctx_tokenizer, all_candidates, os.path.join(save_path, 'dpr_candidate_embeddings_rl_qa_v4.emb'),
+                      CONFIG.MAX_LENGTH, dtype=CONFIG.EMBEDDING_STORE_DTYPE)
+build_candidate_store(ctx_encoder_triple, ctx_tokenizer, all_candidates, os.path.join(save_path, 'dpr_candidate_embeddings_rl_triple_v4.emb'),
+                      CONFIG.MAX_LENGTH, dtype=CONFIG.EMBEDDING_STORE_DTYPE)
 
 print("Updated candidate embeddings saved for Version 4.")
 
@@ -18,6 +18,7 @@ Original file is located at
 !pip install huggingface-hub==0.25.2
 !pip install nltk==3.8.1 rouge-score==0.1.2 bert-score==0.3.13 -q
 !pip install tqdm==4.66.5 -q
+!pip install accelerate==0.30.1 safetensors==0.4.3 -q
 !pip install lime shap -q
 
 # Setup and Imports
@@ -25,13 +26,15 @@ Original file is located at
 import pandas as pd
 import numpy as np
 import torch
-from torch.utils.data import Dataset, DataLoader
+import torch.multiprocessing as mp
+from torch.utils.data import DataLoader, Subset
 from transformers import (
     BartForConditionalGeneration, BartTokenizer,
     DPRContextEncoder, DPRQuestionEncoder,
     DPRContextEncoderTokenizer, DPRQuestionEncoderTokenizer
 )
 from sentence_transformers import SentenceTransformer
+from sentence_transformers.cross_encoder import CrossEncoder
 from sklearn.model_selection import train_test_split
 import os
 from google.colab import drive
@@ -42,10 +45,19 @@ from bert_score import score as bert_score
 import string
 import nltk
 import json
+import sys
+import hashlib
 import pickle
+import time
+import copy
+import math
+from statistics import NormalDist
+import io
+import gc
 import lime
 import lime.lime_text
 import shap
+from safetensors.torch import load_file
 
 nltk.download('wordnet')
 nltk.download('punkt')
@@ -56,7 +68,10 @@ drive.mount('/content/drive')
 # Configuration
 class Config:
     BASE_PATH = "/content/drive/MyDrive/LJMU-Datasets"
-    DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    CODE_PATH = os.path.join(BASE_PATH, "code_v4")  # Folder holding the shared Version3/Python modules (prediction_cache.py, embedding_store.py, artifact_manifest.py, model_loading.py)
+    INFERENCE_MODE = "fp32"  # "fp32" or "int8" (dynamic int8 quantization of Linear layers, CPU only)
+    RUN_QUANTIZATION_REPORT = False  # Reload both model sets on CPU and compare fp32 vs int8 accuracy and latency
+    DEVICE = torch.device("cuda" if torch.cuda.is_available() and INFERENCE_MODE == "fp32" else "cpu")
     BART_MODEL_NAME = "facebook/bart-base"
     DPR_CTX_MODEL_NAME = "facebook/dpr-ctx_encoder-single-nq-base"
     DPR_QUESTION_MODEL_NAME = "facebook/dpr-question_encoder-single-nq-base"
@@ -67,6 +82,43 @@ class Config:
     SUBSET_SIZE = 500
     HOTPOTQA_MAX_SAMPLES = 1000
     WIKIDATA_SUBSET_SIZE = 30000
+    EMBEDDING_STORE_DTYPE = "float16"  # "float16" or "int8" (per-row scale) for candidate embedding stores
+    USE_PREDICTION_CACHE = True
+    PREDICTION_CACHE_DIR = os.path.join(BASE_PATH, "prediction_cache_v4")
+    PREDICTION_CACHE_TOP_SCORES = 100  # Number of top DPR scores stored per question
+    QUANTIZED_MODEL_DIR = os.path.join(BASE_PATH, "quantized_models_v4")
+    CROSS_ENCODER_MODEL_NAME = "cross-encoder/ms-marco-MiniLM-L-6-v2"  # Fallback when Step 2's fine-tuned re-ranker is missing
+    CROSS_ENCODER_MAX_LENGTH = 64
+    CROSS_ENCODER_BATCH_SIZE = 64
+    RETRIEVE_TOP_K = 30  # Stage 1: candidates DPR pulls from the store per question
+    RERANK_TOP_K = 10  # Stage 2: head of the DPR list scored by the cross-encoder
+    RERANK_SKIP_MARGIN = None  # Skip stage 2 when DPR's top-1 leads top-2 by at least this score (None = always re-rank)
+    RERANK_SCORE_WINDOW = None  # Only re-rank candidates within this DPR score of the top-1 (None = whole budget)
+    BOOTSTRAP_RESAMPLES = 1000  # Question-level bootstrap resamples for retrieval confidence intervals
+    BOOTSTRAP_CONFIDENCE = 0.95
+    EVAL_MODE = "full"  # "full" (whole validation sets) or "budgeted" (stratified sample sized by EVAL_TARGET_HALF_WIDTH)
+    EVAL_BUDGET_SECONDS = 600  # Per-task time budget for the budgeted sample's per-example metrics
+    EVAL_TARGET_HALF_WIDTH = 0.02  # Target confidence-interval half-width for every budgeted metric
+    EVAL_CONFIDENCE = 0.95
+    EVAL_PILOT_PER_STRATUM = 5  # Pilot rounds of one example per stratum (stopped early by EVAL_BUDGET_SECONDS) to estimate per-stratum variance and cost
+    EXPLANATION_SCORING = "likelihood"  # "likelihood" (log p(answer | text), one float per text) or "vocab" (legacy averaged softmax)
+    EXPLANATION_TARGET = "prediction"  # Answer scored in likelihood mode: "prediction" (model's own answer) or "reference"
+    EXPLANATION_BATCH_SIZE = 32  # Perturbed texts per BART forward when scoring explanations
+    EXPLANATION_NUM_EXAMPLES = 200  # Validation examples explained per task and explainer (None = full validation set)
+    EXPLANATION_NUM_WORKERS = max(1, (os.cpu_count() or 2) - 1)  # Forked CPU processes for LIME/SHAP (1 = explain in-process)
+    LIME_BATCH_SAMPLES = 32  # Perturbations drawn between adaptive LIME refits
+    LIME_MIN_SAMPLES = 64
+    LIME_MAX_SAMPLES = 1000
+    LIME_TOLERANCE = 0.05  # Max top-k weight change, relative to the largest weight, for a refit to count as stable
+    LIME_STABLE_ROUNDS = 2  # Consecutive stable refits before adaptive LIME stops
+    SHAP_NUM_SAMPLES = None  # KernelSHAP coalitions per example (None = 2 * words + 2048 as in shap; all of them when that covers every coalition)
+    GRADIENT_METHOD = "integrated_gradients"  # "integrated_gradients" or "grad_x_input" (one backward pass)
+    IG_STEPS = 32  # Integrated Gradients interpolation points between the zero baseline and the input
+    IG_BATCH_SIZE = 16  # Interpolation points per forward/backward pass
+    USE_EXPLANATION_STORE = True
+    EXPLANATION_STORE_PATH = os.path.join(BASE_PATH, "explanation_store_v4.jsonl")
+    CAPTURE_ATTENTION_ROLLOUT = True  # Attach an attention-rollout relevance per input token to qualitative samples and answer_query results (bulk evaluation never captures)
+    USE_QUERY_ADAPTER = True  # Apply Step 3's trained PPO policy to question embeddings at retrieval time
 
 CONFIG = Config()
 print(f"Using device: {CONFIG.DEVICE}")
@@ -74,6 +126,12 @@ print(f"Using device: {CONFIG.DEVICE}")
 # Clear GPU memory
 torch.cuda.empty_cache()
 
+# Shared candidate embedding store, artifact manifest and model loading (Version3/Python, copied to CONFIG.CODE_PATH)
+sys.path.insert(0, CONFIG.CODE_PATH)
+from embedding_store import build_candidate_store
+from artifact_manifest import TOKENIZED_FIELDS, load_artifact_manifest, load_manifest_candidates, build_manifest_loaders
+from model_loading import load_pretrained_fast, report_model_load_times
+
 # Load Artifacts from Step 3 and Rebuild DataLoaders
 
 import pickle
@@ -81,144 +139,96 @@ import os
 
 save_path = '/content/drive/MyDrive/bert_retrieval_artifacts_v4'
 
-# Define file paths (ensure correct naming and directory)
-qa_train_path_v4 = os.path.join(CONFIG.BASE_PATH, "qa_train_v4.csv")
-qa_val_path_v4 = os.path.join(CONFIG.BASE_PATH, "qa_val_v4.csv")
-triple_train_path_v4 = os.path.join(CONFIG.BASE_PATH, "triple_train_v4.csv")
-
-# Check if files exist, if not, attempt to locate or re-generate
-if not os.path.exists(qa_train_path_v4) or not os.path.exists(qa_val_path_v4) or not os.path.exists(triple_train_path_v4):
-    print("One or more dataset files not found. Attempting to locate or re-generate...")
-    # Alternative path
-    qa_train_path_alt = os.path.join(CONFIG.BASE_PATH, "qa_train.csv")
-    qa_val_path_alt = os.path.join(CONFIG.BASE_PATH, "qa_val.csv")
-    triple_train_path_alt = os.path.join(CONFIG.BASE_PATH, "triple_train.csv")
-
-    if os.path.exists(qa_train_path_alt) and os.path.exists(qa_val_path_alt) and os.path.exists(triple_train_path_alt):
-        print("Found alternative files without _v4 suffix. Using them instead.")
-        qa_train_path_v4 = qa_train_path_alt
-        qa_val_path_v4 = qa_val_path_alt
-        triple_train_path_v4 = triple_train_path_alt
-    else:
-        print("Alternative files not found. Ensure Step 1 was run to generate qa_train_v4.csv, qa_val_v4.csv, and triple_train_v4.csv.")
-        raise FileNotFoundError("Required dataset files not found.")
-
-# Load raw datasets
-qa_train_df_v4 = pd.read_csv(qa_train_path_v4)
-qa_val_df_v4 = pd.read_csv(qa_val_path_v4)
-triple_train_df_v4 = pd.read_csv(triple_train_path_v4)
-
-# Split triple_train_df into train and validation sets (80/20)
-triple_train_df_v4, triple_val_df_v4 = train_test_split(triple_train_df_v4, train_size=0.8, random_state=42)
-print(f"Triple Train Size (Version 4): {len(triple_train_df_v4)}, Triple Val Size (Version 4): {len(triple_val_df_v4)}")
-
-# Load all_candidates
-with open(os.path.join(save_path, 'all_candidates_v4.pkl'), 'rb') as f:
-    all_candidates = pickle.load(f)
-
-# Define RetrievalDataset class
-class RetrievalDataset(Dataset):
-    def __init__(self, df: pd.DataFrame, bart_tokenizer: BartTokenizer, dpr_question_tokenizer: DPRQuestionEncoderTokenizer,
-                 max_length: int = 256, task: str = "qa", candidate_objects: list = None):
-        self.bart_tokenizer = bart_tokenizer
-        self.dpr_question_tokenizer = dpr_question_tokenizer
-        self.max_length = max_length
-        self.task = task
-        self.data = df
-        self.candidate_objects = candidate_objects
-
-    def __len__(self):
-        return len(self.data)
-
-    def __getitem__(self, idx):
-        row = self.data.iloc[idx]
-        question = row["question"]
-        context = row["context"]
-        answer = row["answer"]
-
-        if self.task == "qa":
-            bart_input_text = f"question: {question} context: {context}"
-        else:
-            bart_input_text = f"complete the triple with the exact object: {question} context: {context}"
-        bart_inputs = self.bart_tokenizer(
-            bart_input_text,
-            return_tensors="pt",
-            max_length=self.max_length,
-            truncation=True,
-            padding="max_length"
-        )
-        bart_labels = self.bart_tokenizer(
-            answer,
-            return_tensors="pt",
-            max_length=self.max_length,
-            truncation=True,
-            padding="max_length"
-        )
-
-        dpr_inputs = self.dpr_question_tokenizer(
-            question,
-            return_tensors="pt",
-            max_length=self.max_length,
-            truncation=True,
-            padding="max_length"
-        )
-
-        item = {
-            "task": self.task,
-            "bart_input_ids": bart_inputs["input_ids"].squeeze().long(),
-            "bart_attention_mask": bart_inputs["attention_mask"].squeeze().long(),
-            "bart_labels": bart_labels["input_ids"].squeeze().long(),
-            "dpr_input_ids": dpr_inputs["input_ids"].squeeze().long(),
-            "dpr_attention_mask": dpr_inputs["attention_mask"].squeeze().long(),
-            "question": question,
-            "context": context,  # Added context field
-            "answer": answer
-        }
-
-        if self.task == "triple" and self.candidate_objects:
-            label_idx = self.candidate_objects.index(answer) if answer in self.candidate_objects else -1
-            item["label_idx"] = label_idx
-
-        return item
-
-# Create DataLoaders from raw data
-bart_tokenizer = BartTokenizer.from_pretrained(CONFIG.BART_MODEL_NAME)
-dpr_question_tokenizer = DPRQuestionEncoderTokenizer.from_pretrained(CONFIG.DPR_QUESTION_MODEL_NAME)
-
-qa_train_dataset_v4 = RetrievalDataset(qa_train_df_v4, bart_tokenizer, dpr_question_tokenizer, task="qa", candidate_objects=all_candidates)
-qa_val_dataset_v4 = RetrievalDataset(qa_val_df_v4, bart_tokenizer, dpr_question_tokenizer, task="qa", candidate_objects=all_candidates)
-triple_train_dataset_v4 = RetrievalDataset(triple_train_df_v4, bart_tokenizer, dpr_question_tokenizer, task="triple", candidate_objects=all_candidates)
-triple_val_dataset_v4 = RetrievalDataset(triple_val_df_v4, bart_tokenizer, dpr_question_tokenizer, task="triple", candidate_objects=all_candidates)
+# Rebuild DataLoaders and load all_candidates from the manifest (same split rows and tokenization as Step 2)
+artifact_manifest = load_artifact_manifest(os.path.join(save_path, "manifest_v4"))
+loaders = build_manifest_loaders(artifact_manifest, CONFIG.BATCH_SIZE, CONFIG.NUM_WORKERS)
+qa_train_loader_v4, qa_val_loader_v4 = loaders["qa_train"], loaders["qa_val"]
+triple_train_loader_v4, triple_val_loader_v4 = loaders["triple_train"], loaders["triple_val"]
+all_candidates = load_manifest_candidates(artifact_manifest)
 
-qa_train_loader_v4 = DataLoader(qa_train_dataset_v4, batch_size=CONFIG.BATCH_SIZE, shuffle=True, num_workers=CONFIG.NUM_WORKERS)
-qa_val_loader_v4 = DataLoader(qa_val_dataset_v4, batch_size=CONFIG.BATCH_SIZE, shuffle=False, num_workers=CONFIG.NUM_WORKERS)
-triple_train_loader_v4 = DataLoader(triple_train_dataset_v4, batch_size=CONFIG.BATCH_SIZE, shuffle=True, num_workers=CONFIG.NUM_WORKERS)
-triple_val_loader_v4 = DataLoader(triple_val_dataset_v4, batch_size=CONFIG.BATCH_SIZE, shuffle=False, num_workers=CONFIG.NUM_WORKERS)
+# Smoke check on one real batch per validation split: every field the evaluation and explainers read must be present
+EXPLAINER_BATCH_FIELDS = {"question", "context", "answer", *TOKENIZED_FIELDS}
+for split in ["qa_val", "triple_val"]:
+    missing = EXPLAINER_BATCH_FIELDS - set(next(iter(loaders[split])))
+    if missing:
+        raise KeyError(f"{split} batches are missing {sorted(missing)}; rebuild the manifest loaders")
 
-print(f"Created QA DataLoaders (Version 4): QA Train={len(qa_train_dataset_v4)}, QA Val={len(qa_val_dataset_v4)}")
-print(f"Created Triple DataLoaders (Version 4): Triple Train={len(triple_train_dataset_v4)}, Triple Val={len(triple_val_dataset_v4)}")
+print(f"Created QA DataLoaders (Version 4): QA Train={len(qa_train_loader_v4.dataset)}, QA Val={len(qa_val_loader_v4.dataset)}")
+print(f"Created Triple DataLoaders (Version 4): Triple Train={len(triple_train_loader_v4.dataset)}, Triple Val={len(triple_val_loader_v4.dataset)}")
 
 # Load BART models and tokenizer
-bart_qa_model = BartForConditionalGeneration.from_pretrained(CONFIG.BART_MODEL_NAME).to(CONFIG.DEVICE)
-bart_qa_model.load_state_dict(torch.load(os.path.join(save_path, 'bart_qa_v4.pt')))
-bart_triple_model = BartForConditionalGeneration.from_pretrained(CONFIG.BART_MODEL_NAME).to(CONFIG.DEVICE)
-bart_triple_model.load_state_dict(torch.load(os.path.join(save_path, 'bart_triple_v4.pt')))
+bart_qa_model = load_pretrained_fast(BartForConditionalGeneration, os.path.join(save_path, 'bart_qa_v4'), os.path.join(save_path, 'bart_qa_v4.pt'), CONFIG.BART_MODEL_NAME, device=CONFIG.DEVICE)
+bart_triple_model = load_pretrained_fast(BartForConditionalGeneration, os.path.join(save_path, 'bart_triple_v4'), os.path.join(save_path, 'bart_triple_v4.pt'), CONFIG.BART_MODEL_NAME, device=CONFIG.DEVICE)
 bart_tokenizer = BartTokenizer.from_pretrained(CONFIG.BART_MODEL_NAME)
 bart_qa_model.eval()
 bart_triple_model.eval()
 
 # Load DPR models and tokenizers (post-RL fine-tuning from Step 3)
-ctx_encoder_qa = DPRContextEncoder.from_pretrained(os.path.join(CONFIG.BASE_PATH, "dpr_ctx_encoder_rl_qa_v4")).to(CONFIG.DEVICE)
-question_encoder_qa = DPRQuestionEncoder.from_pretrained(os.path.join(CONFIG.BASE_PATH, "dpr_question_encoder_rl_qa_v4")).to(CONFIG.DEVICE)
-ctx_encoder_triple = DPRContextEncoder.from_pretrained(os.path.join(CONFIG.BASE_PATH, "dpr_ctx_encoder_rl_triple_v4")).to(CONFIG.DEVICE)
-question_encoder_triple = DPRQuestionEncoder.from_pretrained(os.path.join(CONFIG.BASE_PATH, "dpr_question_encoder_rl_triple_v4")).to(CONFIG.DEVICE)
+ctx_encoder_qa = load_pretrained_fast(DPRContextEncoder, os.path.join(CONFIG.BASE_PATH, "dpr_ctx_encoder_rl_qa_v4"), device=CONFIG.DEVICE)
+question_encoder_qa = load_pretrained_fast(DPRQuestionEncoder, os.path.join(CONFIG.BASE_PATH, "dpr_question_encoder_rl_qa_v4"), device=CONFIG.DEVICE)
+ctx_encoder_triple = load_pretrained_fast(DPRContextEncoder, os.path.join(CONFIG.BASE_PATH, "dpr_ctx_encoder_rl_triple_v4"), device=CONFIG.DEVICE)
+question_encoder_triple = load_pretrained_fast(DPRQuestionEncoder, os.path.join(CONFIG.BASE_PATH, "dpr_question_encoder_rl_triple_v4"), device=CONFIG.DEVICE)
+report_model_load_times()
 ctx_tokenizer = DPRContextEncoderTokenizer.from_pretrained(CONFIG.DPR_CTX_MODEL_NAME)
 question_tokenizer = DPRQuestionEncoderTokenizer.from_pretrained(CONFIG.DPR_QUESTION_MODEL_NAME)
-candidate_embeddings_qa = torch.load(os.path.join(save_path, 'dpr_candidate_embeddings_rl_qa_v4.pt')).to(CONFIG.DEVICE)
-candidate_embeddings_triple = torch.load(os.path.join(save_path, 'dpr_candidate_embeddings_rl_triple_v4.pt')).to(CONFIG.DEVICE)
+# Evaluate against every candidate: Step 3's stores are reused while they match these encoders, otherwise re-encoded
+candidate_store_qa = build_candidate_store(ctx_encoder_qa, ctx_tokenizer, all_candidates, os.path.join(save_path, 'dpr_candidate_embeddings_rl_qa_v4.emb'),
+                                           CONFIG.MAX_LENGTH, dtype=CONFIG.EMBEDDING_STORE_DTYPE)
+candidate_store_triple = build_candidate_store(ctx_encoder_triple, ctx_tokenizer, all_candidates, os.path.join(save_path, 'dpr_candidate_embeddings_rl_triple_v4.emb'),
+                                               CONFIG.MAX_LENGTH, dtype=CONFIG.EMBEDDING_STORE_DTYPE)
+
+# Query Adapters (PPO policies exported by Step 3)
+
+# Question embedding plus the trained policy's mean adjustment (same parameters as Step 3's PolicyNetwork)
+class QueryAdapter(torch.nn.Module):
+    def __init__(self, input_dim=768, hidden_dim=256):
+        super(QueryAdapter, self).__init__()
+        self.network = torch.nn.Sequential(
+            torch.nn.Linear(input_dim, hidden_dim),
+            torch.nn.ReLU(),
+            torch.nn.Linear(hidden_dim, input_dim),
+            torch.nn.Tanh()
+        )
+
+    def forward(self, question_embeddings):
+        return question_embeddings + self.network(question_embeddings)
+
+# Question encoder whose pooler_output is passed through the adapter, so every question_encoder(...).pooler_output
+# call site retrieves with the adjusted embedding. The adapter's weights are part of the wrapper's fingerprint.
+class AdaptedQuestionEncoder(torch.nn.Module):
+    def __init__(self, question_encoder, adapter):
+        super(AdaptedQuestionEncoder, self).__init__()
+        self.question_encoder = question_encoder
+        self.adapter = adapter
+
+    def forward(self, input_ids, attention_mask=None, **kwargs):
+        outputs = self.question_encoder(input_ids=input_ids, attention_mask=attention_mask, **kwargs)
+        outputs.pooler_output = self.adapter(outputs.pooler_output)
+        return outputs
+
+# Load query_adapter_rl_{task}_v4, or None when Step 3 exported no adapter for this task. The adapter must have been
+# trained on this question encoder and on candidates encoded by the same context encoder as candidate_store.
+def load_query_adapter(task: str, question_encoder, candidate_store):
+    adapter_dir = os.path.join(CONFIG.BASE_PATH, f"query_adapter_rl_{task}_v4")
+    if not os.path.exists(os.path.join(adapter_dir, "adapter_config.json")):
+        print(f"No query adapter found for {task}; retrieving with the plain question encoder.")
+        return None
+    with open(os.path.join(adapter_dir, "adapter_config.json"), "r") as f:
+        adapter_config = json.load(f)
+    if adapter_config["question_encoder_fingerprint"] != model_fingerprint(question_encoder):
+        raise ValueError(f"Query adapter for {task} was trained on a different question encoder; re-run Step 3")
+    if adapter_config.get("candidate_store_fingerprint") != candidate_store.encoder_fingerprint:
+        raise ValueError(f"Query adapter for {task} was trained against a different candidate store than {candidate_store.path}; re-run Step 3")
+    adapter = QueryAdapter(input_dim=adapter_config["input_dim"], hidden_dim=adapter_config["hidden_dim"])
+    adapter.load_state_dict(load_file(os.path.join(adapter_dir, "adapter.safetensors")))
+    return adapter.to(CONFIG.DEVICE).eval()
+
+# Wrap a question encoder with its adapter (no-op when there is none)
+def apply_query_adapter(question_encoder, adapter):
+    return question_encoder if adapter is None else AdaptedQuestionEncoder(question_encoder, adapter).eval()
 
 # Load sentence transformer
-sentence_transformer = SentenceTransformer('all-MiniLM-L6-v2')
+sentence_transformer = SentenceTransformer(artifact_manifest["models"]["sentence_transformer"])
 
 print("Artifacts loaded from Step 3 and DataLoaders rebuilt for Version 4.")
 
@@ -248,10 +258,207 @@ def compute_bertscore(generated: str, reference: str) -> float:
 
 print("Helper functions defined.")
 
+# Shared prediction cache and model fingerprints (Version3/Python/prediction_cache.py, copied to CONFIG.CODE_PATH)
+from prediction_cache import model_fingerprint, config_fingerprint, PredictionCache, open_generation_cache, cached_generate
+
+# Attention Rollout (captured during generation)
+
+# Attention rollout for one generated answer. The encoder's self-attention is rolled out layer by layer (head mean
+# plus the residual identity, rows renormalised); the decoder's cross-attention, averaged over heads, layers and
+# generated steps, weights the encoder positions, and the rollout carries that weight back to the input tokens.
+# Padding positions are dropped. Returns one relevance per remaining input token, summing to 1.
+def attention_rollout(encoder_attentions: list, cross_attentions: list, attention_mask: torch.Tensor) -> torch.Tensor:
+    keep = attention_mask.bool()
+    rollout = None
+    for layer_attention in encoder_attentions:  # (heads, src, src) per encoder layer
+        attention = layer_attention.float().mean(dim=0)[keep][:, keep]
+        attention = 0.5 * attention + 0.5 * torch.eye(attention.size(0), device=attention.device)
+        attention = attention / attention.sum(dim=-1, keepdim=True)
+        rollout = attention if rollout is None else attention @ rollout
+    cross = torch.stack([attention.float().mean(dim=0)[-1] for attention in cross_attentions])  # (steps x layers, src)
+    relevance = cross.mean(dim=0)[keep] @ rollout
+    return relevance / relevance.sum()
+
+# Per-token attention rollout for every sequence returned by generate(..., output_attentions=True). With beam search
+# each step's cross-attention is read from the beam the returned sequence came through (beam_indices), so only the
+# attention that produced the final answer counts.
+def generation_rollouts(outputs, input_ids: torch.Tensor, attention_mask: torch.Tensor, num_beams: int = 1) -> list:
+    beam_indices = getattr(outputs, "beam_indices", None)
+    rollouts = []
+    for j in range(input_ids.size(0)):
+        encoder_row = j if outputs.encoder_attentions[0].size(0) == input_ids.size(0) else j * num_beams
+        cross_attentions = []
+        for step, step_attentions in enumerate(outputs.cross_attentions):
+            row = j * num_beams
+            if beam_indices is not None:
+                if step >= beam_indices.size(1) or beam_indices[j, step] < 0:
+                    break  # The returned beam finished before this step
+                row = beam_indices[j, step].item()
+            cross_attentions.extend(layer_attention[row] for layer_attention in step_attentions)
+        relevance = attention_rollout([layer_attention[encoder_row] for layer_attention in outputs.encoder_attentions],
+                                      cross_attentions, attention_mask[j])
+        tokens = bart_tokenizer.convert_ids_to_tokens(input_ids[j][attention_mask[j].bool()])
+        rollouts.append([(token, float(score)) for token, score in zip(tokens, relevance.tolist())])
+    return rollouts
+
+# Decoding settings shared by evaluate_bart and qualitative_analysis so both hit the same cache entries
+bart_eval_generation_config = {"max_new_tokens": 100, "num_beams": 10, "temperature": 0.5, "no_repeat_ngram_size": 2}
+
+# Open the generation cache for a BART model under this step's decoding settings
+def open_bart_generation_cache(model) -> PredictionCache:
+    return open_generation_cache(model, bart_eval_generation_config, CONFIG.PREDICTION_CACHE_DIR, CONFIG.BART_MODEL_NAME, CONFIG.MAX_LENGTH)
+
+print("Prediction cache helpers defined.")
+
+# Inference Mode: Dynamic Int8 Quantization (CPU)
+
+# Quantize every nn.Linear to int8 weights with dynamically quantized activations (leaves the input model untouched)
+def quantize_dynamic_int8(model):
+    model = copy.deepcopy(model).to("cpu").eval()
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+
+# Save an int8 model with a sidecar recording the fp32 weights it was built from
+def save_quantized_model(quantized_model, name: str, source_hash: str):
+    os.makedirs(CONFIG.QUANTIZED_MODEL_DIR, exist_ok=True)
+    torch.save(quantized_model.state_dict(), os.path.join(CONFIG.QUANTIZED_MODEL_DIR, f"{name}_int8_v4.pt"))
+    with open(os.path.join(CONFIG.QUANTIZED_MODEL_DIR, f"{name}_int8_v4.json"), "w") as f:
+        json.dump({"source_hash": source_hash, "dtype": "qint8", "quantized_modules": ["Linear"]}, f)
+
+# Load a saved int8 model: build the architecture from its config, quantize it, then load the int8 weights
+def load_quantized_model(model_cls, config_name: str, name: str):
+    model = model_cls(model_cls.config_class.from_pretrained(config_name))
+    model = torch.quantization.quantize_dynamic(model.eval(), {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    model.load_state_dict(torch.load(os.path.join(CONFIG.QUANTIZED_MODEL_DIR, f"{name}_int8_v4.pt")))
+    return model.eval()
+
+# Return a model in the requested inference mode, reusing the saved int8 copy if it was built from these weights
+def prepare_for_inference(model, model_cls, config_name: str, name: str, mode: str = CONFIG.INFERENCE_MODE):
+    if mode == "fp32":
+        return model.to(CONFIG.DEVICE).eval()
+    if mode != "int8":
+        raise ValueError(f"Unknown inference mode: {mode}")
+    source_hash = model_fingerprint(model)
+    meta_path = os.path.join(CONFIG.QUANTIZED_MODEL_DIR, f"{name}_int8_v4.json")
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            if json.load(f)["source_hash"] == source_hash:
+                print(f"Loading saved int8 model for {name}")
+                return load_quantized_model(model_cls, config_name, name)
+    print(f"Quantizing {name} to int8...")
+    quantized_model = quantize_dynamic_int8(model)
+    save_quantized_model(quantized_model, name, source_hash)
+    return quantized_model
+
+# Serialized size of a model's weights in MB
+def model_size_mb(model) -> float:
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.getbuffer().nbytes / (1024 ** 2)
+
+# Load the RL query adapters while the question encoders are still the fp32 weights Step 3 saved
+query_adapter_qa = load_query_adapter("qa", question_encoder_qa, candidate_store_qa) if CONFIG.USE_QUERY_ADAPTER else None
+query_adapter_triple = load_query_adapter("triple", question_encoder_triple, candidate_store_triple) if CONFIG.USE_QUERY_ADAPTER else None
+
+# Apply the selected inference mode to every model used for evaluation, explanation and serving
+if CONFIG.INFERENCE_MODE != "fp32":
+    bart_qa_model = prepare_for_inference(bart_qa_model, BartForConditionalGeneration, CONFIG.BART_MODEL_NAME, "bart_qa")
+    bart_triple_model = prepare_for_inference(bart_triple_model, BartForConditionalGeneration, CONFIG.BART_MODEL_NAME, "bart_triple")
+    ctx_encoder_qa = prepare_for_inference(ctx_encoder_qa, DPRContextEncoder, CONFIG.DPR_CTX_MODEL_NAME, "dpr_ctx_encoder_rl_qa")
+    question_encoder_qa = prepare_for_inference(question_encoder_qa, DPRQuestionEncoder, CONFIG.DPR_QUESTION_MODEL_NAME, "dpr_question_encoder_rl_qa")
+    ctx_encoder_triple = prepare_for_inference(ctx_encoder_triple, DPRContextEncoder, CONFIG.DPR_CTX_MODEL_NAME, "dpr_ctx_encoder_rl_triple")
+    question_encoder_triple = prepare_for_inference(question_encoder_triple, DPRQuestionEncoder, CONFIG.DPR_QUESTION_MODEL_NAME, "dpr_question_encoder_rl_triple")
+    gc.collect()
+
+# Fold the RL query adapters into retrieval
+if CONFIG.USE_QUERY_ADAPTER:
+    question_encoder_qa = apply_query_adapter(question_encoder_qa, query_adapter_qa)
+    question_encoder_triple = apply_query_adapter(question_encoder_triple, query_adapter_triple)
+print(f"Inference mode: {CONFIG.INFERENCE_MODE} on {CONFIG.DEVICE}")
+
 # Explainability with LIME and Custom SHAP
 
 import gc
 
+# Explanation Store (append-only JSONL with an in-memory offset index)
+
+# Each line is "<key>\t<record JSON>". Opening the store scans only the key prefixes to index line offsets, and
+# get() seeks to and parses just the requested record, so the store can grow without being loaded into memory.
+# A key ties a record to the model weights, the explainer, its config and the exact input text.
+class ExplanationStore:
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.offsets = {}
+        self.hits, self.misses = 0, 0
+        if os.path.exists(path):
+            offset = 0
+            with open(path, "rb") as f:
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break  # Partially written line from an interrupted run
+                    key, _, _ = line.partition(b"\t")
+                    self.offsets[key.decode("utf-8")] = offset
+                    offset += len(line)
+            if offset < os.path.getsize(path):
+                with open(path, "r+b") as f:
+                    f.truncate(offset)
+        print(f"Explanation store {path}: {len(self.offsets)} records")
+
+    @staticmethod
+    def make_key(model_hash: str, explainer: str, config: dict, text: str) -> str:
+        text_hash = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        return hashlib.sha256(f"{model_hash}|{explainer}|{config_fingerprint(config)}|{text_hash}".encode("utf-8")).hexdigest()
+
+    # Read a stored record without touching the hit/miss counters
+    def read(self, key: str):
+        offset = self.offsets.get(key)
+        if offset is None:
+            return None
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            return json.loads(f.readline().partition(b"\t")[2])
+
+    def get(self, key: str):
+        record = self.read(key)
+        if record is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return record
+
+    def put(self, key: str, record: dict):
+        with open(self.path, "ab") as f:
+            offset = f.tell()
+            f.write(key.encode("utf-8") + b"\t" + json.dumps(record).encode("utf-8") + b"\n")
+        self.offsets[key] = offset
+
+explanation_store = ExplanationStore(CONFIG.EXPLANATION_STORE_PATH) if CONFIG.USE_EXPLANATION_STORE else None
+
+# Weight hashes for the explained models (model_fingerprint hashes each model object once while its weights are unchanged)
+def explanation_model_hash(*models) -> str:
+    return ":".join(model_fingerprint(model) for model in models)
+
+# Return the stored record for (model hash, explainer, config, text), computing and appending it on a miss
+def cached_explanation(model_hash: str, explainer: str, config: dict, text: str, compute_fn, use_store: bool = CONFIG.USE_EXPLANATION_STORE) -> dict:
+    if not use_store or explanation_store is None:
+        return compute_fn()
+    key = ExplanationStore.make_key(model_hash, explainer, config, text)
+    record = explanation_store.get(key)
+    if record is None:
+        record = compute_fn()
+        explanation_store.put(key, record)
+    return record
+
+# Stable per-text seed, so a recomputed explanation matches the stored one
+def text_seed(text: str) -> int:
+    return int(hashlib.sha256(text.encode("utf-8")).hexdigest()[:8], 16)
+
+# Store-key text for a BART explanation: the input, plus the reference when that is the explained answer
+def explanation_key_text(text_input: str, reference: str, scoring: str) -> str:
+    if scoring == "likelihood" and CONFIG.EXPLANATION_TARGET == "reference":
+        return f"{text_input}\n{reference}"
+    return text_input
+
 # Function to compute BART probabilities for a given text
 def compute_bart_probs(texts, model, tokenizer, max_vocab_size=50265):  # BART's default vocab size
     if isinstance(texts, str):
@@ -279,6 +486,41 @@ def compute_bart_probs(texts, model, tokenizer, max_vocab_size=50265):  # BART's
         probs = torch.softmax(logits, dim=-1)
     return probs.cpu().numpy()
 
+# Format a BART input the way the model was trained for the task
+def bart_input_text(question: str, context: str, task: str = "qa") -> str:
+    if task == "qa":
+        return f"question: {question} context: {context}"
+    return f"complete the triple with the exact object: {question} context: {context}"
+
+# Teacher-forced log p(answer | text) for each text, summed over the answer tokens. Only the answer tokens' logits
+# are gathered (normalised by a logsumexp), so each text costs one float on the host instead of a vocabulary vector.
+def answer_log_likelihood(texts, model, tokenizer, answer: str, batch_size: int = CONFIG.EXPLANATION_BATCH_SIZE) -> np.ndarray:
+    if isinstance(texts, str):
+        texts = [texts]
+    labels = tokenizer(answer, return_tensors="pt", truncation=True, max_length=CONFIG.MAX_LENGTH)["input_ids"].to(CONFIG.DEVICE)
+    scores = []
+    with torch.no_grad():
+        for start in range(0, len(texts), batch_size):
+            inputs = tokenizer(texts[start:start + batch_size], return_tensors="pt", padding=True, truncation=True,
+                               max_length=CONFIG.MAX_LENGTH).to(CONFIG.DEVICE)
+            batch_labels = labels.expand(inputs["input_ids"].size(0), -1)
+            logits = model(**inputs, labels=batch_labels).logits  # labels only build the shifted decoder inputs
+            scores.append(sequence_log_likelihood(logits, batch_labels).float().cpu())
+    return torch.cat(scores).numpy()
+
+# Sum of log p(label token) per row, gathering only the label logits
+def sequence_log_likelihood(logits: torch.Tensor, labels: torch.Tensor) -> torch.Tensor:
+    return (logits.gather(-1, labels.unsqueeze(-1)).squeeze(-1) - torch.logsumexp(logits, dim=-1)).sum(dim=1)
+
+# Answer the likelihood scorer explains: the model's own answer for the unperturbed text, or the reference
+def explanation_answer(text: str, reference: str, model, tokenizer, target: str = CONFIG.EXPLANATION_TARGET) -> str:
+    if target == "reference":
+        return reference
+    inputs = tokenizer(text, return_tensors="pt", truncation=True, max_length=CONFIG.MAX_LENGTH).to(CONFIG.DEVICE)
+    with torch.no_grad():
+        generated_ids = model.generate(**inputs, **bart_eval_generation_config)
+    return tokenizer.decode(generated_ids[0], skip_special_tokens=True)
+
 # Wrapper function for LIME to handle perturbed samples
 def lime_bart_predict(texts, model, tokenizer):
     if not isinstance(texts, list):
@@ -293,133 +535,387 @@ def lime_bart_predict(texts, model, tokenizer):
     probs = np.concatenate(probs_list, axis=0)
     return probs
 
-# LIME Explainer (Optimized for memory usage)
-def explain_with_lime(model, val_loader, task: str = "qa", num_samples: int = 5):
-    print(f"Explaining {task} predictions with LIME...")
-    explainer = lime.lime_text.LimeTextExplainer(class_names=["answer"])
-    explanations = []
-    model.eval()
+# Adaptive LIME: perturbations are drawn batch_samples at a time with LIME's own scheme (remove a uniformly drawn
+# number of words; the first sample keeps them all) and the weighted ridge surrogate is refit after each batch.
+# Sampling stops once the top num_features words keep their order and weights within tolerance (relative to the
+# largest weight) for stable_rounds refits in a row, or at max_samples. Refits use LIME's highest_weights selection,
+# since forward selection per refit would cost num_words x num_features ridge fits.
+# Returns the (word, weight) list and the number of samples used.
+def adaptive_lime(explainer, text: str, score_fn, num_features: int = 6, batch_samples: int = CONFIG.LIME_BATCH_SAMPLES,
+                  min_samples: int = CONFIG.LIME_MIN_SAMPLES, max_samples: int = CONFIG.LIME_MAX_SAMPLES,
+                  tolerance: float = CONFIG.LIME_TOLERANCE, stable_rounds: int = CONFIG.LIME_STABLE_ROUNDS, seed: int = 0):
+    indexed_string = lime.lime_text.IndexedString(text, bow=explainer.bow, split_expression=explainer.split_expression,
+                                                  mask_string=explainer.mask_string)
+    num_words = indexed_string.num_words()
+    if num_words < 2:
+        return [], 0
+    rng = np.random.default_rng(seed)
+    data = np.ones((1, num_words), dtype=int)
+    scores = np.asarray(score_fn([text]), dtype=np.float64)
+    previous, stable, local_exp = None, 0, []
+    while len(data) < max_samples:
+        batch = np.ones((min(batch_samples, max_samples - len(data)), num_words), dtype=int)
+        texts = []
+        for row, num_removed in zip(batch, rng.integers(1, num_words, size=len(batch))):
+            inactive = rng.choice(num_words, size=num_removed, replace=False)
+            row[inactive] = 0
+            texts.append(indexed_string.inverse_removing(inactive))
+        data = np.vstack([data, batch])
+        scores = np.concatenate([scores, np.asarray(score_fn(texts), dtype=np.float64)])
+        distances = (1.0 - np.sqrt(data.sum(axis=1) / num_words)) * 100  # LIME's cosine distance to the full text
+        _, local_exp, _, _ = explainer.base.explain_instance_with_data(data, scores[:, None], distances, 0, num_features,
+                                                                       feature_selection="highest_weights")
+        if previous is not None and len(data) >= min_samples:
+            previous_weights = dict(previous)
+            scale = max(abs(weight) for _, weight in local_exp) or 1.0
+            drift = max(abs(weight - previous_weights.get(feature, 0.0)) for feature, weight in local_exp)
+            same_order = [feature for feature, _ in local_exp] == [feature for feature, _ in previous]
+            stable = stable + 1 if same_order and drift <= tolerance * scale else 0
+            if stable >= stable_rounds:
+                break
+        previous = local_exp
+    return [(indexed_string.word(feature), float(weight)) for feature, weight in local_exp], len(data)
 
+# (text_input, reference) for the first num_samples validation examples (all of them when num_samples is None)
+def explanation_examples(val_loader, task: str = "qa", num_samples: int = None):
     samples_processed = 0
     for batch in val_loader:
-        if samples_processed >= num_samples:
-            break
-        references = batch["answer"]
         for i in range(len(batch["question"])):
-            if samples_processed >= num_samples:
-                break
-            text_input = f"question: {batch['question'][i]} context: {batch['context'][i]}"
-            explanation = explainer.explain_instance(
-                text_input,
-                lambda texts: lime_bart_predict(texts, model, bart_tokenizer),
-                num_features=6,
-                num_samples=50
-            )
-            explanations.append({
-                "text": text_input,
-                "reference": references[i],
-                "explanation": explanation.as_list()
-            })
+            if num_samples is not None and samples_processed >= num_samples:
+                return
+            yield bart_input_text(batch['question'][i], batch['context'][i], task), batch["answer"][i]
             samples_processed += 1
-            torch.cuda.empty_cache()
-            gc.collect()
 
+# Store config for LIME explanations; every setting that changes the result is part of the key
+def lime_store_config(scoring: str = CONFIG.EXPLANATION_SCORING) -> dict:
+    return {"scoring": scoring, "target": CONFIG.EXPLANATION_TARGET, "num_features": 6, "generation": bart_eval_generation_config,
+            "batch_samples": CONFIG.LIME_BATCH_SAMPLES, "min_samples": CONFIG.LIME_MIN_SAMPLES, "max_samples": CONFIG.LIME_MAX_SAMPLES,
+            "tolerance": CONFIG.LIME_TOLERANCE, "stable_rounds": CONFIG.LIME_STABLE_ROUNDS}
+
+# Explain one BART input with adaptive LIME
+def lime_explanation_record(model, text_input: str, reference: str, scoring: str = CONFIG.EXPLANATION_SCORING) -> dict:
+    explainer = lime.lime_text.LimeTextExplainer(class_names=["answer"])
+    if scoring == "likelihood":
+        # One regression target per perturbation: LIME fits the answer's log-likelihood directly
+        answer = explanation_answer(text_input, reference, model, bart_tokenizer)
+        score_fn = lambda texts: answer_log_likelihood(texts, model, bart_tokenizer, answer)
+    else:
+        answer = None
+        score_fn = lambda texts: lime_bart_predict(texts, model, bart_tokenizer)[:, 1]
+    explanation, lime_samples = adaptive_lime(explainer, text_input, score_fn, num_features=6, seed=text_seed(text_input))
+    return {
+        "text": text_input,
+        "reference": reference,
+        "explained_answer": answer,
+        "scoring": scoring,
+        "explanation": explanation,
+        "lime_samples": lime_samples
+    }
+
+# Print the adaptive LIME budget spent on a task
+def report_lime_budget(explanations: list, task: str = "qa"):
+    lime_budget = [explanation["lime_samples"] for explanation in explanations]
+    if lime_budget:
+        print(f"{task} LIME samples per example: mean {np.mean(lime_budget):.1f}, min {min(lime_budget)}, max {max(lime_budget)}")
+
+# LIME Explainer (adaptive sample budget)
+def explain_with_lime(model, val_loader, task: str = "qa", num_samples: int = 5, scoring: str = CONFIG.EXPLANATION_SCORING,
+                      use_store: bool = CONFIG.USE_EXPLANATION_STORE):
+    print(f"Explaining {task} predictions with adaptive LIME ({scoring} scoring)...")
+    explanations = []
+    model.eval()
+    model_hash = explanation_model_hash(model)
+    lime_config = lime_store_config(scoring)
+    for text_input, reference in explanation_examples(val_loader, task, num_samples):
+        compute = lambda: lime_explanation_record(model, text_input, reference, scoring)
+        explanations.append(cached_explanation(model_hash, "lime", lime_config, explanation_key_text(text_input, reference, scoring),
+                                               compute, use_store))
+    report_lime_budget(explanations, task)
     return explanations
 
-# Custom permutation-based SHAP approximation (Updated to handle inconsistent sequence lengths)
-def custom_permutation_shap(text, model, tokenizer, num_permutations=50):
-    print(f"Computing custom permutation SHAP for text: {text[:50]}...")
+# Number of leading words of text that survive tokenizer truncation to max_length. Byte-level BPE tokenizes
+# space-separated words independently, so per-word token counts add up to the count for the whole text.
+def truncated_word_count(text: str, tokenizer, max_length: int = CONFIG.MAX_LENGTH) -> int:
+    budget = max_length - tokenizer.num_special_tokens_to_add()
+    used = 0
+    for count, word in enumerate(text.split()):
+        used += len(tokenizer.tokenize(word if count == 0 else " " + word))
+        if used > budget:
+            return count
+    return len(text.split())
+
+# KernelSHAP over the first max_words words of a text (all of them by default); later words are cut by truncation,
+# so they stay in every coalition and get no attribution. All coalition masks are built up front: every coalition
+# with its exact Shapley kernel weight when 2^M - 2 fits the budget, otherwise num_samples masks (2M + 2048 by
+# default, as in shap) in complementary pairs whose sizes are drawn from the kernel (equal weights). The masked
+# texts are scored in one batched call, and the per-word values solve the weighted least squares constrained to
+# sum to f(text) - f(truncated tail only).
+def kernel_shap(text: str, score_fn, num_samples: int = CONFIG.SHAP_NUM_SAMPLES, seed: int = 0, max_words: int = None) -> list:
+    all_words = text.split()
+    max_words = len(all_words) if max_words is None else max_words
+    words, tail = all_words[:max_words], all_words[max_words:]
+    num_words = len(words)
+    if num_samples is None:
+        num_samples = 2 * num_words + 2048
+    if num_words < 2:
+        scores = score_fn([text, " ".join(tail)])
+        return [(word, float(scores[0] - scores[1])) for word in words]
+    if 2 ** num_words - 2 <= num_samples:
+        masks = ((np.arange(1, 2 ** num_words - 1)[:, None] >> np.arange(num_words)) & 1).astype(bool)
+        sizes = masks.sum(axis=1)
+        weights = (num_words - 1) / (np.array([math.comb(num_words, size) for size in sizes]) * sizes * (num_words - sizes))
+    else:
+        rng = np.random.default_rng(seed)
+        size_range = np.arange(1, num_words)
+        size_probs = (num_words - 1) / (size_range * (num_words - size_range))
+        sizes = rng.choice(size_range, size=num_samples // 2, p=size_probs / size_probs.sum())
+        masks = np.zeros((len(sizes), num_words), dtype=bool)
+        for row, size in enumerate(sizes):
+            masks[row, rng.choice(num_words, size=size, replace=False)] = True
+        masks = np.concatenate([masks, ~masks])
+        weights = np.ones(len(masks))
+    texts = [text, " ".join(tail)] + [" ".join([word for word, keep in zip(words, mask) if keep] + tail) for mask in masks]
+    scores = np.asarray(score_fn(texts), dtype=np.float64)
+    total = scores[0] - scores[1]
+    coalitions = masks.astype(np.float64)
+    # Eliminate the last word through the efficiency constraint, then solve for the rest
+    design = coalitions[:, :-1] - coalitions[:, -1:]
+    target = (scores[2:] - scores[1]) - coalitions[:, -1] * total
+    sqrt_weights = np.sqrt(weights)
+    values = np.linalg.lstsq(design * sqrt_weights[:, None], target * sqrt_weights, rcond=None)[0]
+    values = np.append(values, total - values.sum())
+    return [(word, float(value)) for word, value in zip(words, values)]
+
+# Store config for KernelSHAP explanations
+def shap_store_config(scoring: str = CONFIG.EXPLANATION_SCORING, shap_samples: int = CONFIG.SHAP_NUM_SAMPLES) -> dict:
+    return {"scoring": scoring, "target": CONFIG.EXPLANATION_TARGET, "num_samples": shap_samples, "generation": bart_eval_generation_config,
+            "features": "words_within_max_length", "max_length": CONFIG.MAX_LENGTH}
+
+# Explain one BART input with KernelSHAP. In vocab mode the score is the probability of the unperturbed text's most
+# likely vocabulary entry.
+def shap_explanation_record(model, text_input: str, reference: str, scoring: str = CONFIG.EXPLANATION_SCORING,
+                            shap_samples: int = CONFIG.SHAP_NUM_SAMPLES) -> dict:
+    if scoring == "likelihood":
+        answer = explanation_answer(text_input, reference, model, bart_tokenizer)
+        score_fn = lambda texts: answer_log_likelihood(texts, model, bart_tokenizer, answer)
+    else:
+        answer = None
+        top_entry = int(lime_bart_predict([text_input], model, bart_tokenizer)[0].argmax())
+        score_fn = lambda texts: lime_bart_predict(texts, model, bart_tokenizer)[:, top_entry]
+    return {
+        "text": text_input,
+        "reference": reference,
+        "explained_answer": answer,
+        "scoring": scoring,
+        "shap_values": kernel_shap(text_input, score_fn, num_samples=shap_samples, seed=text_seed(text_input),
+                                   max_words=truncated_word_count(text_input, bart_tokenizer))
+    }
+
+# SHAP Explainer (batched KernelSHAP, per-word attributions)
+def explain_with_shap(model, val_loader, task: str = "qa", num_samples: int = 5, scoring: str = CONFIG.EXPLANATION_SCORING,
+                      shap_samples: int = CONFIG.SHAP_NUM_SAMPLES, use_store: bool = CONFIG.USE_EXPLANATION_STORE):
+    print(f"Explaining {task} predictions with KernelSHAP ({scoring} scoring, {shap_samples or '2M + 2048'} coalitions)...")
     model.eval()
-    baseline_input = tokenizer(
-        text,
-        return_tensors="pt",
-        padding=True,
-        truncation=True,
-        max_length=CONFIG.MAX_LENGTH
-    )
-    baseline_input = {k: v.to(CONFIG.DEVICE) for k, v in baseline_input.items()}
-    with torch.no_grad():
-        baseline_output = model(**baseline_input).logits
-        # Average over sequence length to get a single probability distribution
-        baseline_output = baseline_output.mean(dim=1)  # Shape: (1, vocab_size)
-        baseline_probs = torch.softmax(baseline_output, dim=-1).cpu().numpy()[0]  # Shape: (vocab_size,)
+    explanations = []
+    model_hash = explanation_model_hash(model)
+    shap_config = shap_store_config(scoring, shap_samples)
+    for text_input, reference in explanation_examples(val_loader, task, num_samples):
+        compute = lambda: shap_explanation_record(model, text_input, reference, scoring, shap_samples)
+        explanations.append(cached_explanation(model_hash, "kernel_shap", shap_config, explanation_key_text(text_input, reference, scoring),
+                                               compute, use_store))
+    return explanations
 
-    feature_importance = np.zeros(len(baseline_probs))
-    words = text.split()
-    if len(words) < 2:
-        return feature_importance
-
-    for _ in range(num_permutations):
-        permuted_words = words.copy()
-        np.random.shuffle(permuted_words)
-        permuted_text = " ".join(permuted_words)
-        permuted_input = tokenizer(
-            permuted_text,
-            return_tensors="pt",
-            padding=True,
-            truncation=True,
-            max_length=CONFIG.MAX_LENGTH
-        )
-        permuted_input = {k: v.to(CONFIG.DEVICE) for k, v in permuted_input.items()}
-        with torch.no_grad():
-            permuted_output = model(**permuted_input).logits
-            # Average over sequence length to get a single probability distribution
-            permuted_output = permuted_output.mean(dim=1)  # Shape: (1, vocab_size)
-            permuted_probs = torch.softmax(permuted_output, dim=-1).cpu().numpy()[0]  # Shape: (vocab_size,)
-        importance = np.abs(baseline_probs - permuted_probs).mean()
-        feature_importance += importance
-        torch.cuda.empty_cache()
-        gc.collect()
+# Explanation Worker Pool (LIME / KernelSHAP across forked CPU processes)
+
+# Models shared by every worker; set before the pool forks so children inherit the parent's shared-memory weights
+# instead of loading or receiving a copy each
+explanation_worker_shared = {}
+
+def init_explanation_worker():
+    torch.set_num_threads(1)
 
-    return feature_importance / num_permutations
+# Explain one job in a worker and hand the record back to the parent, which owns the store
+def run_explanation_job(job: tuple) -> tuple:
+    key, explainer, task, text_input, reference, scoring = job
+    model = explanation_worker_shared["models"][task]
+    with torch.no_grad():
+        if explainer == "lime":
+            record = lime_explanation_record(model, text_input, reference, scoring)
+        else:
+            record = shap_explanation_record(model, text_input, reference, scoring, CONFIG.SHAP_NUM_SAMPLES)
+    return key, record
+
+# Explain the validation sets of several tasks with LIME and/or KernelSHAP. Store keys are computed up front and
+# only missing records become jobs, so an interrupted run resumes where it stopped. Jobs are sharded across
+# num_workers forked processes (each model's weights are moved to shared memory once and mapped read-only by every
+# worker), and each record is appended to the store as soon as its worker returns it. Falls back to in-process
+# explanation with one worker, on GPU, or without a store.
+# Returns {explainer: {task: [records in validation order]}}.
+def explain_validation_sets(models: dict, val_loaders: dict, explainers=("lime", "kernel_shap"), num_samples: int = CONFIG.EXPLANATION_NUM_EXAMPLES,
+                            scoring: str = CONFIG.EXPLANATION_SCORING, num_workers: int = CONFIG.EXPLANATION_NUM_WORKERS) -> dict:
+    if num_workers <= 1 or CONFIG.DEVICE.type != "cpu" or explanation_store is None:
+        explain_fns = {"lime": explain_with_lime, "kernel_shap": explain_with_shap}
+        return {explainer: {task: explain_fns[explainer](models[task], val_loaders[task], task=task, num_samples=num_samples, scoring=scoring)
+                            for task in models}
+                for explainer in explainers}
+
+    store_configs = {"lime": lime_store_config(scoring), "kernel_shap": shap_store_config(scoring)}
+    keys = {explainer: {task: [] for task in models} for explainer in explainers}
+    jobs = []
+    for task, model in models.items():
+        model.eval()
+        model_hash = explanation_model_hash(model)
+        for text_input, reference in explanation_examples(val_loaders[task], task, num_samples):
+            key_text = explanation_key_text(text_input, reference, scoring)
+            for explainer in explainers:
+                key = ExplanationStore.make_key(model_hash, explainer, store_configs[explainer], key_text)
+                keys[explainer][task].append(key)
+                if key not in explanation_store.offsets:
+                    jobs.append((key, explainer, task, text_input, reference, scoring))
+    jobs = list({job[0]: job for job in jobs}.values())  # Identical inputs in a split are explained once
+    total = sum(len(task_keys) for explainer_keys in keys.values() for task_keys in explainer_keys.values())
+    print(f"Explanation jobs: {len(jobs)} to compute, {total - len(jobs)} already stored ({', '.join(explainers)}; {', '.join(models)})")
+    explanation_store.hits += total - len(jobs)
+    explanation_store.misses += len(jobs)
+
+    if jobs:
+        for model in models.values():
+            model.share_memory()
+        explanation_worker_shared["models"] = models
+        ctx = mp.get_context("fork")  # Workers inherit the notebook's functions and the shared-memory models
+        with ctx.Pool(processes=min(num_workers, len(jobs)), initializer=init_explanation_worker) as pool:
+            for key, record in tqdm(pool.imap_unordered(run_explanation_job, jobs), total=len(jobs), desc="Explaining"):
+                explanation_store.put(key, record)
+        explanation_worker_shared.clear()
+
+    results = {explainer: {task: [explanation_store.read(key) for key in task_keys] for task, task_keys in explainer_keys.items()}
+               for explainer, explainer_keys in keys.items()}
+    if "lime" in results:
+        for task, explanations in results["lime"].items():
+            report_lime_budget(explanations, task)
+    return results
 
-# SHAP Explainer (Custom permutation-based, optimized for memory)
-def explain_with_shap(model, val_loader, task: str = "qa", num_samples: int = 5):
-    print(f"Explaining {task} predictions with custom permutation SHAP...")
+# Gradient Attributions (Integrated Gradients / gradient x input)
+
+# Per-token attributions of score_fn(inputs_embeds, attention_mask) -> (n,) w.r.t. one input's token embeddings.
+# Integrated Gradients averages the gradient over a midpoint-rule path from a zero baseline, evaluating ig_batch_size
+# path points per forward/backward pass; grad_x_input is a single pass at the input. Scores are summed over the
+# embedding dimension, so each token gets one number.
+def embedding_attributions(score_fn, inputs_embeds: torch.Tensor, attention_mask: torch.Tensor, method: str = CONFIG.GRADIENT_METHOD,
+                           steps: int = CONFIG.IG_STEPS, ig_batch_size: int = CONFIG.IG_BATCH_SIZE) -> torch.Tensor:
+    if CONFIG.INFERENCE_MODE != "fp32":
+        raise ValueError("Gradient attributions need the fp32 models (int8 dynamic quantization has no backward)")
+    if method not in ("integrated_gradients", "grad_x_input"):
+        raise ValueError(f"Unknown gradient attribution method: {method}")
+    inputs_embeds = inputs_embeds.detach()
+    alphas = torch.ones(1, device=inputs_embeds.device) if method == "grad_x_input" else \
+        (torch.arange(steps, device=inputs_embeds.device, dtype=inputs_embeds.dtype) + 0.5) / steps
+    total_grads = torch.zeros_like(inputs_embeds[0])
+    for chunk in alphas.split(ig_batch_size):
+        path = (chunk.view(-1, 1, 1) * inputs_embeds).requires_grad_(True)  # Zero baseline: x' + a (x - x') = a x
+        scores = score_fn(path, attention_mask.expand(len(chunk), -1))
+        total_grads += torch.autograd.grad(scores.sum(), path)[0].sum(dim=0)
+    return (inputs_embeds[0] * total_grads / len(alphas)).sum(dim=-1)
+
+# Attribute BART's log-likelihood of answer to the tokens of text
+def bart_gradient_attributions(model, tokenizer, text: str, answer: str, method: str = CONFIG.GRADIENT_METHOD) -> list:
+    inputs = tokenizer(text, return_tensors="pt", truncation=True, max_length=CONFIG.MAX_LENGTH).to(CONFIG.DEVICE)
+    labels = tokenizer(answer, return_tensors="pt", truncation=True, max_length=CONFIG.MAX_LENGTH)["input_ids"].to(CONFIG.DEVICE)
     model.eval()
-    explanations = []
 
+    def score_fn(inputs_embeds, attention_mask):
+        batch_labels = labels.expand(inputs_embeds.size(0), -1)
+        logits = model(inputs_embeds=inputs_embeds, attention_mask=attention_mask, labels=batch_labels).logits
+        return sequence_log_likelihood(logits, batch_labels)
+
+    # bart-base does not scale embeddings, so the encoder's embed_tokens output is exactly what it consumes
+    inputs_embeds = model.get_encoder().embed_tokens(inputs["input_ids"])
+    attributions = embedding_attributions(score_fn, inputs_embeds, inputs["attention_mask"], method)
+    tokens = tokenizer.convert_ids_to_tokens(inputs["input_ids"][0])
+    return [(token, float(score)) for token, score in zip(tokens, attributions.tolist())]
+
+# Attribute the DPR similarity between a question and one candidate embedding to the question's tokens
+def dpr_gradient_attributions(question_encoder, question: str, candidate_embedding: torch.Tensor, method: str = CONFIG.GRADIENT_METHOD) -> list:
+    inputs = question_tokenizer(question, return_tensors="pt", truncation=True, max_length=CONFIG.MAX_LENGTH).to(CONFIG.DEVICE)
+    candidate_embedding = candidate_embedding.to(CONFIG.DEVICE).float().view(-1)
+    base_encoder = question_encoder.question_encoder if isinstance(question_encoder, AdaptedQuestionEncoder) else question_encoder
+    question_encoder.eval()
+
+    def score_fn(inputs_embeds, attention_mask):
+        question_embeddings = question_encoder(input_ids=None, inputs_embeds=inputs_embeds, attention_mask=attention_mask).pooler_output
+        return torch.matmul(question_embeddings, candidate_embedding)
+
+    inputs_embeds = base_encoder.get_input_embeddings()(inputs["input_ids"])
+    attributions = embedding_attributions(score_fn, inputs_embeds, inputs["attention_mask"], method)
+    tokens = question_tokenizer.convert_ids_to_tokens(inputs["input_ids"][0])
+    return [(token, float(score)) for token, score in zip(tokens, attributions.tolist())]
+
+# Gradient explanations for the BART answer (its own prediction) and for DPR's top-1 retrieved candidate
+def explain_with_gradients(model, question_encoder, candidate_store, val_loader, task: str = "qa", num_samples: int = 5,
+                           method: str = CONFIG.GRADIENT_METHOD, use_store: bool = CONFIG.USE_EXPLANATION_STORE):
+    print(f"Explaining {task} predictions with {method}...")
+    explanations = []
+    model_hash = f"{explanation_model_hash(model, question_encoder)}:{candidate_store.encoder_fingerprint}"
+    gradient_config = {"method": method, "steps": CONFIG.IG_STEPS, "generation": bart_eval_generation_config}
     samples_processed = 0
     for batch in val_loader:
-        if samples_processed >= num_samples:
+        if num_samples is not None and samples_processed >= num_samples:
             break
-        references = batch["answer"]
         for i in range(len(batch["question"])):
-            if samples_processed >= num_samples:
+            if num_samples is not None and samples_processed >= num_samples:
                 break
-            text_input = f"question: {batch['question'][i]} context: {batch['context'][i]}"
-            shap_values = custom_permutation_shap(text_input, model, bart_tokenizer, num_permutations=50)
-            explanations.append({
-                "text": text_input,
-                "reference": references[i],
-                "shap_values": shap_values.tolist()
-            })
+            question, reference = batch["question"][i], batch["answer"][i]
+            text_input = bart_input_text(question, batch["context"][i], task)
+
+            def compute():
+                answer = explanation_answer(text_input, reference, model, bart_tokenizer, target="prediction")
+                with torch.no_grad():
+                    question_inputs = question_tokenizer(question, return_tensors="pt", truncation=True, max_length=CONFIG.MAX_LENGTH).to(CONFIG.DEVICE)
+                    top_id = int(candidate_store.scores(question_encoder(**question_inputs).pooler_output)[0].argmax())
+                return {
+                    "text": text_input,
+                    "reference": reference,
+                    "explained_answer": answer,
+                    "method": method,
+                    "answer_attributions": bart_gradient_attributions(model, bart_tokenizer, text_input, answer, method),
+                    "retrieved_candidate": all_candidates[top_id],
+                    "retrieval_attributions": dpr_gradient_attributions(question_encoder, question, candidate_store.rows([top_id])[0], method)
+                }
+
+            explanations.append(cached_explanation(model_hash, "gradient", gradient_config, f"{text_input}\n{question}", compute, use_store))
             samples_processed += 1
-            torch.cuda.empty_cache()
-            gc.collect()
-
     return explanations
 
-# Explain QA predictions
-lime_explanations_qa = explain_with_lime(bart_qa_model, qa_val_loader_v4, task="qa", num_samples=5)
-shap_explanations_qa = explain_with_shap(bart_qa_model, qa_val_loader_v4, task="qa", num_samples=5)
+# Explain QA and triple predictions (worker pool; re-running resumes from the explanation store)
+explanations = explain_validation_sets({"qa": bart_qa_model, "triple": bart_triple_model},
+                                       {"qa": qa_val_loader_v4, "triple": triple_val_loader_v4})
+lime_explanations_qa, lime_explanations_triple = explanations["lime"]["qa"], explanations["lime"]["triple"]
+shap_explanations_qa, shap_explanations_triple = explanations["kernel_shap"]["qa"], explanations["kernel_shap"]["triple"]
 
-# Explain triple predictions
-lime_explanations_triple = explain_with_lime(bart_triple_model, triple_val_loader_v4, task="triple", num_samples=5)
-shap_explanations_triple = explain_with_shap(bart_triple_model, triple_val_loader_v4, task="triple", num_samples=5)
+# Gradient explanations (fp32 only)
+gradient_explanations_qa, gradient_explanations_triple = [], []
+if CONFIG.INFERENCE_MODE == "fp32":
+    gradient_explanations_qa = explain_with_gradients(bart_qa_model, question_encoder_qa, candidate_store_qa, qa_val_loader_v4,
+                                                      task="qa", num_samples=CONFIG.EXPLANATION_NUM_EXAMPLES)
+    gradient_explanations_triple = explain_with_gradients(bart_triple_model, question_encoder_triple, candidate_store_triple, triple_val_loader_v4,
+                                                          task="triple", num_samples=CONFIG.EXPLANATION_NUM_EXAMPLES)
 
 # Save explanations
 explainability_results = {
     "lime_qa": lime_explanations_qa,
     "shap_qa": shap_explanations_qa,
     "lime_triple": lime_explanations_triple,
-    "shap_triple": shap_explanations_triple
+    "shap_triple": shap_explanations_triple,
+    "gradient_qa": gradient_explanations_qa,
+    "gradient_triple": gradient_explanations_triple
 }
 
 explainability_path = os.path.join(CONFIG.BASE_PATH, "explainability_results_v4.json")
 with open(explainability_path, "w") as f:
     json.dump(explainability_results, f)
 print(f"Saved explainability results at {explainability_path}")
+if explanation_store is not None:
+    print(f"Explanation store: {explanation_store.hits} hits / {explanation_store.misses} computed")
 
 # Print sample explanations
 print("\nSample LIME Explanation (QA):")
@@ -431,30 +927,255 @@ print(lime_explanations_triple[0])
 print("\nSample SHAP Explanation (Triple):")
 print(shap_explanations_triple[0])
 
+# Evaluation Metrics and Budgeted Stratified Sampling
+
+# Store id of each reference answer (-1 when it is not in the candidate pool)
+def reference_ids(references, candidate_index: dict) -> torch.Tensor:
+    return torch.tensor([candidate_index.get(ref, -1) for ref in references], dtype=torch.long)
+
+# 1-based rank of each reference among all candidates scored for its question: one count of the candidates scoring
+# strictly higher, so no sort is needed. Questions whose reference is not in the pool get 0.
+def full_ranks(similarities: torch.Tensor, ref_ids: torch.Tensor) -> torch.Tensor:
+    ref_ids = ref_ids.to(similarities.device)
+    ref_scores = similarities.gather(1, ref_ids.clamp(min=0)[:, None])
+    ranks = (similarities > ref_scores).sum(dim=1) + 1
+    return torch.where(ref_ids >= 0, ranks, torch.zeros_like(ranks)).cpu()
+
+# Every @k metric from one rank array: MRR@k (reciprocal rank inside the top k, else 0) and Precision@k (the
+# reference is in the top k; one relevant candidate per question). Returns {metric name: per-question values}.
+def rank_metrics(ranks: np.ndarray, k_values=(1, 5, 10)) -> dict:
+    ranks = np.asarray(ranks)
+    reciprocal = 1.0 / np.maximum(ranks, 1)
+    metrics = {"mrr": reciprocal}
+    for k in k_values:
+        metrics[f"mrr_at_{k}"] = np.where(ranks <= k, reciprocal, 0.0)
+        metrics[f"precision_at_{k}"] = (ranks <= k).astype(np.float64)
+    return metrics
+
+# Percentile bootstrap over questions for the mean of every metric at once. Each resample is a row of multinomial
+# counts over the questions, so all resampled means come from one (resamples x questions) @ (questions x metrics)
+# product instead of a Python loop. With per-question weights each resample's mean is the weighted mean.
+# Returns {metric: (low, high)}.
+def bootstrap_ci(metrics: dict, num_resamples: int = CONFIG.BOOTSTRAP_RESAMPLES, confidence: float = CONFIG.BOOTSTRAP_CONFIDENCE,
+                 seed: int = 42, weights: np.ndarray = None) -> dict:
+    names = list(metrics)
+    values = np.stack([metrics[name] for name in names], axis=1)  # (questions, metrics)
+    num_questions = values.shape[0]
+    if num_questions == 0:
+        return {name: (0.0, 0.0) for name in names}
+    rng = np.random.default_rng(seed)
+    counts = rng.multinomial(num_questions, np.full(num_questions, 1.0 / num_questions), size=num_resamples)
+    if weights is None:
+        means = counts @ values / num_questions  # (resamples, metrics)
+    else:
+        means = counts @ (values * weights[:, None]) / np.maximum(counts @ weights, 1e-12)[:, None]
+    alpha = (1.0 - confidence) / 2
+    low, high = np.quantile(means, [alpha, 1.0 - alpha], axis=0)
+    return {name: (float(low[j]), float(high[j])) for j, name in enumerate(names)}
+
+# Mean and bootstrap interval of each metric, keyed "<metric>" and "<metric>_ci" (weighted means with per-question weights)
+def summarize_metrics(metrics: dict, prefix: str = "", weights: np.ndarray = None) -> dict:
+    intervals = bootstrap_ci(metrics, weights=weights)
+    summary = {}
+    for name, values in metrics.items():
+        summary[f"{prefix}{name}"] = float(np.average(values, weights=weights)) if len(values) else 0.0
+        summary[f"{prefix}{name}_ci"] = list(intervals[name])
+    return summary
+
+# Predicate of every triple row: the "predicate" column Step 1 saves, or for CSVs written before it was saved the
+# question's last word (Step 1 builds triple questions as "<subject> <predicate>")
+def triple_predicates(data: pd.DataFrame) -> pd.Series:
+    if "predicate" in data.columns:
+        predicates = data["predicate"]
+    elif "question" in data.columns:
+        predicates = data["question"].astype(str).str.split().str[-1]
+    else:
+        raise ValueError("Triple rows carry neither a predicate nor a question column; re-run Step 1 to stratify by predicate")
+    if predicates.isna().any():
+        raise ValueError(f"{int(predicates.isna().sum())} triple rows have no predicate; re-run Step 1 to stratify by predicate")
+    return predicates.astype(str)
+
+# Stratum of every validation row: task, answer length in words (1, 2-3, 4-7, 8+) and, for triples, the predicate
+def evaluation_strata(dataset) -> pd.Series:
+    answer_words = dataset.data["answer"].astype(str).str.split().str.len()
+    length_bins = pd.cut(answer_words, bins=[0, 1, 3, 7, np.inf], labels=["1", "2-3", "4-7", "8+"]).astype(str)
+    predicates = triple_predicates(dataset.data) if dataset.task == "triple" else pd.Series("-", index=dataset.data.index)
+    return (dataset.task + "|" + length_bins + "|" + predicates).reset_index(drop=True)
+
+# Draw per_stratum[stratum] rows from each stratum (all of them when it is smaller), avoiding the rows in exclude
+def draw_from_strata(strata: pd.Series, per_stratum: dict, seed: int = 42, exclude=()) -> list:
+    rng = np.random.default_rng(seed)
+    excluded = set(exclude)
+    indices = []
+    for stratum, rows in strata.groupby(strata).groups.items():
+        available = [row for row in rows if row not in excluded]
+        take = min(per_stratum.get(stratum, 0), len(available))
+        indices.extend(rng.choice(available, size=take, replace=False).tolist())
+    return sorted(indices)
+
+# DataLoader over the given rows of a validation dataset, in order
+def subset_loader(dataset, indices: list) -> DataLoader:
+    return DataLoader(Subset(dataset, indices), batch_size=CONFIG.BATCH_SIZE, shuffle=False, num_workers=CONFIG.NUM_WORKERS)
+
+# Within-stratum variance of one metric per sampled stratum. A stratum with a single sampled row has no variance
+# estimate of its own, so it takes the pooled within-stratum variance of the strata with two or more rows, or the
+# variance of the whole sample when no stratum has two rows yet.
+def stratum_variances(values: np.ndarray, sample_strata: pd.Series) -> pd.Series:
+    groups = pd.Series(values).groupby(sample_strata.values)
+    sizes, variances = groups.size(), groups.var(ddof=1)
+    repeated = sizes > 1
+    if repeated.any():
+        pooled = float(((sizes[repeated] - 1) * variances[repeated]).sum() / (sizes[repeated] - 1).sum())
+    else:
+        pooled = float(np.var(values, ddof=1)) if len(values) > 1 else 0.0
+    return variances.where(repeated, pooled)
+
+# Stratified mean of one metric, weighting each stratum by its share of the population, with a normal interval whose
+# variance includes the finite population correction (singleton strata use the pooled variance, see stratum_variances)
+def stratified_estimate(values: np.ndarray, sample_strata: pd.Series, population_counts: pd.Series,
+                        confidence: float = CONFIG.EVAL_CONFIDENCE) -> dict:
+    z = NormalDist().inv_cdf(0.5 + confidence / 2)
+    total = population_counts.sum()
+    variances = stratum_variances(values, sample_strata)
+    mean, variance = 0.0, 0.0
+    for stratum, group in pd.Series(values).groupby(sample_strata.values):
+        weight = population_counts[stratum] / total
+        mean += weight * group.mean()
+        variance += weight ** 2 * (1 - len(group) / population_counts[stratum]) * variances[stratum] / len(group)
+    half_width = z * math.sqrt(variance)
+    return {"mean": float(mean), "ci": [float(mean - half_width), float(mean + half_width)], "half_width": float(half_width)}
+
+# Sample size reaching a target half-width under proportional allocation: n0 = z^2 * sum(W_h * s_h^2) / h^2, then the
+# finite population correction n = n0 / (1 + n0 / N)
+def required_sample_size(values: np.ndarray, sample_strata: pd.Series, population_counts: pd.Series, target_half_width: float,
+                         confidence: float = CONFIG.EVAL_CONFIDENCE) -> int:
+    z = NormalDist().inv_cdf(0.5 + confidence / 2)
+    total = population_counts.sum()
+    weighted_variance = sum(population_counts[stratum] / total * variance
+                            for stratum, variance in stratum_variances(values, sample_strata).items())
+    n0 = z ** 2 * weighted_variance / target_half_width ** 2
+    return int(math.ceil(n0 / (1 + n0 / total)))
+
+# Per-example metrics for the budgeted sample: BLEU and ROUGE-L of BART's answer (through the generation cache, so
+# evaluate_bart reuses these generations) and DPR's reciprocal rank and hit@1 over the full candidate store
+def example_metrics(bart_model, question_encoder, candidate_store, dataset, indices: list) -> dict:
+    bart_model.eval()
+    question_encoder.eval()
+    cache = open_bart_generation_cache(bart_model) if CONFIG.USE_PREDICTION_CACHE else None
+    candidate_index = {candidate: idx for idx, candidate in enumerate(candidate_store.candidates)}
+    metrics = {"bleu": [], "rouge_l": [], "dpr_reciprocal_rank": [], "dpr_hit_at_1": []}
+    with torch.no_grad():
+        for batch in subset_loader(dataset, indices):
+            input_ids = batch["bart_input_ids"].to(CONFIG.DEVICE)
+            attention_mask = batch["bart_attention_mask"].to(CONFIG.DEVICE)
+            generated_texts = cached_generate(bart_model, bart_tokenizer, input_ids, attention_mask, bart_eval_generation_config, cache)
+            for gen, ref in zip(generated_texts, batch["answer"]):
+                gen, ref = normalize_text(gen), normalize_text(ref)
+                metrics["bleu"].append(compute_bleu(gen, ref))
+                metrics["rouge_l"].append(compute_rouge_l(gen, ref))
+            question_embeddings = question_encoder(input_ids=batch["dpr_input_ids"].to(CONFIG.DEVICE),
+                                                   attention_mask=batch["dpr_attention_mask"].to(CONFIG.DEVICE)).pooler_output
+            ranks = full_ranks(candidate_store.scores(question_embeddings), reference_ids(batch["answer"], candidate_index)).numpy()
+            metrics["dpr_reciprocal_rank"].extend(np.where(ranks > 0, 1.0 / np.maximum(ranks, 1), 0.0).tolist())
+            metrics["dpr_hit_at_1"].extend((ranks == 1).astype(np.float64).tolist())
+    return {name: np.asarray(values, dtype=np.float64) for name, values in metrics.items()}
+
+# Budgeted stratified evaluation of one task. A pilot of up to pilot_per_stratum rounds, one row per stratum each,
+# estimates each metric's per-stratum variance and the seconds per example; it stops after the round that exhausts
+# budget_seconds. The sample is then grown, with proportional allocation, to the size the noisiest metric needs for
+# target_half_width, or to what the remaining budget affords if that is smaller. Returns the sampled row indices with
+# their expansion weights (stratum population / rows sampled from it) and, per metric, the stratified estimate and
+# the half-width actually achieved.
+def plan_budgeted_evaluation(bart_model, question_encoder, candidate_store, dataset, task: str = "qa",
+                             budget_seconds: float = CONFIG.EVAL_BUDGET_SECONDS, target_half_width: float = CONFIG.EVAL_TARGET_HALF_WIDTH,
+                             confidence: float = CONFIG.EVAL_CONFIDENCE, pilot_per_stratum: int = CONFIG.EVAL_PILOT_PER_STRATUM,
+                             seed: int = 42) -> dict:
+    strata = evaluation_strata(dataset)
+    population_counts = strata.value_counts()
+    pilot, pilot_metrics, pilot_seconds = [], {}, 0.0
+    for pilot_round in range(pilot_per_stratum):
+        rows = draw_from_strata(strata, {stratum: 1 for stratum in population_counts.index}, seed=seed + pilot_round, exclude=pilot)
+        if not rows:
+            break
+        start = time.perf_counter()
+        round_metrics = example_metrics(bart_model, question_encoder, candidate_store, dataset, rows)
+        pilot_seconds += time.perf_counter() - start
+        pilot += rows
+        pilot_metrics = {name: np.concatenate([pilot_metrics.get(name, np.zeros(0)), values]) for name, values in round_metrics.items()}
+        if pilot_seconds >= budget_seconds:
+            break
+    seconds_per_example = pilot_seconds / max(len(pilot), 1)
+
+    needed = max(required_sample_size(values, strata[pilot], population_counts, target_half_width, confidence)
+                 for values in pilot_metrics.values())
+    affordable = len(pilot) + int(max(budget_seconds - pilot_seconds, 0) / max(seconds_per_example, 1e-9))
+    sample_size = min(max(needed, len(pilot)), affordable, len(strata))
+    allocation = {stratum: max(int(round(sample_size * count / len(strata))) - int((strata[pilot] == stratum).sum()), 0)
+                  for stratum, count in population_counts.items()}
+    extra = draw_from_strata(strata, allocation, seed=seed + pilot_per_stratum, exclude=pilot)
+    extra_metrics = example_metrics(bart_model, question_encoder, candidate_store, dataset, extra) if extra else {name: np.zeros(0) for name in pilot_metrics}
+
+    indices = pilot + extra
+    sample_strata = strata[indices]
+    estimates = {name: stratified_estimate(np.concatenate([pilot_metrics[name], extra_metrics[name]]), sample_strata, population_counts, confidence)
+                 for name in pilot_metrics}
+    sample_counts = sample_strata.value_counts()
+    ordered_strata = strata[sorted(indices)]
+    plan = {
+        "task": task,
+        "population": int(len(strata)),
+        "strata": int(len(population_counts)),
+        "sample_size": int(len(indices)),
+        "needed_sample_size": int(needed),
+        "budget_limited": bool(needed > sample_size and sample_size < len(strata)),
+        "seconds_per_example": seconds_per_example,
+        "target_half_width": target_half_width,
+        "confidence": confidence,
+        "estimates": estimates,
+        "indices": sorted(indices),
+        "weights": (population_counts[ordered_strata].values / sample_counts[ordered_strata].values).tolist()
+    }
+    print(f"Budgeted evaluation ({task}): {plan['sample_size']}/{plan['population']} rows over {plan['strata']} strata "
+          f"(needed {needed}{', budget-limited' if plan['budget_limited'] else ''}), {seconds_per_example * 1000:.1f} ms per example")
+    for name, estimate in estimates.items():
+        print(f"{name}: {estimate['mean']:.4f} +/- {estimate['half_width']:.4f} ({int(confidence * 100)}% CI)")
+    return plan
+
+# Evaluation loaders: the full validation sets, or in budgeted mode the stratified samples sized above. Parts 1-3 and
+# the qualitative analysis run on these, and in budgeted mode Parts 1-3 weight every row by its expansion weight so
+# their headline means estimate the full validation set; the stratified estimates and achieved bounds are saved too.
+budgeted_evaluation_plans = {}
+qa_eval_loader, triple_eval_loader = qa_val_loader_v4, triple_val_loader_v4
+if CONFIG.EVAL_MODE == "budgeted":
+    budgeted_evaluation_plans["qa"] = plan_budgeted_evaluation(bart_qa_model, question_encoder_qa, candidate_store_qa, qa_val_loader_v4.dataset, task="qa")
+    budgeted_evaluation_plans["triple"] = plan_budgeted_evaluation(bart_triple_model, question_encoder_triple, candidate_store_triple,
+                                                                   triple_val_loader_v4.dataset, task="triple")
+    qa_eval_loader = subset_loader(qa_val_loader_v4.dataset, budgeted_evaluation_plans["qa"]["indices"])
+    triple_eval_loader = subset_loader(triple_val_loader_v4.dataset, budgeted_evaluation_plans["triple"]["indices"])
+
+# Per-row weights of a task's evaluation loader, in loader order (None when the full validation set is evaluated)
+def sample_weights(task: str):
+    plan = budgeted_evaluation_plans.get(task)
+    return None if plan is None else np.asarray(plan["weights"], dtype=np.float64)
+
 # (Part 1): Quantitative Validation - Evaluate BART
 
-# Evaluate BART on both QA and triple tasks
-def evaluate_bart(model, val_loader, task: str = "qa"):
+# Evaluate BART on both QA and triple tasks (weighted means when per-example weights are given)
+def evaluate_bart(model, val_loader, task: str = "qa", use_cache: bool = CONFIG.USE_PREDICTION_CACHE, weights: np.ndarray = None):
     print(f"Evaluating BART for {task}...")
     model.eval()
     bleu_scores, rouge_scores, bert_scores = [], [], []
     sample_outputs = []
     scorer = rouge_scorer.RougeScorer(['rougeL'], use_stemmer=True)
+    cache = open_bart_generation_cache(model) if use_cache else None
 
     with torch.no_grad():
         for batch in tqdm(val_loader, desc=f"Evaluating {task}"):
             input_ids = batch["bart_input_ids"].to(CONFIG.DEVICE)
             attention_mask = batch["bart_attention_mask"].to(CONFIG.DEVICE)
             references = batch["answer"]
-            generated_ids = model.generate(
-                input_ids=input_ids,
-                attention_mask=attention_mask,
-                max_new_tokens=100,
-                num_beams=10,  # Reduced from 20 to 10
-                temperature=0.5,
-                no_repeat_ngram_size=2
-            )
-            generated_texts = [bart_tokenizer.decode(g_ids, skip_special_tokens=True) for g_ids in generated_ids]
+            # No attention capture here: beam-search attentions for the whole split are costly and unused by the metrics
+            generated_texts = cached_generate(model, bart_tokenizer, input_ids, attention_mask, bart_eval_generation_config, cache)
             for gen, ref in zip(generated_texts, references):
                 gen = normalize_text(gen)
                 ref = normalize_text(ref)
@@ -465,11 +1186,13 @@ def evaluate_bart(model, val_loader, task: str = "qa"):
                 rouge_scores.append(rouge)
                 bert_scores.append(bert_f1)
                 sample_outputs.append((gen, ref))
-            del input_ids, attention_mask, generated_ids
+            del input_ids, attention_mask
             torch.cuda.empty_cache()
-    avg_bleu = np.mean(bleu_scores)
-    avg_rouge = np.mean(rouge_scores)
-    avg_bert = np.mean(bert_scores)
+    if cache:
+        print(f"Prediction cache: {cache.hits} hits, {cache.misses} misses")
+    avg_bleu = np.average(bleu_scores, weights=weights)
+    avg_rouge = np.average(rouge_scores, weights=weights)
+    avg_bert = np.average(bert_scores, weights=weights)
     print(f"BART {task} Evaluation:")
     print(f"Average BLEU: {avg_bleu:.4f}")
     print(f"Average ROUGE-L: {avg_rouge:.4f}")
@@ -481,115 +1204,147 @@ def evaluate_bart(model, val_loader, task: str = "qa"):
     return avg_bleu, avg_rouge, avg_bert
 
 # Evaluate BART on QA and triple tasks
-bart_qa_bleu, bart_qa_rouge, bart_qa_bert = evaluate_bart(bart_qa_model, qa_val_loader_v4, task="qa")
-bart_triple_bleu, bart_triple_rouge, bart_triple_bert = evaluate_bart(bart_triple_model, triple_val_loader_v4, task="triple")
+bart_qa_bleu, bart_qa_rouge, bart_qa_bert = evaluate_bart(bart_qa_model, qa_eval_loader, task="qa", weights=sample_weights("qa"))
+bart_triple_bleu, bart_triple_rouge, bart_triple_bert = evaluate_bart(bart_triple_model, triple_eval_loader, task="triple",
+                                                                     weights=sample_weights("triple"))
 
 # (Part 2): Quantitative Validation - Evaluate DPR (Optimized for Version 3)
 
-# Evaluate DPR on both QA and triple tasks at k=1, 5, 10
-def evaluate_dpr_k(ctx_encoder, question_encoder, val_loader, candidates, k_values=[1, 5, 10], task: str = "qa"):
-    ctx_encoder.eval()
+# Evaluate DPR against the full candidate store: each batch of questions is scored against every stored candidate,
+# reduced to the reference's rank, and all @k metrics and their bootstrap intervals come from the rank array
+# (weighted by the per-question weights when given)
+def evaluate_dpr_k(question_encoder, candidate_store, val_loader, k_values=(1, 5, 10), task: str = "qa", weights: np.ndarray = None):
     question_encoder.eval()
-    mrr_k, precision_k = {k: [] for k in k_values}, {k: [] for k in k_values}
-    eval_candidates = candidates[:500]  # Reduced from 1000 to 500
-    print(f"Task: {task}, Using candidate pool size: {len(eval_candidates)}")
-    candidate_inputs = ctx_tokenizer(eval_candidates, return_tensors="pt", padding=True, truncation=True, max_length=CONFIG.MAX_LENGTH)
-    candidate_inputs = {k: v.to(CONFIG.DEVICE) for k, v in candidate_inputs.items()}
-    with torch.no_grad():
-        candidate_embeddings = ctx_encoder(**candidate_inputs).pooler_output
+    print(f"Task: {task}, Using candidate pool size: {len(candidate_store)}")
+    candidate_index = {candidate: idx for idx, candidate in enumerate(candidate_store.candidates)}
+    ranks = []
     with torch.no_grad():
         for batch in tqdm(val_loader, desc=f"Evaluating DPR {task}"):
-            question_inputs = {
-                "input_ids": batch["dpr_input_ids"].to(CONFIG.DEVICE),
-                "attention_mask": batch["dpr_attention_mask"].to(CONFIG.DEVICE)
-            }
-            references = batch["answer"]
-            question_embeddings = question_encoder(**question_inputs).pooler_output
-            similarities = torch.matmul(question_embeddings, candidate_embeddings.T)
-            rankings = torch.argsort(similarities, dim=1, descending=True)
-            for i, (ranking, ref) in enumerate(zip(rankings, references)):
-                ref_idx = eval_candidates.index(ref) if ref in eval_candidates else -1
-                if ref_idx == -1:
-                    continue
-                for k in k_values:
-                    top_k_indices = ranking[:k]
-                    rank = (top_k_indices == ref_idx).nonzero(as_tuple=True)[0].item() + 1 if ref_idx in top_k_indices else len(eval_candidates)
-                    mrr_k[k].append(1.0 / rank)
-                    precision_k[k].append(1.0 if ref_idx in top_k_indices else 0.0)
-            del question_inputs, similarities, rankings
+            question_embeddings = question_encoder(input_ids=batch["dpr_input_ids"].to(CONFIG.DEVICE),
+                                                   attention_mask=batch["dpr_attention_mask"].to(CONFIG.DEVICE)).pooler_output
+            ranks.append(full_ranks(candidate_store.scores(question_embeddings), reference_ids(batch["answer"], candidate_index)))
+            del question_embeddings
             torch.cuda.empty_cache()
-    results = {}
+    ranks = torch.cat(ranks).numpy()
+    found = ranks > 0
+    print(f"{task}: {int(found.sum())}/{len(ranks)} references in the candidate pool")
+    results = summarize_metrics(rank_metrics(ranks[found], k_values), weights=None if weights is None else weights[found])
+    results["reference_coverage"] = float(np.average(found, weights=weights)) if len(ranks) else 0.0
+    results["median_rank"] = float(np.median(ranks[found])) if found.any() else 0.0
+    print(f"DPR Evaluation ({task}), {int(CONFIG.BOOTSTRAP_CONFIDENCE * 100)}% bootstrap intervals:")
+    print(f"MRR: {results['mrr']:.4f} [{results['mrr_ci'][0]:.4f}, {results['mrr_ci'][1]:.4f}], median rank {results['median_rank']:.0f}")
     for k in k_values:
-        avg_mrr = np.mean(mrr_k[k])
-        avg_precision = np.mean(precision_k[k])
-        results[f"mrr_at_{k}"] = avg_mrr
-        results[f"precision_at_{k}"] = avg_precision
-        print(f"DPR Evaluation ({task}) at k={k}:")
-        print(f"MRR@{k}: {avg_mrr:.4f}")
-        print(f"Precision@{k}: {avg_precision:.4f}")
+        print(f"MRR@{k}: {results[f'mrr_at_{k}']:.4f} [{results[f'mrr_at_{k}_ci'][0]:.4f}, {results[f'mrr_at_{k}_ci'][1]:.4f}]")
+        print(f"Precision@{k}: {results[f'precision_at_{k}']:.4f} [{results[f'precision_at_{k}_ci'][0]:.4f}, {results[f'precision_at_{k}_ci'][1]:.4f}]")
     return results
 
 # Evaluate DPR on QA and triple tasks
-dpr_qa_metrics = evaluate_dpr_k(ctx_encoder_qa, question_encoder_qa, qa_val_loader_v4, all_candidates, task="qa")
-dpr_triple_metrics = evaluate_dpr_k(ctx_encoder_triple, question_encoder_triple, triple_val_loader_v4, all_candidates, task="triple")
+dpr_qa_metrics = evaluate_dpr_k(question_encoder_qa, candidate_store_qa, qa_eval_loader, task="qa", weights=sample_weights("qa"))
+dpr_triple_metrics = evaluate_dpr_k(question_encoder_triple, candidate_store_triple, triple_eval_loader, task="triple",
+                                    weights=sample_weights("triple"))
 
 # (Part 3): Quantitative Validation - Evaluate DPR-based Ensemble
 
-# Evaluate DPR-based Ensemble on both QA and triple tasks at k=1, 5, 10
-def ensemble_evaluate_dpr_k(ctx_encoder, question_encoder, val_loader, candidates, k_values=[1, 5, 10], top_k: int = 30, task: str = "qa"):
-    print(f"Evaluating DPR-based ensemble for {task}...")
-    ctx_encoder.eval()
+# Load the fine-tuned re-ranker for a task, falling back to the pretrained MS MARCO cross-encoder
+def load_cross_encoder(task: str = "qa") -> CrossEncoder:
+    path = os.path.join(CONFIG.BASE_PATH, f"cross_encoder_{task}_v4")
+    model_name = path if os.path.isdir(path) else CONFIG.CROSS_ENCODER_MODEL_NAME
+    return CrossEncoder(model_name, num_labels=1, max_length=CONFIG.CROSS_ENCODER_MAX_LENGTH, device=str(CONFIG.DEVICE))
+
+# Two-stage cascade for one batch: DPR pulls retrieve_top_k candidates from the store, then the cross-encoder
+# scores only the first rerank_top_k (question, candidate) pairs, fewer when an early cutoff applies.
+# Returns the DPR and cascade orders as (batch, retrieve_top_k) candidate ids, seconds per stage and pairs scored.
+def cascade_retrieve_rerank(question_encoder, cross_encoder, candidate_store, questions, input_ids, attention_mask,
+                            retrieve_top_k: int = CONFIG.RETRIEVE_TOP_K, rerank_top_k: int = CONFIG.RERANK_TOP_K,
+                            skip_margin: float = CONFIG.RERANK_SKIP_MARGIN, score_window: float = CONFIG.RERANK_SCORE_WINDOW):
+    stage_seconds = {}
+    start = time.perf_counter()
+    question_embeddings = question_encoder(input_ids=input_ids, attention_mask=attention_mask).pooler_output
+    top_scores, dpr_ids = torch.topk(candidate_store.scores(question_embeddings), k=min(retrieve_top_k, len(candidate_store)), dim=1)
+    top_scores, dpr_ids = top_scores.cpu(), dpr_ids.cpu()  # Copy to host also waits for the GPU
+    stage_seconds["retrieve"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    cascade_ids = dpr_ids.clone()
+    pairs, slots = [], []
+    for i, question in enumerate(questions):
+        if skip_margin is not None and top_scores.size(1) > 1 and top_scores[i, 0] - top_scores[i, 1] >= skip_margin:
+            continue
+        budget = min(rerank_top_k, dpr_ids.size(1))
+        if score_window is not None:
+            budget = int((top_scores[i, :budget] >= top_scores[i, 0] - score_window).sum())
+        if budget < 2:
+            continue
+        slots.append((i, budget, len(pairs)))
+        pairs.extend((question, candidate_store.candidates[idx]) for idx in dpr_ids[i, :budget].tolist())
+    if pairs:
+        pair_scores = torch.as_tensor(cross_encoder.predict(pairs, batch_size=CONFIG.CROSS_ENCODER_BATCH_SIZE, show_progress_bar=False))
+        for i, budget, offset in slots:
+            order = torch.argsort(pair_scores[offset:offset + budget], descending=True)
+            cascade_ids[i, :budget] = dpr_ids[i, :budget][order]
+    stage_seconds["rerank"] = time.perf_counter() - start
+    return dpr_ids, cascade_ids, stage_seconds, len(pairs)
+
+# 1-based rank of each reference in a row of candidate ids (0 when it was not retrieved)
+def reference_ranks(ranked_ids: torch.Tensor, ref_ids: torch.Tensor) -> torch.Tensor:
+    matches = ranked_ids == ref_ids[:, None]
+    return torch.where(matches.any(dim=1), matches.int().argmax(dim=1) + 1, torch.zeros(len(ref_ids), dtype=torch.long))
+
+# Compare DPR and cascade orders over questions whose reference DPR retrieved, with bootstrap intervals and
+# per-stage latency. Quality metrics use the per-question weights when given; cost metrics are per question evaluated.
+def summarize_cascade(dpr_ranks: np.ndarray, cascade_ranks: np.ndarray, stage_seconds: dict, num_pairs: int, k_values=(1,), task: str = "qa",
+                      weights: np.ndarray = None) -> dict:
+    retrieved = dpr_ranks > 0
+    num_questions = max(len(dpr_ranks), 1)
+    recall = float(np.average(retrieved, weights=weights)) if len(dpr_ranks) else 0.0
+    report = {"recall_at_retrieve": recall, "pairs_per_question": num_pairs / num_questions}
+    for stage, seconds in stage_seconds.items():
+        report[f"{stage}_ms_per_question"] = 1000 * seconds / num_questions
+    for name, ranks in (("dpr", dpr_ranks), ("cascade", cascade_ranks)):
+        metrics = rank_metrics(ranks[retrieved], k_values)
+        selected = {f"mrr_at_{k}": metrics[f"mrr_at_{k}"] for k in k_values}
+        selected.update({f"hit_at_{k}": metrics[f"precision_at_{k}"] for k in k_values})
+        selected["precision_at_1"] = (ranks[retrieved] == 1).astype(np.float64)
+        report.update(summarize_metrics(selected, prefix=f"{name}_", weights=None if weights is None else weights[retrieved]))
+    print(f"Cascade Evaluation ({task}): DPR P@1 {report['dpr_precision_at_1']:.4f} {report['dpr_precision_at_1_ci']} -> "
+          f"cascade P@1 {report['cascade_precision_at_1']:.4f} {report['cascade_precision_at_1_ci']}")
+    for k in k_values:
+        print(f"MRR@{k}: DPR {report[f'dpr_mrr_at_{k}']:.4f}, cascade {report[f'cascade_mrr_at_{k}']:.4f}")
+    print(f"Recall@{CONFIG.RETRIEVE_TOP_K}: {report['recall_at_retrieve']:.4f}, pairs re-ranked per question: {report['pairs_per_question']:.1f}")
+    print(f"Latency per question: retrieve {report['retrieve_ms_per_question']:.2f} ms, rerank {report['rerank_ms_per_question']:.2f} ms")
+    return report
+
+# Evaluate the DPR -> cross-encoder cascade on both QA and triple tasks at k=1, 5, 10
+def ensemble_evaluate_dpr_k(question_encoder, cross_encoder, candidate_store, val_loader, k_values=(1, 5, 10), task: str = "qa",
+                            weights: np.ndarray = None):
+    print(f"Evaluating DPR -> cross-encoder cascade for {task}...")
     question_encoder.eval()
-    mrr_k, precision_k = {k: [] for k in k_values}, {k: [] for k in k_values}
-    eval_candidates = candidates[:500]  # Reduced from 1000 to 500
-    candidate_inputs = ctx_tokenizer(eval_candidates, return_tensors="pt", padding=True, truncation=True, max_length=CONFIG.MAX_LENGTH)
-    candidate_inputs = {k: v.to(CONFIG.DEVICE) for k, v in candidate_inputs.items()}
-    with torch.no_grad():
-        candidate_embeddings = ctx_encoder(**candidate_inputs).pooler_output
+    candidate_index = {candidate: idx for idx, candidate in enumerate(candidate_store.candidates)}
+    dpr_ranks, cascade_ranks = [], []
+    stage_seconds = {"retrieve": 0.0, "rerank": 0.0}
+    num_pairs = 0
     with torch.no_grad():
         for batch in tqdm(val_loader, desc=f"Ensemble Evaluating {task}"):
-            question_inputs = {
-                "input_ids": batch["dpr_input_ids"].to(CONFIG.DEVICE),
-                "attention_mask": batch["dpr_attention_mask"].to(CONFIG.DEVICE)
-            }
-            references = batch["answer"]
-            question_embeddings = question_encoder(**question_inputs).pooler_output
-            similarities = torch.matmul(question_embeddings, candidate_embeddings.T)
-            rankings = torch.argsort(similarities, dim=1, descending=True)
-            top_k_indices = rankings[:, :top_k]  # Shape: (batch_size, top_k)
-            batch_size = top_k_indices.size(0)
-            for i in range(batch_size):
-                top_k_candidate_indices = top_k_indices[i].cpu().numpy()
-                top_k_candidates = [eval_candidates[idx] for idx in top_k_candidate_indices]
-                ref = references[i]
-                ref_idx = top_k_candidates.index(ref) if ref in top_k_candidates else -1
-                if ref_idx == -1:
-                    continue
-                for k in k_values:
-                    top_k_subset = top_k_indices[i, :k]
-                    matches = torch.where(top_k_subset == top_k_candidate_indices[ref_idx])[0]
-                    if matches.numel() > 0:
-                        rank = matches[0].item() + 1
-                    else:
-                        rank = len(top_k_candidates)
-                    mrr_k[k].append(1.0 / rank)
-                    precision_k[k].append(1.0 if rank == 1 else 0.0)
-            del question_inputs, similarities, rankings, top_k_indices
-            torch.cuda.empty_cache()
-    results = {}
-    for k in k_values:
-        avg_mrr = np.mean(mrr_k[k]) if mrr_k[k] else 0.0
-        avg_precision = np.mean(precision_k[k]) if precision_k[k] else 0.0
-        results[f"mrr_at_{k}"] = avg_mrr
-        results[f"precision_at_{k}"] = avg_precision
-        print(f"DPR-based Ensemble Evaluation ({task}) at k={k}:")
-        print(f"MRR@{k}: {avg_mrr:.4f}")
-        print(f"Precision@{k}: {avg_precision:.4f}")
-    return results
+            dpr_ids, cascade_ids, batch_seconds, batch_pairs = cascade_retrieve_rerank(
+                question_encoder, cross_encoder, candidate_store, batch["question"],
+                batch["dpr_input_ids"].to(CONFIG.DEVICE), batch["dpr_attention_mask"].to(CONFIG.DEVICE)
+            )
+            ref_ids = reference_ids(batch["answer"], candidate_index)
+            dpr_ranks.append(reference_ranks(dpr_ids, ref_ids))
+            cascade_ranks.append(reference_ranks(cascade_ids, ref_ids))
+            for stage, seconds in batch_seconds.items():
+                stage_seconds[stage] += seconds
+            num_pairs += batch_pairs
+    return summarize_cascade(torch.cat(dpr_ranks).numpy(), torch.cat(cascade_ranks).numpy(), stage_seconds, num_pairs,
+                             k_values=k_values, task=task, weights=weights)
 
 # Evaluate ensemble on QA and triple tasks
-ensemble_qa_metrics = ensemble_evaluate_dpr_k(ctx_encoder_qa, question_encoder_qa, qa_val_loader_v4, all_candidates, task="qa")
-ensemble_triple_metrics = ensemble_evaluate_dpr_k(ctx_encoder_triple, question_encoder_triple, triple_val_loader_v4, all_candidates, task="triple")
+cross_encoder_qa = load_cross_encoder("qa")
+cross_encoder_triple = load_cross_encoder("triple")
+ensemble_qa_metrics = ensemble_evaluate_dpr_k(question_encoder_qa, cross_encoder_qa, candidate_store_qa, qa_eval_loader, task="qa",
+                                              weights=sample_weights("qa"))
+ensemble_triple_metrics = ensemble_evaluate_dpr_k(question_encoder_triple, cross_encoder_triple, candidate_store_triple, triple_eval_loader, task="triple",
+                                                  weights=sample_weights("triple"))
 
 # (Part 4): Quantitative Validation - Save Results
 
@@ -600,7 +1355,10 @@ quantitative_results = {
     "dpr_qa": dpr_qa_metrics,
     "dpr_triple": dpr_triple_metrics,
     "ensemble_qa": ensemble_qa_metrics,
-    "ensemble_triple": ensemble_triple_metrics
+    "ensemble_triple": ensemble_triple_metrics,
+    "evaluation_mode": CONFIG.EVAL_MODE,
+    "budgeted_sampling": {task: {key: value for key, value in plan.items() if key not in ("indices", "weights")}
+                          for task, plan in budgeted_evaluation_plans.items()}
 }
 
 quantitative_path = os.path.join(CONFIG.BASE_PATH, "quantitative_results_v4.json")
@@ -611,11 +1369,14 @@ print(f"Saved quantitative results at {quantitative_path}")
 # Qualitative Analysis (Human Assessment)
 
 # Qualitative Analysis
-def qualitative_analysis(model, val_loader, task: str = "qa", num_samples: int = 5):  # Reduced to 5 samples
+def qualitative_analysis(model, val_loader, task: str = "qa", num_samples: int = 5,  # Reduced to 5 samples
+                         use_cache: bool = CONFIG.USE_PREDICTION_CACHE, capture_attention: bool = CONFIG.CAPTURE_ATTENTION_ROLLOUT):
     print(f"Performing qualitative analysis for {task}...")
     model.eval()
     samples = []
     samples_processed = 0
+    # Same decoding config as evaluate_bart, so these predictions are served from its cache
+    cache = open_bart_generation_cache(model) if use_cache else None
 
     with torch.no_grad():
         for batch in val_loader:
@@ -629,33 +1390,44 @@ def qualitative_analysis(model, val_loader, task: str = "qa", num_samples: int =
             for i in range(input_ids.size(0)):
                 if samples_processed >= num_samples:
                     break
-                generated_ids = model.generate(
-                    input_ids=input_ids[i:i+1],
-                    attention_mask=attention_mask[i:i+1],
-                    max_new_tokens=100,
-                    num_beams=10,  # Reduced from 20 to 10
-                    temperature=0.5,
-                    no_repeat_ngram_size=2
-                )
-                generated_text = bart_tokenizer.decode(generated_ids[0], skip_special_tokens=True)
+                if capture_attention:
+                    generated, rollouts = cached_generate(model, bart_tokenizer, input_ids[i:i+1], attention_mask[i:i+1], bart_eval_generation_config,
+                                                          cache, rollout_fn=generation_rollouts)
+                    generated_text, rollout = generated[0], rollouts[0]
+                else:
+                    generated_text = cached_generate(model, bart_tokenizer, input_ids[i:i+1], attention_mask[i:i+1], bart_eval_generation_config, cache)[0]
+                    rollout = None
                 samples.append({
                     "question": questions[i],
                     "generated": generated_text,
                     "reference": references[i],
                     "coherence": "Incoherent" if generated_text.lower() in ["answer", "dasksk"] else "Coherent",
                     "reliability": "Reliable" if generated_text.lower() == references[i].lower() else "Unreliable",
-                    "interpretability": "Interpretable" if generated_text.lower() not in ["answer", "dasksk"] else "Not Interpretable"
+                    "interpretability": "Interpretable" if generated_text.lower() not in ["answer", "dasksk"] else "Not Interpretable",
+                    "attention_rollout": rollout
                 })
                 samples_processed += 1
 
-            del input_ids, attention_mask, generated_ids
+            del input_ids, attention_mask
             torch.cuda.empty_cache()
 
     return samples
 
 # Perform qualitative analysis for QA and triple tasks
-qa_qualitative = qualitative_analysis(bart_qa_model, qa_val_loader_v4, task="qa", num_samples=5)
-triple_qualitative = qualitative_analysis(bart_triple_model, triple_val_loader_v4, task="triple", num_samples=5)
+# Budgeted mode reviews one example per stratum instead of the first five
+def qualitative_loader(val_loader, seed: int = 42):
+    strata = evaluation_strata(val_loader.dataset)
+    indices = draw_from_strata(strata, {stratum: 1 for stratum in strata.unique()}, seed=seed)
+    return subset_loader(val_loader.dataset, indices), len(indices)
+
+if CONFIG.EVAL_MODE == "budgeted":
+    (qa_qualitative_loader, qa_qualitative_size), (triple_qualitative_loader, triple_qualitative_size) = \
+        qualitative_loader(qa_val_loader_v4), qualitative_loader(triple_val_loader_v4)
+else:
+    (qa_qualitative_loader, qa_qualitative_size), (triple_qualitative_loader, triple_qualitative_size) = \
+        (qa_val_loader_v4, 5), (triple_val_loader_v4, 5)
+qa_qualitative = qualitative_analysis(bart_qa_model, qa_qualitative_loader, task="qa", num_samples=qa_qualitative_size)
+triple_qualitative = qualitative_analysis(bart_triple_model, triple_qualitative_loader, task="triple", num_samples=triple_qualitative_size)
 
 # Print sample results
 print("\nSample Qualitative Analysis (QA):")
@@ -665,7 +1437,10 @@ for sample in qa_qualitative[:5]:
     print(f"Reference: {sample['reference']}")
     print(f"Coherence: {sample['coherence']}")
     print(f"Reliability: {sample['reliability']}")
-    print(f"Interpretability: {sample['interpretability']}\n")
+    print(f"Interpretability: {sample['interpretability']}")
+    if sample["attention_rollout"]:
+        print(f"Top attended tokens: {sorted(sample['attention_rollout'], key=lambda pair: pair[1], reverse=True)[:5]}")
+    print()
 
 print("\nSample Qualitative Analysis (Triple):")
 for sample in triple_qualitative[:5]:
@@ -674,7 +1449,10 @@ for sample in triple_qualitative[:5]:
     print(f"Reference: {sample['reference']}")
     print(f"Coherence: {sample['coherence']}")
     print(f"Reliability: {sample['reliability']}")
-    print(f"Interpretability: {sample['interpretability']}\n")
+    print(f"Interpretability: {sample['interpretability']}")
+    if sample["attention_rollout"]:
+        print(f"Top attended tokens: {sorted(sample['attention_rollout'], key=lambda pair: pair[1], reverse=True)[:5]}")
+    print()
 
 # Save qualitative results (Version 4)
 qualitative_results = {
@@ -685,4 +1463,142 @@ qualitative_results = {
 qualitative_path = os.path.join(CONFIG.BASE_PATH, "qualitative_analysis_v4.json")
 with open(qualitative_path, "w") as f:
     json.dump(qualitative_results, f)
-print(f"Saved qualitative analysis at {qualitative_path}")
\ No newline at end of file
+print(f"Saved qualitative analysis at {qualitative_path}")
+# Serving: Answer a Single Query
+
+# Answer one query with BART and retrieve supporting candidates with DPR, using the models of the selected inference mode
+# The answer carries its attention rollout by default; explain=True also attaches gradient x input attributions for
+# the answer and the top retrieved candidate (fp32 only)
+def answer_query(question: str, context: str, task: str = "qa", top_k: int = 5, explain: bool = False,
+                 capture_attention: bool = CONFIG.CAPTURE_ATTENTION_ROLLOUT):
+    bart_model = bart_qa_model if task == "qa" else bart_triple_model
+    question_encoder = question_encoder_qa if task == "qa" else question_encoder_triple
+    candidate_store = candidate_store_qa if task == "qa" else candidate_store_triple
+    text_input = bart_input_text(question, context, task)
+    bart_inputs = bart_tokenizer(text_input, return_tensors="pt", max_length=CONFIG.MAX_LENGTH, truncation=True).to(CONFIG.DEVICE)
+    question_inputs = question_tokenizer(question, return_tensors="pt", max_length=CONFIG.MAX_LENGTH, truncation=True).to(CONFIG.DEVICE)
+    with torch.no_grad():
+        generated = cached_generate(bart_model, bart_tokenizer, bart_inputs["input_ids"], bart_inputs["attention_mask"],
+                                    bart_eval_generation_config, rollout_fn=generation_rollouts if capture_attention else None)
+        answer, rollout = (generated[0][0], generated[1][0]) if capture_attention else (generated[0], None)
+        question_embedding = question_encoder(**question_inputs).pooler_output
+        similarities = candidate_store.scores(question_embedding)[0]
+        top_scores, top_ids = torch.topk(similarities, k=min(top_k, similarities.size(0)))
+    result = {
+        "answer": answer,
+        "attention_rollout": rollout,
+        "retrieved": [{"candidate": candidate_store.candidates[idx], "score": score} for idx, score in zip(top_ids.tolist(), top_scores.tolist())],
+        "inference_mode": CONFIG.INFERENCE_MODE
+    }
+    if explain:
+        # Frequent questions are answered from the explanation store without a backward pass
+        top_id = top_ids[0].item()
+        result.update(cached_explanation(
+            f"{explanation_model_hash(bart_model, question_encoder)}:{candidate_store.encoder_fingerprint}", "answer_query",
+            {"method": "grad_x_input", "generation": bart_eval_generation_config}, f"{text_input}\n{question}",
+            lambda: {
+                "answer_attributions": bart_gradient_attributions(bart_model, bart_tokenizer, text_input, result["answer"], method="grad_x_input"),
+                "retrieval_attributions": dpr_gradient_attributions(question_encoder, question, candidate_store.rows([top_id])[0], method="grad_x_input")
+            }
+        ))
+    return result
+
+sample_row = qa_val_loader_v4.dataset.data.iloc[0]
+print(answer_query(sample_row["question"], sample_row["context"], task="qa", explain=CONFIG.INFERENCE_MODE == "fp32"))
+
+# Int8 vs FP32 Accuracy and Latency Report (CPU)
+
+# Load the fp32 Step 2/3 models for a task on CPU, independent of the selected inference mode
+def load_fp32_models(task: str):
+    bart_model = load_pretrained_fast(BartForConditionalGeneration, os.path.join(save_path, f'bart_{task}_v4'), device="cpu")
+    ctx_encoder = load_pretrained_fast(DPRContextEncoder, os.path.join(CONFIG.BASE_PATH, f"dpr_ctx_encoder_rl_{task}_v4"), device="cpu")
+    question_encoder = load_pretrained_fast(DPRQuestionEncoder, os.path.join(CONFIG.BASE_PATH, f"dpr_question_encoder_rl_{task}_v4"), device="cpu")
+    return bart_model.eval(), ctx_encoder.eval(), question_encoder.eval()
+
+# Measure BLEU, MRR, P@k and per-item latency for one set of models on CPU
+def benchmark_inference_mode(bart_model, ctx_encoder, question_encoder, val_loader, candidates, k_values=(1, 5, 10),
+                             num_batches: int = 20, num_candidates: int = 500, num_latency_queries: int = 50):
+    eval_candidates = candidates[:num_candidates]
+    bleu_scores, mrr, precision_k = [], [], {k: [] for k in k_values}
+    generate_times, encode_times = [], []
+    with torch.no_grad():
+        start = time.perf_counter()
+        candidate_inputs = ctx_tokenizer(eval_candidates, return_tensors="pt", padding=True, truncation=True, max_length=CONFIG.MAX_LENGTH)
+        candidate_embeddings = ctx_encoder(**candidate_inputs).pooler_output
+        ctx_time = (time.perf_counter() - start) / len(eval_candidates)
+
+        for step, batch in enumerate(tqdm(val_loader, desc="Benchmarking", total=num_batches)):
+            if step >= num_batches:
+                break
+            start = time.perf_counter()
+            generated_ids = bart_model.generate(
+                input_ids=batch["bart_input_ids"],
+                attention_mask=batch["bart_attention_mask"],
+                **bart_eval_generation_config
+            )
+            generate_times.append((time.perf_counter() - start) / len(batch["answer"]))
+            for g_ids, ref in zip(generated_ids, batch["answer"]):
+                gen = normalize_text(bart_tokenizer.decode(g_ids, skip_special_tokens=True))
+                bleu_scores.append(compute_bleu(gen, normalize_text(ref)))
+
+            question_embeddings = question_encoder(input_ids=batch["dpr_input_ids"], attention_mask=batch["dpr_attention_mask"]).pooler_output
+            similarities = torch.matmul(question_embeddings, candidate_embeddings.T)
+            for sims, ref in zip(similarities, batch["answer"]):
+                if ref not in eval_candidates:
+                    continue
+                rank = (sims > sims[eval_candidates.index(ref)]).sum().item() + 1
+                mrr.append(1.0 / rank)
+                for k in k_values:
+                    precision_k[k].append(1.0 if rank <= k else 0.0)
+
+        # Per-query question encoder latency at serving shape (batch size 1, no padding)
+        for question in val_loader.dataset.data["question"].tolist()[:num_latency_queries]:
+            question_inputs = question_tokenizer(question, return_tensors="pt", max_length=CONFIG.MAX_LENGTH, truncation=True)
+            start = time.perf_counter()
+            question_encoder(**question_inputs)
+            encode_times.append(time.perf_counter() - start)
+
+    results = {
+        "bleu": float(np.mean(bleu_scores)),
+        "mrr": float(np.mean(mrr)) if mrr else 0.0,
+        "generate_latency_ms": 1000 * float(np.mean(generate_times)),
+        "question_encoder_latency_ms": 1000 * float(np.mean(encode_times)),
+        "ctx_encoder_latency_ms": 1000 * ctx_time,
+        "bart_size_mb": model_size_mb(bart_model),
+        "question_encoder_size_mb": model_size_mb(question_encoder)
+    }
+    for k in k_values:
+        results[f"precision_at_{k}"] = float(np.mean(precision_k[k])) if precision_k[k] else 0.0
+    return results
+
+if CONFIG.RUN_QUANTIZATION_REPORT:
+    quantization_report = {}
+    for task, val_loader in [("qa", qa_val_loader_v4), ("triple", triple_val_loader_v4)]:
+        print(f"Benchmarking fp32 vs int8 for {task}...")
+        fp32_models = load_fp32_models(task)
+        int8_models = (
+            prepare_for_inference(fp32_models[0], BartForConditionalGeneration, CONFIG.BART_MODEL_NAME, f"bart_{task}", mode="int8"),
+            prepare_for_inference(fp32_models[1], DPRContextEncoder, CONFIG.DPR_CTX_MODEL_NAME, f"dpr_ctx_encoder_rl_{task}", mode="int8"),
+            prepare_for_inference(fp32_models[2], DPRQuestionEncoder, CONFIG.DPR_QUESTION_MODEL_NAME, f"dpr_question_encoder_rl_{task}", mode="int8")
+        )
+        fp32_results = benchmark_inference_mode(*fp32_models, val_loader, all_candidates)
+        int8_results = benchmark_inference_mode(*int8_models, val_loader, all_candidates)
+        quantization_report[task] = {
+            "fp32": fp32_results,
+            "int8": int8_results,
+            "generate_speedup": fp32_results["generate_latency_ms"] / int8_results["generate_latency_ms"],
+            "question_encoder_speedup": fp32_results["question_encoder_latency_ms"] / int8_results["question_encoder_latency_ms"],
+            "ctx_encoder_speedup": fp32_results["ctx_encoder_latency_ms"] / int8_results["ctx_encoder_latency_ms"]
+        }
+        print(f"Task: {task}")
+        for metric in ["bleu", "mrr", "precision_at_1", "precision_at_5", "precision_at_10",
+                       "generate_latency_ms", "question_encoder_latency_ms", "ctx_encoder_latency_ms", "bart_size_mb", "question_encoder_size_mb"]:
+            print(f"{metric}: fp32={fp32_results[metric]:.4f}, int8={int8_results[metric]:.4f}")
+        print(f"Question encoder speedup: {quantization_report[task]['question_encoder_speedup']:.2f}x")
+        del fp32_models, int8_models
+        gc.collect()
+
+    quantization_report_path = os.path.join(CONFIG.BASE_PATH, "quantization_report_v4.json")
+    with open(quantization_report_path, "w") as f:
+        json.dump(quantization_report, f)
+    print(f"Saved quantization report at {quantization_report_path}")